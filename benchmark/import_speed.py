@@ -0,0 +1,78 @@
+"""
+Measures the time of `import ptypy` in fresh interpreters.
+
+"cold" runs start with an empty descriptor cache, such that all
+parameter docstrings are parsed, "warm" runs reuse the cache written
+by the previous run. With --all, the serial engines and all PtyScan
+modules are loaded as well. Under mpirun, all ranks import at the same
+moment, as they do at the start of a reconstruction.
+
+Usage:
+    python import_speed.py [--repeat N] [--all]
+    mpirun -n 64 python import_speed.py --mpi
+"""
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+import shutil
+
+IMPORT = """
+import time
+t = time.perf_counter()
+import ptypy
+%s
+print(time.perf_counter() - t)
+"""
+LOAD_ALL = "ptypy.load_gpu_engines('serial'); ptypy.load_all_ptyscan_modules()"
+
+
+def time_import(cache_dir, load_all=False):
+    env = dict(os.environ, PTYPY_CACHE_DIR=cache_dir)
+    code = IMPORT % (LOAD_ALL if load_all else '')
+    out = subprocess.run([sys.executable, '-c', code], env=env, check=True,
+                         stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    return float(out.stdout.split()[-1])
+
+
+def run_serial(repeat, load_all):
+    cold, warm = [], []
+    for n in range(repeat):
+        cache_dir = tempfile.mkdtemp(prefix='ptypy_cache')
+        try:
+            cold.append(time_import(cache_dir, load_all))
+            warm.append(time_import(cache_dir, load_all))
+        finally:
+            shutil.rmtree(cache_dir)
+    for name, t in [('cold', cold), ('warm', warm)]:
+        t = sorted(t)
+        print('%s import: median %.3f s, min %.3f s, max %.3f s (%d runs)'
+              % (name, t[len(t) // 2], t[0], t[-1], len(t)))
+
+
+def run_mpi(load_all):
+    # Time the import on all ranks of an MPI job, the cache is taken from the environment
+    t = time.perf_counter()
+    import ptypy
+    if load_all:
+        ptypy.load_gpu_engines('serial')
+        ptypy.load_all_ptyscan_modules()
+    duration = time.perf_counter() - t
+    from ptypy.utils import parallel
+    times = parallel.comm.gather(duration, root=0) if parallel.MPIenabled else [duration]
+    if parallel.master:
+        print('import on %d ranks: mean %.3f s, max %.3f s' % (len(times), sum(times) / len(times), max(times)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[1])
+    parser.add_argument('--repeat', type=int, default=5, help='number of cold and warm imports')
+    parser.add_argument('--all', action='store_true', help='also load serial engines and PtyScan modules')
+    parser.add_argument('--mpi', action='store_true', help='time the import in this process on every MPI rank')
+    args = parser.parse_args()
+    if args.mpi:
+        run_mpi(args.all)
+    else:
+        run_serial(args.repeat, args.all)
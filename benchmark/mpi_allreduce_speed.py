@@ -10,17 +10,40 @@ sizes ={
     'i14_2': (1, 3360, 3360), 
 }
 
-def run_benchmark(shape):
+# overlap of the rank regions in pixels (about one probe width)
+margin = 128
+
+def rank_region(shape):
+    """
+    Split the frame into a grid of tiles, one per rank, each extended
+    by margin to mimic the footprint of a rank's views.
+    """
+    ny = int(np.floor(np.sqrt(parallel.size)))
+    while parallel.size % ny:
+        ny -= 1
+    nx = parallel.size // ny
+    iy, ix = divmod(parallel.rank, nx)
+    ty, tx = shape[-2] // ny, shape[-1] // nx
+    y0, x0 = max(iy * ty - margin, 0), max(ix * tx - margin, 0)
+    y1, x1 = min((iy + 1) * ty + margin, shape[-2]), min((ix + 1) * tx + margin, shape[-1])
+    return y0, y1, x0, x1
+
+def run_benchmark(shape, sparse=False):
     megabytes = np.prod(shape) * 8 / 1024 / 1024 * 2
 
     data = np.zeros(shape, dtype=np.complex64)
+    region = rank_region(shape)
     
     # average 5 runs
     duration = 0
     for n in range(5):
         t1 = time.perf_counter()
-        parallel.allreduce(data)  # 2 calls to simulate ptypy obb / obn reduce
-        parallel.allreduce(data)
+        if sparse:
+            parallel.allreduce_region(data, region)
+            parallel.allreduce_region(data, region)
+        else:
+            parallel.allreduce(data)  # 2 calls to simulate ptypy obb / obn reduce
+            parallel.allreduce(data)
         t2 = time.perf_counter()
         duration += t2-t1
     duration /= 5
@@ -33,10 +56,11 @@ res = []
 
 for name,sz in sizes.items():
     mb, dur = run_benchmark(sz)
-    res.append([name, dur, mb, mb/dur])
+    mb, dur_sparse = run_benchmark(sz, sparse=True)
+    res.append([name, dur, dur_sparse, mb, mb/dur, mb/dur_sparse])
 
 if parallel.rank == 0:
     print('Final results for {} processes'.format(parallel.size))
-    print(','.join(['Name', 'Duration', 'MB', 'MB/s']))
+    print(','.join(['Name', 'Duration', 'Duration (regions)', 'MB', 'MB/s', 'MB/s (regions)']))
     for r in res:
         print(','.join([str(x) for x in r]))
@@ -17,29 +17,13 @@ To cite PTYPY in publications, use
 
 del short_version, release
 
-try:
-    import zmq
-except ImportError as ie:
-    __has_zmq__ = False
-else:
-    __has_zmq__ = True
-    del zmq
-
-try:
-    import mpi4py
-except ImportError as ie:
-    __has_mpi4py__ = False
-else:
-    __has_mpi4py__ = True
-    del mpi4py
-
-try:
-    import matplotlib
-except ImportError as ie:
-    __has_matplotlib__ = False
-else:
-    __has_matplotlib__ = True
-    del matplotlib
+# Check for optional dependencies without importing them, which is slow.
+# They are imported where they are used.
+from importlib.util import find_spec
+__has_zmq__ = find_spec('zmq') is not None
+__has_mpi4py__ = find_spec('mpi4py') is not None
+__has_matplotlib__ = find_spec('matplotlib') is not None
+del find_spec
 
 # Initialize MPI (eventually GPU)
 from .utils import parallel
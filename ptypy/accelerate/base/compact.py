@@ -0,0 +1,186 @@
+'''
+Compact host storage of diffraction magnitudes and masks for the serial engines.
+
+Frames are kept in a reduced precision and expanded to float32 on access,
+one batch of frames at a time.
+'''
+
+import numpy as np
+from . import FLOAT_TYPE
+
+# Frames expanded at once by the projectional engines if batch_size is not set
+COMPACT_BATCH_SIZE = 64
+
+
+class _CompactFrames(object):
+    """
+    Read-only stack of frames that expands to float32 when indexed.
+
+    Indexing along the first axis works as for a numpy array, e.g.
+    ``frames[sl]``, ``frames[idx]`` or ``frames[i, None]``.
+    """
+    dtype = np.dtype(FLOAT_TYPE)
+
+    def __init__(self, shape):
+        self.shape = tuple(shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def _expand(self, idx):
+        raise NotImplementedError
+
+    def __getitem__(self, item):
+        if not isinstance(item, tuple):
+            item = (item,)
+        idx, rest = item[0], item[1:]
+        out = self._expand(idx)
+        if not rest:
+            return out
+        if np.ndim(idx) == 0 and not isinstance(idx, slice):
+            return out[rest]
+        return out[(slice(None),) + rest]
+
+    def __array__(self, dtype=None, copy=None):
+        out = self._expand(slice(None))
+        return out if dtype is None else out.astype(dtype)
+
+
+class CompactMagnitudes(_CompactFrames):
+    """
+    Magnitudes ``sqrt(|I|)`` of a stack of intensities `data`.
+
+    With ``mode='float16'`` the magnitudes are stored in half precision
+    (relative error below 5e-4). With ``mode='uint16'`` they are quantized
+    to 16 bit integers with a scale per frame, giving an absolute error of
+    at most ``max(sqrt(I)) / 131070`` in each frame. Both are well below
+    the photon noise of about 0.5 on the magnitudes.
+    """
+    def __init__(self, data, mode='float16'):
+        super().__init__(data.shape)
+        self.mode = mode
+        mag = np.sqrt(np.abs(data), dtype=FLOAT_TYPE)
+        if mode == 'float16':
+            self.scale = None
+            self.mag = mag.astype(np.float16)
+        elif mode == 'uint16':
+            peak = mag.reshape(mag.shape[0], -1).max(-1) if mag.size else np.zeros(mag.shape[0])
+            self.scale = np.where(peak > 0, peak / 65535., 1.).astype(FLOAT_TYPE)
+            self.mag = np.rint(mag / self.scale[:, None, None]).astype(np.uint16)
+        else:
+            raise ValueError("Unknown compact data mode '%s'" % mode)
+
+    @property
+    def nbytes(self):
+        return self.mag.nbytes + (self.scale.nbytes if self.scale is not None else 0)
+
+    def _expand(self, idx):
+        out = self.mag[idx].astype(FLOAT_TYPE)
+        if self.scale is not None:
+            scale = self.scale[idx]
+            out *= scale[..., None, None] if np.ndim(scale) else scale
+        return out
+
+
+class PackedMask(_CompactFrames):
+    """
+    Binary mask stack packed into bits along the last axis.
+    """
+    def __init__(self, mask):
+        super().__init__(mask.shape)
+        self.bits = np.packbits(mask.astype(bool), axis=-1)
+
+    @property
+    def nbytes(self):
+        return self.bits.nbytes
+
+    def _expand(self, idx):
+        return np.unpackbits(self.bits[idx], axis=-1, count=self.shape[-1]).astype(FLOAT_TYPE)
+
+
+def serialize_frames(diff, mask, mode=None):
+    """
+    Magnitudes, mask and number of valid pixels per frame of the
+    diffraction storage `diff` and its mask storage `mask`.
+
+    If `mode` is given, magnitudes are stored as :py:class:`CompactMagnitudes`
+    with this mode and binary masks as :py:class:`PackedMask`. Storages whose
+    data has been released with :py:func:`release_frames` return the compact
+    frames kept at release.
+    """
+    released = getattr(diff, 'compact_frames', None)
+    if released is not None:
+        return released
+    ma = mask.data.astype(FLOAT_TYPE)
+    ma_sum = ma.sum(-1).sum(-1)
+    if not mode:
+        return np.sqrt(np.abs(diff.data)), ma, ma_sum
+    mag = CompactMagnitudes(diff.data, mode)
+    if np.array_equal(ma, ma.astype(bool)):
+        ma = PackedMask(ma)
+    return mag, ma, ma_sum
+
+
+def release_frames(diff, mask, frames):
+    """
+    Replace the data of the diffraction storage `diff` and of its mask
+    storage `mask` by empty arrays and keep the serialized `frames` instead.
+
+    Only the serial engines can work with such storages afterwards.
+    """
+    diff.compact_frames = frames
+    diff.data = np.empty((0,) + diff.data.shape[1:], dtype=diff.data.dtype)
+    mask.data = np.empty((0,) + mask.data.shape[1:], dtype=mask.data.dtype)
+
+
+class CompactDataMixin:
+    """
+    Serialization of the diffraction data for the serial engines,
+    optionally in reduced precision.
+
+    Defaults:
+
+    [compact_data]
+    default = None
+    type = str
+    help = Store diffraction magnitudes and masks in reduced precision
+    doc = One of:
+      - ``None`` : magnitudes and masks as float32 arrays
+      - ``'float16'`` : magnitudes in half precision, binary masks packed into bits
+      - ``'uint16'`` : magnitudes as 16 bit integers with a scale per frame, binary masks packed into bits
+      Frames are expanded to float32 in batches of at most ``batch_size`` frames when they are used.
+      The projectional engines use batches of 64 frames if ``batch_size`` is not set.
+    choices = None,'float16','uint16'
+    userlevel = 2
+
+    [release_data]
+    default = False
+    type = bool
+    help = Release the diffraction and mask storages once all data is serialized
+    doc = Only the compact copies of the engine are kept (see ``compact_data``), which are reused
+      by following serial projectional and stochastic engines. Any other engine, as well as
+      saving or plotting of the diffraction data, no longer works after the data is released.
+    userlevel = 2
+    """
+
+    def _serialize_frames(self, prep, d):
+        """
+        Store magnitudes, mask and number of valid pixels of the
+        diffraction storage `d` in `prep`.
+        """
+        prep.mag, prep.ma, prep.ma_sum = serialize_frames(d, self.ma.S[d.ID], self.p.compact_data)
+
+    def _release_data(self):
+        """
+        Keep only the serialized frames once the scan is complete.
+        """
+        if not (self.p.release_data and self.ptycho.model.end_of_scan):
+            return
+        for dID, prep in self.diff_info.items():
+            d = self.di.S[dID]
+            if getattr(d, 'compact_frames', None) is None:
+                release_frames(d, self.ma.S[dID], (prep.mag, prep.ma, prep.ma_sum))
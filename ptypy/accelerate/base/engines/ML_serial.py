@@ -13,12 +13,14 @@ This file is part of the PTYPY package.
 """
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from ptypy.engines.ML import ML, BaseModel
-from .projectional_serial import serialize_array_access
+from .projectional_serial import serialize_array_access, batch_slices, run_threaded, thread_buffers, PoUpdateModeMixin
 from ptypy import utils as u
 from ptypy.utils.verbose import logger, log
 from ptypy.utils import parallel
+from ptypy.utils.profiling import profiler
 from ptypy.engines.utils import Cnorm2, Cdot
 from ptypy.engines import register
 from ptypy.accelerate.base.kernels import GradientDescentKernel, AuxiliaryWaveKernel, PoUpdateKernel, PositionCorrectionKernel
@@ -29,7 +31,7 @@ from ptypy.accelerate.base.array_utils import complex_gaussian_filter, complex_g
 __all__ = ['ML_serial']
 
 @register()
-class ML_serial(ML):
+class ML_serial(ML, PoUpdateModeMixin):
 
     """
     Defaults:
@@ -38,6 +40,37 @@ class ML_serial(ML):
     default = convolution
     type = str
     help = Method to be used for smoothing the gradient, choose between ```convolution``` or ```fft```.
+
+    [batch_size]
+    default = None
+    type = int
+    help = Maximum number of diffraction frames processed at once
+    doc = Each diffraction block is streamed through auxiliary buffers of this many frames,
+      which bounds the memory used for exit waves independently of ``frames_per_block``.
+      If ``None``, a whole block is processed at once.
+    userlevel = 2
+    lowlim = 1
+
+    [num_threads]
+    default = 1
+    type = int
+    help = Number of threads per MPI rank
+    doc = Batches of frames (see ``batch_size``) are distributed over a pool of threads
+      with their own buffers. Gradients are accumulated in private arrays per thread
+      and summed before the MPI reduction.
+    userlevel = 2
+    lowlim = 1
+
+    [exit_cache_frames]
+    default = 0
+    type = int
+    help = Number of frames whose propagated exit waves are reused by the line search
+    doc = The gradient pass keeps the forward-propagated exit waves of up to this many frames
+      (all probe modes, single precision) and the line-search pass uses them instead of
+      rebuilding and propagating them, saving one of the five FFTs per frame and iteration.
+      The budget is filled with whole work units (see ``batch_size``). ``0`` disables the cache.
+    userlevel = 2
+    lowlim = 0
     """
 
     def __init__(self, ptycho_parent, pars=None):
@@ -48,15 +81,25 @@ class ML_serial(ML):
 
         self.kernels = {}
         self.diff_info = {}
+        self.addr_tables = {}
         self.cn2_ob_grad = 0.
         self.cn2_pr_grad = 0.
 
+        # Thread pool and private accumulators for threaded execution
+        self._pool = None
+        self._thread_bufs = {}
+
     def engine_initialize(self):
         """
         Prepare for ML reconstruction.
         """
+        if self.p.minibatch_fraction < 1. and self.p.batch_size is None:
+            raise RuntimeError("minibatch_fraction < 1 requires a batch_size, "
+                               "mini-batches are drawn from blocks of batch_size frames")
         super(ML_serial, self).engine_initialize()
         self._setup_kernels()
+        if self.p.num_threads > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self.p.num_threads)
 
     def _initialize_model(self):
 
@@ -86,6 +129,9 @@ class ML_serial(ML):
 
             # Get info to shape buffer arrays
             fpc = scan.max_frames_per_block
+            if self.p.batch_size is not None:
+                fpc = min(fpc, self.p.batch_size)
+            kern.batch_size = fpc
 
             # TODO : make this more foolproof
             try:
@@ -104,20 +150,64 @@ class ML_serial(ML):
             kern.GDK = GradientDescentKernel(aux, nmodes)
             kern.GDK.allocate()
 
-            kern.POK = PoUpdateKernel()
+            kern.POK = PoUpdateKernel(mode=self.p.po_update_mode)
             kern.POK.allocate()
 
             kern.AWK = AuxiliaryWaveKernel()
             kern.AWK.allocate()
 
-            kern.FW = geo.propagator.fw
-            kern.BW = geo.propagator.bw
+            kern.FW = geo.propagator.fw_inplace
+            kern.BW = geo.propagator.bw_inplace
             kern.resolution = geo.resolution[0]
 
             if self.do_position_refinement:
                 kern.PCK = PositionCorrectionKernel(aux, nmodes, self.p.position_refinement, geo.resolution)
                 kern.PCK.allocate()
 
+            # buffers and buffered kernels for each thread
+            kern.threads = [u.Param(aux=aux, a=kern.a, b=kern.b, GDK=kern.GDK)]
+            for tid in range(1, self.p.num_threads):
+                taux = np.zeros(ash, dtype=np.complex64)
+                GDK = GradientDescentKernel(taux, nmodes)
+                GDK.allocate()
+                kern.threads.append(u.Param(aux=taux,
+                                            a=np.zeros(ash, dtype=np.complex64),
+                                            b=np.zeros(ash, dtype=np.complex64),
+                                            GDK=GDK))
+
+    def _all_work_units(self):
+        """
+        List of (dID, batch slice) pairs covering all diffraction data.
+        """
+        units = []
+        for dID in self.di.S.keys():
+            prep = self.diff_info[dID]
+            batch_size = self.kernels[prep.label].batch_size
+            units += [(dID, sl) for sl in batch_slices(prep.addr.shape[0], batch_size)]
+        return units
+
+    def _work_units(self):
+        """
+        List of (dID, batch slice) pairs of the current mini-batch.
+        """
+        return self._all_work_units() if self.batch is None else self.batch
+
+    def _select_batch(self):
+        """
+        Draw the work units used in this iteration. The mini-batch is
+        made of whole work units, i.e. blocks of ``batch_size`` frames.
+        """
+        fraction = self._batch_fraction()
+        if fraction >= 1.:
+            self.batch = None
+            self.batch_scale = 1.
+            return
+        units = self._all_work_units()
+        n = min(len(units), max(1, int(np.ceil(fraction * len(units)))))
+        self.batch = [units[i] for i in np.sort(self._draw_batch(len(units), n))]
+        self._set_batch_scale(sum(sl.stop - sl.start for dID, sl in units),
+                              sum(sl.stop - sl.start for dID, sl in self.batch))
+
     def engine_prepare(self):
 
         ## Serialize new data ##
@@ -131,12 +221,13 @@ class ML_serial(ML):
             # they get overridden if self.p.floating_intensities=True
             prep.float_intens_coeff = np.ones((d.data.shape[0],), dtype=np.float32)
 
-        # Unfortunately this needs to be done for all pods, since
-        # the shape of the probe / object was modified.
-        # TODO: possible scaling issue
+        # Addresses need to be gathered for all pods, since the shape of
+        # the probe / object may have been modified. Only pods of new
+        # views are looked up.
         for label, d in self.di.storages.items():
             prep = self.diff_info[d.ID]
-            prep.view_IDs, prep.poe_IDs, prep.addr = serialize_array_access(d)
+            prep.view_IDs, prep.poe_IDs, prep.addr = serialize_array_access(
+                d, table=self.addr_tables.setdefault(d.ID, u.Param()))
             # Re-create exit addresses when gradient models (single exit buffer per view) are used
             # TODO: this should not be necessary, kernels should not use exit wave information
             if self.kernels[prep.label].scanmodel in ("GradFull", "BlockGradFull"):
@@ -154,9 +245,9 @@ class ML_serial(ML):
 
     def _get_smooth_gradient(self, data, sigma):
         if self.p.smooth_gradient_method == "convolution":
-            return complex_gaussian_filter(data, sigma)
+            return complex_gaussian_filter(data, [sigma, sigma])
         elif self.p.smooth_gradient_method == "fft":
-            return complex_gaussian_filter_fft(data, sigma)
+            return complex_gaussian_filter_fft(data, [sigma, sigma])
         else:
             raise NotImplementedError("smooth_gradient_method should be ```convolution``` or ```fft```.")
 
@@ -200,9 +291,12 @@ class ML_serial(ML):
         ta = time.time()
         for it in range(num):
             t1 = time.time()
+            self._select_batch()
             error_dct = self.ML_model.new_grad()
             tg += time.time() - t1
 
+            if self.lbfgs is not None:
+                self.lbfgs.keep_gradient(self.ob_grad, self.pr_grad)
             cn2_new_pr_grad, cdotr_pr_grad = self._replace_pr_grad()
             cn2_new_ob_grad, cdotr_ob_grad = self._replace_ob_grad()
 
@@ -223,36 +317,48 @@ class ML_serial(ML):
                 self.scale_p_o = self.p.scale_probe_object
 
             ############################
-            # Compute next conjugate
+            # Compute next search direction
             ############################
-            if self.curiter == 0:
-                bt = 0.
+            dt = self.ptycho.FType
+            if self.lbfgs is not None:
+                self.lbfgs.update(self.ob_grad, self.pr_grad)
+                smooth = None
+                if self.smooth_gradient:
+                    smooth = lambda data: self._get_smooth_gradient(data, self.smooth_gradient.sigma)
+                self.lbfgs.direction(self.ob_grad, self.pr_grad,
+                                     self.ob_h, self.pr_h, self.scale_p_o, smooth)
             else:
-                bt_num = (self.scale_p_o * (cn2_new_pr_grad - cdotr_pr_grad) + (cn2_new_ob_grad - cdotr_ob_grad))
+                if self.curiter == 0:
+                    bt = 0.
+                else:
+                    bt_num = (self.scale_p_o * (cn2_new_pr_grad - cdotr_pr_grad) + (cn2_new_ob_grad - cdotr_ob_grad))
 
-                bt_denom = self.scale_p_o * self.cn2_pr_grad + self.cn2_ob_grad
+                    bt_denom = self.scale_p_o * self.cn2_pr_grad + self.cn2_ob_grad
 
-                bt = max(0, bt_num / bt_denom)
+                    bt = max(0, bt_num / bt_denom)
+                    # gradients of different mini-batches can be far apart,
+                    # restart the conjugate directions if they are
+                    if self.batch is not None and bt > 1.:
+                        bt = 0.
 
-            # logger.info('Polak-Ribiere coefficient: %f ' % bt)
+                # logger.info('Polak-Ribiere coefficient: %f ' % bt)
 
-            self.cn2_ob_grad = cn2_new_ob_grad
-            self.cn2_pr_grad = cn2_new_pr_grad
+                self.cn2_ob_grad = cn2_new_ob_grad
+                self.cn2_pr_grad = cn2_new_pr_grad
 
-            dt = self.ptycho.FType
-            # 3. Next conjugate
-            self.ob_h *= dt(bt / self.tmin)
+                # 3. Next conjugate
+                self.ob_h *= dt(bt / self.tmin)
 
-            # Smoothing preconditioner
-            if self.smooth_gradient:
-                for name, s in self.ob_h.storages.items():
-                    s.data[:] -= self._get_smooth_gradient(self.ob_grad.storages[name].data, self.smooth_gradient.sigma)
-            else:
-                self.ob_h -= self.ob_grad
+                # Smoothing preconditioner
+                if self.smooth_gradient:
+                    for name, s in self.ob_h.storages.items():
+                        s.data[:] -= self._get_smooth_gradient(self.ob_grad.storages[name].data, self.smooth_gradient.sigma)
+                else:
+                    self.ob_h -= self.ob_grad
 
-            self.pr_h *= dt(bt / self.tmin)
-            self.pr_grad *= dt(self.scale_p_o)
-            self.pr_h -= self.pr_grad
+                self.pr_h *= dt(bt / self.tmin)
+                self.pr_grad *= dt(self.scale_p_o)
+                self.pr_h -= self.pr_grad
 
             # In principle, the way things are now programmed this part
             # could be iterated over in a real Newton-Raphson style.
@@ -271,6 +377,8 @@ class ML_serial(ML):
             self.pr_h *= self.tmin
             self.ob += self.ob_h
             self.pr += self.pr_h
+            if self.lbfgs is not None:
+                self.lbfgs.store_step(self.ob_h, self.pr_h)
             # Newton-Raphson loop would end here
 
             # Refine the scan positions
@@ -282,6 +390,8 @@ class ML_serial(ML):
             # increase iteration counter
             self.curiter += 1
 
+        profiler.add_time('gradient', tg)
+        profiler.add_time('line_search', tc)
         logger.info('Time spent in gradient calculation: %.2f' % tg)
         logger.info('  ....  in coefficient calculation: %.2f' % tc)
         return error_dct  # np.array([[self.ML_model.LL[0]] * 3])
@@ -324,9 +434,11 @@ class ML_serial(ML):
                 max_obx = ob.shape[-1] - aux.shape[-1] - 1
 
                 # We need to re-calculate the current error
-                PCK.build_aux(aux, addr, ob, pr)
-                aux[:] = FW(aux)
-                PCK.log_likelihood_ml(aux, addr, I, w, err_phot)
+                for sl in batch_slices(addr.shape[0], kern.batch_size):
+                    baux = aux[:(sl.stop - sl.start) * addr.shape[1]]
+                    PCK.build_aux(baux, addr[sl], ob, pr)
+                    FW(baux)
+                    PCK.log_likelihood_ml(baux, addr[sl], I[sl], w[sl], err_phot[sl])
                 error_state = np.zeros_like(err_phot)
                 error_state[:] = err_phot
                 PCK.mangler.setup_shifts(self.curiter, nframes=addr.shape[0])
@@ -334,9 +446,11 @@ class ML_serial(ML):
                 log(4, 'Position refinement trial: iteration %s' % (self.curiter))
                 for i in range(PCK.mangler.nshifts):
                     PCK.mangler.get_address(i, addr, mangled_addr, max_oby, max_obx)
-                    PCK.build_aux(aux, mangled_addr, ob, pr)
-                    aux[:] = FW(aux)
-                    PCK.log_likelihood_ml(aux, mangled_addr, I, w, err_phot)
+                    for sl in batch_slices(addr.shape[0], kern.batch_size):
+                        baux = aux[:(sl.stop - sl.start) * addr.shape[1]]
+                        PCK.build_aux(baux, mangled_addr[sl], ob, pr)
+                        FW(baux)
+                        PCK.log_likelihood_ml(baux, mangled_addr[sl], I[sl], w[sl], err_phot[sl])
                     PCK.update_addr_and_error_state(addr, error_state, mangled_addr, err_phot)
 
                 prep.err_phot = error_state
@@ -363,6 +477,10 @@ class ML_serial(ML):
             prep = self.diff_info[d.ID]
             float_intens_coeff[label] = prep.float_intens_coeff
         self.ptycho.runtime["float_intens"] = parallel.gather_dict(float_intens_coeff)
+
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
         super().engine_finalize()
 
 
@@ -390,6 +508,10 @@ class GaussianModel(BaseModelSerial):
         """
         super(GaussianModel, self).__init__(MLengine)
 
+        # propagated exit waves of the last gradient pass, by work unit
+        self.fcache = {}
+        self.fcache_valid = False
+
     def prepare(self):
 
         super(GaussianModel, self).prepare()
@@ -405,6 +527,29 @@ class GaussianModel(BaseModelSerial):
         """
         super(GaussianModel, self).__del__()
 
+    def _cache_units(self, units):
+        """
+        Buffers for the propagated exit waves of the leading work units
+        within the ``exit_cache_frames`` budget, reusing those of the
+        last pass. Buffers of other units are released.
+        """
+        budget = self.engine.p.exit_cache_frames
+        cache = {}
+        for dID, sl in units:
+            nframes = sl.stop - sl.start
+            if nframes > budget:
+                break
+            budget -= nframes
+            prep = self.engine.diff_info[dID]
+            aux = self.engine.kernels[prep.label].aux
+            shape = (nframes * prep.addr.shape[1],) + aux.shape[1:]
+            buf = self.fcache.get((dID, sl.start))
+            if buf is None or buf.shape != shape:
+                buf = np.empty(shape, dtype=aux.dtype)
+            cache[(dID, sl.start)] = buf
+        self.fcache = cache
+        return cache
+
     def new_grad(self):
         """
         Compute a new gradient direction according to a Gaussian noise model.
@@ -421,66 +566,93 @@ class GaussianModel(BaseModelSerial):
         LL = np.array([0.])
         error_dct = {}
 
-        for dID in self.di.S.keys():
+        # one gradient accumulator per thread
+        nthreads = self.engine.p.num_threads
+        cache = self.engine._thread_bufs
+        obgs = {oID: thread_buffers(cache, ('obg', oID), s.data, nthreads)
+                for oID, s in ob_grad.storages.items()}
+        prgs = {pID: thread_buffers(cache, ('prg', pID), s.data, nthreads)
+                for pID, s in pr_grad.storages.items()}
+
+        def grad(tid, dID, sl):
             prep = self.engine.diff_info[dID]
             # find probe, object in exit ID in dependence of dID
             pID, oID, eID = prep.poe_IDs
 
             # references for kernels
             kern = self.engine.kernels[prep.label]
-            GDK = kern.GDK
+            GDK = kern.threads[tid].GDK
             AWK = kern.AWK
             POK = kern.POK
 
-            aux = kern.aux
-
             FW = kern.FW
             BW = kern.BW
 
-            # get addresses and auxilliary array
-            addr = prep.addr
-            w = prep.weights
-            err_phot = prep.err_phot
-            fic = prep.float_intens_coeff
+            # get addresses and auxilliary array,
+            # the exit addresses index the aux buffer, shift them to the batch
+            addr = prep.addr[sl].copy()
+            addr[:, :, 2, 0] -= sl.start * addr.shape[1]
+            aux = kern.threads[tid].aux
+            baux = aux[:addr.shape[0] * addr.shape[1]]
+            w = prep.weights[sl]
+            err_phot = prep.err_phot[sl]
+            fic = prep.float_intens_coeff[sl]
 
             # local references
             ob = self.engine.ob.S[oID].data
-            obg = ob_grad.S[oID].data
+            obg = obgs[oID][tid]
             pr = self.engine.pr.S[pID].data
-            prg = pr_grad.S[pID].data
-            I = prep.I
+            prg = prgs[pID][tid]
+            I = prep.I[sl]
 
             # make propagated exit (to buffer)
-            AWK.build_aux_no_ex(aux, addr, ob, pr, add=False)
+            AWK.build_aux_no_ex(baux, addr, ob, pr, add=False)
 
             # forward prop
-            aux[:] = FW(aux)
+            FW(baux)
+
+            # keep for the line search
+            fbuf = fcache.get((dID, sl.start))
+            if fbuf is not None:
+                fbuf[:] = baux
 
             GDK.make_model(aux, addr)
 
             if self.p.floating_intensities:
                 GDK.floating_intensity(addr, w, I, fic)
 
-            GDK.main(aux, addr, w, I)
+            GDK.main(baux, addr, w, I)
             GDK.error_reduce(addr, err_phot)
-            aux[:] = BW(aux)
+            BW(baux)
+
+            POK.ob_update_ML(addr, obg, pr, baux)
+            POK.pr_update_ML(addr, prg, ob, baux)
 
-            POK.ob_update_ML(addr, obg, pr, aux)
-            POK.pr_update_ML(addr, prg, ob, aux)
+        units = self.engine._work_units()
+        fcache = self._cache_units(units)
+        run_threaded(self.engine._pool, grad, units, nthreads)
+        self.fcache_valid = True
 
-        for dID, prep in self.engine.diff_info.items():
-            err_phot = prep.err_phot
+        # reduce the thread accumulators
+        for bufs in list(obgs.values()) + list(prgs.values()):
+            for buf in bufs[1:]:
+                bufs[0] += buf
+
+        for dID, sl in units:
+            prep = self.engine.diff_info[dID]
+            err_phot = prep.err_phot[sl]
             LL += err_phot.sum()
             err_phot /= np.prod(prep.weights.shape[-2:])
             err_fourier = np.zeros_like(err_phot)
             err_exit = np.zeros_like(err_phot)
             errs = np.ascontiguousarray(np.vstack([err_fourier, err_phot, err_exit]).T)
-            error_dct.update(zip(prep.view_IDs, errs))
+            error_dct.update(zip(prep.view_IDs[sl], errs))
 
         # MPI reduction of gradients
         ob_grad.allreduce()
         pr_grad.allreduce()
         parallel.allreduce(LL)
+        self._batch_rescale(ob_grad, pr_grad, LL)
 
         # Object regularizer
         if self.regularizer:
@@ -500,8 +672,11 @@ class GaussianModel(BaseModelSerial):
         B = np.zeros((3,), dtype=np.longdouble)
         Brenorm = 1. / self.LL[0] ** 2
 
-        # Outer loop: through diffraction patterns
-        for dID in self.di.S.keys():
+        # one set of coefficients per thread
+        nthreads = self.engine.p.num_threads
+        Bs = [B] + [np.zeros_like(B) for tid in range(1, nthreads)]
+
+        def coeffs(tid, dID, sl):
             prep = self.engine.diff_info[dID]
 
             # find probe, object in exit ID in dependence of dID
@@ -509,42 +684,58 @@ class GaussianModel(BaseModelSerial):
 
             # references for kernels
             kern = self.engine.kernels[prep.label]
-            GDK = kern.GDK
+            GDK = kern.threads[tid].GDK
             AWK = kern.AWK
 
-            f = kern.aux
-            a = kern.a
-            b = kern.b
-
             FW = kern.FW
 
-            # get addresses and auxilliary array
-            addr = prep.addr
-            w = prep.weights
-            fic = prep.float_intens_coeff
+            # get addresses and auxilliary arrays
+            addr = prep.addr[sl]
+            nz = addr.shape[0] * addr.shape[1]
+            f = kern.threads[tid].aux[:nz]
+            a = kern.threads[tid].a[:nz]
+            b = kern.threads[tid].b[:nz]
+            w = prep.weights[sl]
+            fic = prep.float_intens_coeff[sl]
 
             # local references
             ob = self.ob.S[oID].data
             ob_h = c_ob_h.S[oID].data
             pr = self.pr.S[pID].data
             pr_h = c_pr_h.S[pID].data
-            I = self.di.S[dID].data
+            I = self.di.S[dID].data[sl]
 
-            # make propagated exit (to buffer)
-            AWK.build_aux_no_ex(f, addr, ob, pr, add=False)
+            # make propagated exit (to buffer), unless kept by the gradient pass
+            fbuf = fcache.get((dID, sl.start))
+            if fbuf is None:
+                AWK.build_aux_no_ex(f, addr, ob, pr, add=False)
+            else:
+                f = fbuf
             AWK.build_aux_no_ex(a, addr, ob_h, pr, add=False)
             AWK.build_aux_no_ex(a, addr, ob, pr_h, add=True)
             AWK.build_aux_no_ex(b, addr, ob_h, pr_h, add=False)
 
             # forward prop
-            f[:] = FW(f)
-            a[:] = FW(a)
-            b[:] = FW(b)
+            if fbuf is None:
+                FW(f)
+            FW(a)
+            FW(b)
 
             GDK.make_a012(f, a, b, addr, I, fic)
-            GDK.fill_b(addr, Brenorm, w, B)
+            GDK.fill_b(addr, Brenorm, w, Bs[tid])
+
+        # object and probe have not changed since the gradient pass
+        fcache = self.fcache if self.fcache_valid else {}
+        self.fcache_valid = False
+
+        # Outer loop: through diffraction patterns
+        run_threaded(self.engine._pool, coeffs, self.engine._work_units(), nthreads)
+
+        for Bt in Bs[1:]:
+            B += Bt
 
         parallel.allreduce(B)
+        self._batch_rescale(B)
 
         # Object regularizer
         if self.regularizer:
@@ -9,6 +9,7 @@ This file is part of the PTYPY package.
 """
 import numpy as np
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 from ptypy import utils as u
 from ptypy.utils.verbose import logger, log
@@ -17,13 +18,13 @@ from ptypy.engines import register
 from ptypy.engines.projectional import _ProjectionEngine, DMMixin, RAARMixin
 from ptypy.accelerate.base.kernels import FourierUpdateKernel, AuxiliaryWaveKernel, PoUpdateKernel, PositionCorrectionKernel
 from ptypy.accelerate.base import array_utils as au
+from ptypy.accelerate.base.compact import CompactDataMixin, COMPACT_BATCH_SIZE
 
 
 ### TODOS
 #
 # - The Propagator needs to be made somewhere else
 # - Get it running faster with MPI (partial sync)
-# - implement "batching" when processing frames to lower the pressure on memory
 # - Be smarter about the engine.prepare() part
 # - Propagator needs to be reconfigurable for a certain batch size, gpyfft hates that.
 # - Fourier_update_kernel needs to allow batched execution
@@ -48,58 +49,199 @@ def gaussian_kernel(sigma, size=None, sigma_y=None, size_y=None):
     return g / g.sum()
 
 
-def serialize_array_access(diff_storage):
+def serialize_array_access(diff_storage, table=None):
+    """
+    Build the address array of all active views of `diff_storage`, sorted
+    according to their layer in the diffraction stack.
+
+    The pods of each view are looked up once and remembered as rows of the
+    view tables of the probe, object, exit, diffraction and mask
+    containers. Addresses are then gathered from these tables, such that
+    storages that were padded or shifted by a reformat are accounted for.
+
+    Parameters
+    ----------
+    diff_storage : Storage
+        The diffraction storage.
+    table : Param or None
+        Lookup table kept by the caller across calls for this storage. If
+        given, only views added since the previous call are looked up.
+
+    Returns
+    -------
+    view_IDs, poe_ID, addr
+    """
+    C = diff_storage.owner
+    rows = C.view_rows(diff_storage)
+    if table is None:
+        table = u.Param()
+
+    # Start over if views have been deactivated in the meantime
+    known = table.get('di_rows')
+    if known is None or len(np.intersect1d(known, rows)) != len(known):
+        known = np.zeros((0,), dtype=int)
+        table.di_rows = known
+        table.view_IDs = []
+        table.rows = None
+    new = np.setdiff1d(rows, known, assume_unique=True)
+
+    if len(new) > 0:
+        # Row of a view in the view table of its container
+        views = list(C.original.V.values())
+        if table.rows is None:
+            # Master pod
+            mpod = views[new[0]].pod
+            # Determine linked storages for probe, object and exit waves
+            table.poe_ID = (mpod.pr_view.storage.ID,
+                            mpod.ob_view.storage.ID,
+                            mpod.ex_view.storage.ID)
+            table.containers = [mpod.pr_view.owner, mpod.ob_view.owner,
+                                mpod.ex_view.owner, mpod.di_view.owner,
+                                mpod.ma_view.owner]
+        prID, obID, exID = table.poe_ID
+
+        new_rows = []
+        for r in new:
+            view = views[r]
+            view_rows = []
+            for pname, pod in view.pods.items():
+                view_rows.append([pod.pr_view.numID - 1,
+                                  pod.ob_view.numID - 1,
+                                  pod.ex_view.numID - 1,
+                                  pod.di_view.numID - 1,
+                                  pod.ma_view.numID - 1])
+
+                if pod.pr_view.storage.ID != prID:
+                    log(1, "Splitting probes for one diffraction stack is not supported in " + __name__)
+                if pod.ob_view.storage.ID != obID:
+                    log(1, "Splitting objects for one diffraction stack is not supported in " + __name__)
+                if pod.ex_view.storage.ID != exID:
+                    log(1, "Splitting exit stacks for one diffraction stack is not supported in " + __name__)
+
+            new_rows.append(view_rows)
+            table.view_IDs.append(view.ID)
+
+        new_rows = np.array(new_rows, dtype=int)
+        table.rows = new_rows if table.rows is None else np.concatenate([table.rows, new_rows])
+        table.di_rows = np.concatenate([known, new])
+
+    # Gather the addresses (layer, dlow) of all pod views
+    vrows = table.rows
+    addr = np.zeros(vrows.shape + (3,), dtype=np.int32)
+    for k, c in enumerate(table.containers):
+        recs = c.view_records
+        addr[:, :, k, 0] = recs['dlayer'][vrows[:, :, k]]
+        addr[:, :, k, 1:] = recs['dlow'][vrows[:, :, k], :2]
+
     # Sort views according to layer in diffraction stack
-    views = diff_storage.views
-    dlayers = [view.dlayer for view in views]
-    views = [views[i] for i in np.argsort(dlayers)]
-    view_IDs = [view.ID for view in views]
-
-    # Master pod
-    mpod = views[0].pod
-
-    # Determine linked storages for probe, object and exit waves
-    pr = mpod.pr_view.storage
-    ob = mpod.ob_view.storage
-    ex = mpod.ex_view.storage
-
-    poe_ID = (pr.ID, ob.ID, ex.ID)
-
-    addr = []
-    for view in views:
-        address = []
-
-        for pname, pod in view.pods.items():
-            ## store them for each pod
-            # create addresses
-            a = np.array(
-                [(pod.pr_view.dlayer, pod.pr_view.dlow[0], pod.pr_view.dlow[1]),
-                 (pod.ob_view.dlayer, pod.ob_view.dlow[0], pod.ob_view.dlow[1]),
-                 (pod.ex_view.dlayer, pod.ex_view.dlow[0], pod.ex_view.dlow[1]),
-                 (pod.di_view.dlayer, pod.di_view.dlow[0], pod.di_view.dlow[1]),
-                 (pod.ma_view.dlayer, pod.ma_view.dlow[0], pod.ma_view.dlow[1])])
-
-            address.append(a)
-
-            if pod.pr_view.storage.ID != pr.ID:
-                log(1, "Splitting probes for one diffraction stack is not supported in " + __name__)
-            if pod.ob_view.storage.ID != ob.ID:
-                log(1, "Splitting objects for one diffraction stack is not supported in " + __name__)
-            if pod.ex_view.storage.ID != ex.ID:
-                log(1, "Splitting exit stacks for one diffraction stack is not supported in " + __name__)
-
-        ## store data for each view
-        # adresses
-        addr.append(address)
+    order = np.argsort(addr[:, 0, 3, 0], kind='stable')
+    view_IDs = [table.view_IDs[i] for i in order]
 
     # store them for each storage
-    return view_IDs, poe_ID, np.array(addr).astype(np.int32)
+    return view_IDs, table.poe_ID, addr[order]
+
+
+def batch_slices(nframes, batch_size):
+    """
+    Split `nframes` consecutive frames into slices of at most
+    `batch_size` frames.
+    """
+    for start in range(0, nframes, batch_size):
+        yield slice(start, min(start + batch_size, nframes))
+
+
+def run_threaded(pool, func, units, nthreads):
+    """
+    Call ``func(tid, *unit)`` for all work `units`, distributed round-robin
+    over `nthreads` threads of `pool`. The thread index `tid` selects the
+    buffers a call may write to. Runs in the calling thread if `pool` is None.
+    """
+    if pool is None:
+        for unit in units:
+            func(0, *unit)
+        return
+
+    def work(tid):
+        for unit in units[tid::nthreads]:
+            func(tid, *unit)
+
+    for future in [pool.submit(work, tid) for tid in range(nthreads)]:
+        future.result()
+
+
+def thread_buffers(cache, key, arr, nthreads):
+    """
+    Return a list of `nthreads` accumulators for `arr`. The first one is
+    `arr` itself, the others are zeroed private arrays kept in `cache`.
+    """
+    bufs = cache.get(key)
+    if bufs is None or len(bufs) != nthreads - 1 or (bufs and bufs[0].shape != arr.shape):
+        bufs = [np.zeros_like(arr) for tid in range(1, nthreads)]
+        cache[key] = bufs
+    else:
+        for buf in bufs:
+            buf.fill(0)
+    return [arr] + bufs
+
+
+class PoUpdateModeMixin:
+    """
+    Execution mode of the object and probe update kernels of the serial engines.
+
+    Defaults:
+
+    [po_update_mode]
+    default = loop
+    type = str
+    help = Execution mode of the numpy object/probe update kernels
+    doc = One of:
+      - ``'loop'`` : update object and probe view by view
+      - ``'batched'`` : process blocks of views with vectorized arithmetic
+      Batching pays off for many small frames, it is about twice as fast for 16x16 frames and
+      breaks even at about 64x64. Frames of 64x64 pixels or more, and single views, are therefore
+      updated view by view in either mode.
+    choices = 'loop','batched'
+    userlevel = 2
+    """
 
 
-class _ProjectionEngine_serial(_ProjectionEngine):
+class _ProjectionEngine_serial(_ProjectionEngine, CompactDataMixin, PoUpdateModeMixin):
     """
     A full-fledged Difference Map engine that uses numpy arrays instead of iteration.
 
+    Defaults:
+
+    [batch_size]
+    default = None
+    type = int
+    help = Maximum number of diffraction frames processed at once
+    doc = Each diffraction block is streamed through an auxiliary buffer of this many frames,
+      which bounds the memory used for exit waves independently of ``frames_per_block``.
+      If ``None``, a whole block is processed at once, or 64 frames with ``compact_data``.
+    userlevel = 2
+    lowlim = 1
+
+    [sparse_allreduce]
+    default = False
+    type = bool
+    help = Only exchange overlapping object regions between MPI ranks
+    doc = During an iteration each rank keeps the object up to date only within the bounding
+      box of its own views (widened by the position refinement search range). Object updates
+      are exchanged with the ranks whose boxes overlap instead of reducing the whole object,
+      and the full object is synchronised once at the end of every call to ``iterate``.
+      Falls back to full reductions if ``obj_smooth_std`` is set.
+    userlevel = 2
+
+    [num_threads]
+    default = 1
+    type = int
+    help = Number of threads per MPI rank
+    doc = Batches of frames (see ``batch_size``) are distributed over a pool of threads
+      with their own buffers. Object and probe updates are accumulated in private arrays
+      per thread and summed before the MPI reduction.
+    userlevel = 2
+    lowlim = 1
+
     """
 
     def __init__(self, ptycho_parent, pars=None):
@@ -123,10 +265,15 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
         # Stores all information needed with respect to the diffraction storages.
         self.diff_info = {}
+        self.addr_tables = {}
         self.ob_cfact = {}
         self.pr_cfact = {}
         self.kernels = {}
 
+        # Thread pool and private accumulators for threaded execution
+        self._pool = None
+        self._thread_bufs = {}
+
     def engine_initialize(self):
         """
         Prepare for reconstruction.
@@ -135,6 +282,8 @@ class _ProjectionEngine_serial(_ProjectionEngine):
         super().engine_initialize()
         self._reset_benchmarks()
         self._setup_kernels()
+        if self.p.num_threads > 1:
+            self._pool = ThreadPoolExecutor(max_workers=self.p.num_threads)
 
     def _reset_benchmarks(self):
         self.benchmark.A_Build_aux = 0.
@@ -148,6 +297,19 @@ class _ProjectionEngine_serial(_ProjectionEngine):
         self.benchmark.calls_fourier = 0
         self.benchmark.calls_object = 0
         self.benchmark.calls_probe = 0
+        # Fourier update timings of each thread, added up after each iteration
+        self._thread_benchmarks = [dict.fromkeys(['A_Build_aux', 'B_Prop', 'C_Fourier_update', 'D_iProp',
+                                                  'E_Build_exit', 'F_LLerror'], 0.)
+                                   for tid in range(self.p.num_threads)]
+
+    def _collect_benchmarks(self):
+        """
+        Add the timings of all threads to the benchmark.
+        """
+        for bench in self._thread_benchmarks:
+            for name, t in bench.items():
+                self.benchmark[name] += t
+                bench[name] = 0.
 
     def _setup_kernels(self):
         """
@@ -165,6 +327,12 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
             # Get info to shape buffer arrays
             fpc = scan.max_frames_per_block
+            if self.p.batch_size is not None:
+                fpc = min(fpc, self.p.batch_size)
+            elif self.p.compact_data:
+                # Bound the frames expanded from the compact storage at once
+                fpc = min(fpc, COMPACT_BATCH_SIZE)
+            kern.batch_size = fpc
 
             # TODO : make this more foolproof
             try:
@@ -182,20 +350,39 @@ class _ProjectionEngine_serial(_ProjectionEngine):
             kern.FUK = FourierUpdateKernel(aux, nmodes)
             kern.FUK.allocate()
 
-            kern.POK = PoUpdateKernel()
+            kern.POK = PoUpdateKernel(mode=self.p.po_update_mode)
             kern.POK.allocate()
 
             kern.AWK = AuxiliaryWaveKernel()
             kern.AWK.allocate()
 
-            kern.FW = geo.propagator.fw
-            kern.BW = geo.propagator.bw
+            kern.FW = geo.propagator.fw_inplace
+            kern.BW = geo.propagator.bw_inplace
             kern.resolution = geo.resolution[0]
 
             if self.do_position_refinement:
                 kern.PCK = PositionCorrectionKernel(aux, nmodes, self.p.position_refinement, geo.resolution)
                 kern.PCK.allocate()
 
+            # buffers and buffered kernels for each thread
+            kern.threads = [u.Param(aux=aux, FUK=kern.FUK)]
+            for tid in range(1, self.p.num_threads):
+                taux = np.zeros(ash, dtype=np.complex64)
+                FUK = FourierUpdateKernel(taux, nmodes)
+                FUK.allocate()
+                kern.threads.append(u.Param(aux=taux, FUK=FUK))
+
+    def _work_units(self):
+        """
+        List of (dID, batch slice) pairs covering all diffraction data.
+        """
+        units = []
+        for dID in self.di.S.keys():
+            prep = self.diff_info[dID]
+            batch_size = self.kernels[prep.label].batch_size
+            units += [(dID, sl) for sl in batch_slices(prep.addr.shape[0], batch_size)]
+        return units
+
     def engine_prepare(self):
 
         super().engine_prepare()
@@ -207,20 +394,20 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
             prep.label = label
             self.diff_info[d.ID] = prep
-            prep.mag = np.sqrt(np.abs(d.data))
-            prep.ma = self.ma.S[d.ID].data.astype(np.float32)
-            # self.ma.S[d.ID].data = prep.ma
-            prep.ma_sum = prep.ma.sum(-1).sum(-1)
+            self._serialize_frames(prep, d)
             prep.err_phot = np.zeros_like(prep.ma_sum)
             prep.err_fourier = np.zeros_like(prep.ma_sum)
             prep.err_exit = np.zeros_like(prep.ma_sum)
 
-        # Unfortunately this needs to be done for all pods, since
-        # the shape of the probe / object was modified.
-        # TODO: possible scaling issue, remove the need for padding
+        self._release_data()
+
+        # Addresses need to be gathered for all pods, since the shape of
+        # the probe / object may have been modified. Only pods of new
+        # views are looked up.
         for label, d in self.di.storages.items():
             prep = self.diff_info[d.ID]
-            prep.view_IDs, prep.poe_IDs, prep.addr = serialize_array_access(d)
+            prep.view_IDs, prep.poe_IDs, prep.addr = serialize_array_access(
+                d, table=self.addr_tables.setdefault(d.ID, u.Param()))
             if self.do_position_refinement:
                 prep.original_addr = np.zeros_like(prep.addr)
                 prep.original_addr[:] = prep.addr
@@ -243,74 +430,15 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
             error = {}
 
-            for dID in self.di.S.keys():
+            # Fourier update, batch by batch
+            run_threaded(self._pool, self._fourier_update, self._work_units(), self.p.num_threads)
+            self._collect_benchmarks()
 
-                # find probe, object and exit ID in dependence of dID
+            for dID in self.di.S.keys():
                 prep = self.diff_info[dID]
-                pID, oID, eID = prep.poe_IDs
-
-                # references for kernels
-                kern = self.kernels[prep.label]
-                FUK = kern.FUK
-                AWK = kern.AWK
-                FW = kern.FW
-                BW = kern.BW
-
-                # get addresses and buffers
-                addr = prep.addr
-                mag = prep.mag
-                ma_sum = prep.ma_sum
-                err_phot = prep.err_phot
-                err_fourier = prep.err_fourier
-                err_exit = prep.err_exit
-                pbound = self.pbound_scan[prep.label]
-                aux = kern.aux
-
-                # local references
-                ma = prep.ma
-                ob = self.ob.S[oID].data
-                pr = self.pr.S[pID].data
-                ex = self.ex.S[eID].data
-
-                ## compute log-likelihood
-                if self.p.compute_log_likelihood:
-                    t1 = time.time()
-                    AWK.build_aux_no_ex(aux, addr, ob, pr)
-                    aux[:] = FW(aux)
-                    FUK.log_likelihood(aux, addr, mag, ma, err_phot)
-                    self.benchmark.F_LLerror += time.time() - t1
-
-                ## build auxilliary wave
-                t1 = time.time()
-                AWK.make_aux(aux, addr, ob, pr, ex, c_po=self._c, c_e=1-self._c)
-                self.benchmark.A_Build_aux += time.time() - t1
-
-                ## forward FFT
-                t1 = time.time()
-                aux[:] = FW(aux)
-                self.benchmark.B_Prop += time.time() - t1
-
-                ## Deviation from measured data
-                t1 = time.time()
-                FUK.fourier_error(aux, addr, mag, ma, ma_sum)
-                FUK.error_reduce(addr, err_fourier)
-                FUK.fmag_all_update(aux, addr, mag, ma, err_fourier, pbound)
-                self.benchmark.C_Fourier_update += time.time() - t1
-
-                ## backward FFT
-                t1 = time.time()
-                aux[:] = BW(aux)
-                self.benchmark.D_iProp += time.time() - t1
-
-                ## build exit wave
-                t1 = time.time()
-                AWK.make_exit(aux, addr, ob, pr, ex, c_a=self._b, c_po=self._a, c_e=-(self._a+self._b))
-                FUK.exit_error(aux,addr)
-                FUK.error_reduce(addr, err_exit)
-                self.benchmark.E_Build_exit += time.time() - t1
 
                 # update errors
-                errs = np.ascontiguousarray(np.vstack([err_fourier, err_phot, err_exit]).T)
+                errs = np.ascontiguousarray(np.vstack([prep.err_fourier, prep.err_phot, prep.err_exit]).T)
                 error.update(zip(prep.view_IDs, errs))
 
                 self.benchmark.calls_fourier += 1
@@ -329,9 +457,110 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
             self.curiter += 1
 
+        if self._sparse_allreduce():
+            for oID, ob in self.ob.storages.items():
+                parallel.sync_regions(ob.data, self._ob_region(oID))
+
         self.error = error
         return error
 
+    def _sparse_allreduce(self):
+        return (self.p.sparse_allreduce and parallel.size > 1
+                and self.p.obj_smooth_std is None)
+
+    def _ob_region(self, oID):
+        """
+        Bounding box (y0, y1, x0, x1) of the object `oID` accessed by the
+        views of this rank, including the position refinement search range.
+        """
+        ob = self.ob.S[oID].data
+        lo = np.array(ob.shape[-2:])
+        hi = np.zeros(2, dtype=int)
+        for prep in self.diff_info.values():
+            if prep.poe_IDs[1] != oID or prep.addr.size == 0:
+                continue
+            pad = 0
+            if self.do_position_refinement:
+                kern = self.kernels[prep.label]
+                pad = 2 * int(np.ceil(self.p.position_refinement.max_shift / kern.resolution))
+            frame = np.array(self.pr.S[prep.poe_IDs[0]].data.shape[-2:])
+            oblow = prep.addr[:, :, 1, 1:].reshape(-1, 2)
+            lo = np.minimum(lo, oblow.min(0) - pad)
+            hi = np.maximum(hi, oblow.max(0) + frame + pad)
+        lo = np.clip(lo, 0, ob.shape[-2:])
+        hi = np.clip(hi, lo, ob.shape[-2:])
+        return lo[0], hi[0], lo[1], hi[1]
+
+    def _fourier_update(self, tid, dID, sl):
+        """
+        Fourier constraint for the batch `sl` of diffraction storage `dID`,
+        using the buffers of thread `tid`.
+        """
+        # find probe, object and exit ID in dependence of dID
+        prep = self.diff_info[dID]
+        pID, oID, eID = prep.poe_IDs
+
+        # references for kernels
+        kern = self.kernels[prep.label]
+        FUK = kern.threads[tid].FUK
+        AWK = kern.AWK
+        FW = kern.FW
+        BW = kern.BW
+
+        # get addresses and buffers
+        addr = prep.addr[sl]
+        mag = prep.mag[sl]
+        ma_sum = prep.ma_sum[sl]
+        err_phot = prep.err_phot[sl]
+        err_fourier = prep.err_fourier[sl]
+        err_exit = prep.err_exit[sl]
+        pbound = self.pbound_scan[prep.label]
+        aux = kern.threads[tid].aux[:addr.shape[0] * addr.shape[1]]
+        bench = self._thread_benchmarks[tid]
+
+        # local references
+        ma = prep.ma[sl]
+        ob = self.ob.S[oID].data
+        pr = self.pr.S[pID].data
+        ex = self.ex.S[eID].data
+
+        ## compute log-likelihood
+        if self.p.compute_log_likelihood:
+            t1 = time.time()
+            AWK.build_aux_no_ex(aux, addr, ob, pr)
+            FW(aux)
+            FUK.log_likelihood(aux, addr, mag, ma, err_phot)
+            bench['F_LLerror'] += time.time() - t1
+
+        ## build auxilliary wave
+        t1 = time.time()
+        AWK.make_aux(aux, addr, ob, pr, ex, c_po=self._c, c_e=1-self._c)
+        bench['A_Build_aux'] += time.time() - t1
+
+        ## forward FFT
+        t1 = time.time()
+        FW(aux)
+        bench['B_Prop'] += time.time() - t1
+
+        ## Deviation from measured data
+        t1 = time.time()
+        FUK.fourier_error(aux, addr, mag, ma, ma_sum)
+        FUK.error_reduce(addr, err_fourier)
+        FUK.fmag_all_update(aux, addr, mag, ma, err_fourier, pbound)
+        bench['C_Fourier_update'] += time.time() - t1
+
+        ## backward FFT
+        t1 = time.time()
+        BW(aux)
+        bench['D_iProp'] += time.time() - t1
+
+        ## build exit wave
+        t1 = time.time()
+        AWK.make_exit(aux, addr, ob, pr, ex, c_a=self._b, c_po=self._a, c_e=-(self._a+self._b))
+        FUK.exit_error(aux, addr)
+        FUK.error_reduce(addr, err_exit)
+        bench['E_Build_exit'] += time.time() - t1
+
     def position_update(self):
         """
         Position refinement
@@ -351,7 +580,7 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
                 prep = self.diff_info[dID]
                 pID, oID, eID = prep.poe_IDs
-                ma = self.ma.S[dID].data
+                ma = prep.ma
                 ob = self.ob.S[oID].data
                 pr = self.pr.S[pID].data
                 kern = self.kernels[prep.label]
@@ -364,20 +593,14 @@ class _ProjectionEngine_serial(_ProjectionEngine):
                 err_fourier = prep.err_fourier
 
                 PCK = kern.PCK
-                FW = kern.FW
 
                 # Keep track of object boundaries
                 max_oby = ob.shape[-2] - aux.shape[-2] - 1
                 max_obx = ob.shape[-1] - aux.shape[-1] - 1
 
                 # We need to re-calculate the current error
-                PCK.build_aux(aux, addr, ob, pr)
-                aux[:] = FW(aux)
-                if self.p.position_refinement.metric == "fourier":
-                    PCK.fourier_error(aux, addr, mag, ma, ma_sum)
-                    PCK.error_reduce(addr, err_fourier)
-                if self.p.position_refinement.metric == "photon":
-                    PCK.log_likelihood(aux, addr, mag, ma, err_fourier)
+                for sl in batch_slices(addr.shape[0], kern.batch_size):
+                    self._position_error(kern, aux, addr[sl], ob, pr, mag[sl], ma[sl], ma_sum[sl], err_fourier[sl])
                 error_state = np.zeros_like(err_fourier)
                 error_state[:] = err_fourier
                 PCK.mangler.setup_shifts(self.curiter, nframes=addr.shape[0])
@@ -385,19 +608,28 @@ class _ProjectionEngine_serial(_ProjectionEngine):
                 log(4, 'Position refinement trial: iteration %s' % (self.curiter))
                 for i in range(PCK.mangler.nshifts):
                     PCK.mangler.get_address(i, addr, mangled_addr, max_oby, max_obx)
-                    PCK.build_aux(aux, mangled_addr, ob, pr)
-                    aux[:] = FW(aux)
-                    if self.p.position_refinement.metric == "fourier":
-                        PCK.fourier_error(aux, mangled_addr, mag, ma, ma_sum)
-                        PCK.error_reduce(mangled_addr, err_fourier)
-                    if self.p.position_refinement.metric == "photon":
-                        PCK.log_likelihood(aux, mangled_addr, mag, ma, err_fourier)
+                    for sl in batch_slices(addr.shape[0], kern.batch_size):
+                        self._position_error(kern, aux, mangled_addr[sl], ob, pr, mag[sl], ma[sl], ma_sum[sl], err_fourier[sl])
                     PCK.update_addr_and_error_state(addr, error_state, mangled_addr, err_fourier)
 
                 prep.err_fourier = error_state
                 prep.addr = addr
 
 
+    def _position_error(self, kern, aux, addr, ob, pr, mag, ma, ma_sum, err_fourier):
+        """
+        Error metric of the position refinement for one batch of views.
+        """
+        PCK = kern.PCK
+        aux = aux[:addr.shape[0] * addr.shape[1]]
+        PCK.build_aux(aux, addr, ob, pr)
+        kern.FW(aux)
+        if self.p.position_refinement.metric == "fourier":
+            PCK.fourier_error(aux, addr, mag, ma, ma_sum)
+            PCK.error_reduce(addr, err_fourier)
+        if self.p.position_refinement.metric == "photon":
+            PCK.log_likelihood(aux, addr, mag, ma, err_fourier)
+
     def overlap_update(self, MPI=True):
         """
         DM overlap constraint update.
@@ -443,8 +675,23 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
             obn.data[:] = cfact
 
-        # storage for-loop
-        for dID in self.di.S.keys():
+        # keep the inertia part to separate the updates of this rank
+        sparse = MPI and self._sparse_allreduce()
+        if sparse:
+            cfact_sum = parallel.allreduce(cfact)
+            regions = {oID: self._ob_region(oID) for oID in self.ob.storages.keys()}
+            bases = {oID: ob.data[..., y0:y1, x0:x1].copy()
+                     for oID, ob in self.ob.storages.items()
+                     for y0, y1, x0, x1 in [regions[oID]]}
+
+        # one accumulator per thread
+        nthreads = self.p.num_threads
+        obs = {oID: thread_buffers(self._thread_bufs, ('ob', oID), ob.data, nthreads)
+               for oID, ob in self.ob.storages.items()}
+        obns = {oID: thread_buffers(self._thread_bufs, ('obn', oID), obn.data, nthreads)
+                for oID, obn in self.ob_nrm.storages.items()}
+
+        def ob_update(tid, dID, sl):
             prep = self.diff_info[dID]
 
             POK = self.kernels[prep.label].POK
@@ -452,16 +699,36 @@ class _ProjectionEngine_serial(_ProjectionEngine):
             pID, oID, eID = prep.poe_IDs
 
             # scan for loop
-            ev = POK.ob_update(prep.addr,
-                               self.ob.S[oID].data,
-                               self.ob_nrm.S[oID].data,
-                               self.pr.S[pID].data,
-                               self.ex.S[eID].data)
+            POK.ob_update(prep.addr[sl],
+                          obs[oID][tid],
+                          obns[oID][tid],
+                          self.pr.S[pID].data,
+                          self.ex.S[eID].data)
+
+        # storage for-loop
+        run_threaded(self._pool, ob_update, self._work_units(), nthreads)
+
+        # reduce the thread accumulators
+        for oID in self.ob.storages.keys():
+            for ob, obn in zip(obs[oID][1:], obns[oID][1:]):
+                obs[oID][0] += ob
+                obns[oID][0] += obn
 
         for oID, ob in self.ob.storages.items():
             obn = self.ob_nrm.S[oID]
             # MPI test
-            if MPI:
+            if MPI and sparse:
+                # exchange only the updates, the inertia part is identical on all ranks
+                y0, y1, x0, x1 = region = regions[oID]
+                base = bases[oID]
+                ob.data[..., y0:y1, x0:x1] -= base
+                obn.data[..., y0:y1, x0:x1] -= cfact
+                parallel.allreduce_region(ob.data, region)
+                parallel.allreduce_region(obn.data, region)
+                ob.data[..., y0:y1, x0:x1] += base * (cfact_sum / cfact if cfact else 0.)
+                obn.data[..., y0:y1, x0:x1] += cfact_sum
+                ob.data /= obn.data
+            elif MPI:
                 parallel.allreduce(ob.data)
                 parallel.allreduce(obn.data)
                 ob.data /= obn.data
@@ -494,7 +761,14 @@ class _ProjectionEngine_serial(_ProjectionEngine):
             pr.data *= cfact
             prn.data.fill(cfact)
 
-        for dID in self.di.S.keys():
+        # one accumulator per thread
+        nthreads = self.p.num_threads
+        prs = {pID: thread_buffers(self._thread_bufs, ('pr', pID), pr.data, nthreads)
+               for pID, pr in self.pr.storages.items()}
+        prns = {pID: thread_buffers(self._thread_bufs, ('prn', pID), prn.data, nthreads)
+                for pID, prn in self.pr_nrm.storages.items()}
+
+        def pr_update(tid, dID, sl):
             prep = self.diff_info[dID]
 
             POK = self.kernels[prep.label].POK
@@ -502,14 +776,22 @@ class _ProjectionEngine_serial(_ProjectionEngine):
             pID, oID, eID = prep.poe_IDs
 
             # scan for-loop
-            ev = POK.pr_update(prep.addr,
-                               self.pr.S[pID].data,
-                               self.pr_nrm.S[pID].data,
-                               self.ob.S[oID].data,
-                               self.ex.S[eID].data)
+            POK.pr_update(prep.addr[sl],
+                          prs[pID][tid],
+                          prns[pID][tid],
+                          self.ob.S[oID].data,
+                          self.ex.S[eID].data)
+
+        run_threaded(self._pool, pr_update, self._work_units(), nthreads)
 
-            self.benchmark.probe_update += time.time() - t1
-            self.benchmark.calls_probe += 1
+        # reduce the thread accumulators
+        for pID in self.pr.storages.keys():
+            for pr, prn in zip(prs[pID][1:], prns[pID][1:]):
+                prs[pID][0] += pr
+                prns[pID][0] += prn
+
+        self.benchmark.probe_update += time.time() - t1
+        self.benchmark.calls_probe += 1
 
         for pID, pr in self.pr.storages.items():
 
@@ -558,6 +840,10 @@ class _ProjectionEngine_serial(_ProjectionEngine):
 
         self._reset_benchmarks()
 
+        if self._pool is not None:
+            self._pool.shutdown()
+            self._pool = None
+
         if self.do_position_refinement and self.p.position_refinement.record:
             for label, d in self.di.storages.items():
                 prep = self.diff_info[d.ID]
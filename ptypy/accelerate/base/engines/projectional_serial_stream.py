@@ -18,7 +18,7 @@ from ptypy import utils as u
 from ptypy.utils.verbose import logger, log
 from ptypy.utils import parallel
 from ptypy.engines import register
-from .projectional_serial import DM_serial
+from .projectional_serial import DM_serial, batch_slices
 
 ### TODOS 
 # 
@@ -105,7 +105,7 @@ class DM_serial_stream(DM_serial):
                     err_fourier = prep.err_fourier
 
                     # local references
-                    ma = self.ma.S[dID].data
+                    ma = prep.ma
                     ob = self.ob.S[oID].data
                     obn = self.ob_nrm.S[oID].data
                     obb = self.ob_buf.S[oID].data
@@ -115,30 +115,34 @@ class DM_serial_stream(DM_serial):
                     # Fourier update.
                     if do_update_fourier:
                         log(4, '----- Fourier update -----', True)
-                        t1 = time.time()
-                        AWK.make_aux(aux, addr, ob, pr, ex, c_po=self._c, c_e=1-self._c)
-                        self.benchmark.A_Build_aux += time.time() - t1
-
-                        ## FFT
-                        t1 = time.time()
-                        aux[:] = FW(aux)
-                        self.benchmark.B_Prop += time.time() - t1
-
-                        ## Deviation from measured data
-                        t1 = time.time()
-                        FUK.fourier_error(aux, addr, mag, ma, ma_sum)
-                        FUK.error_reduce(addr, err_fourier)
-                        FUK.fmag_all_update(aux, addr, mag, ma, err_fourier, pbound)
-                        self.benchmark.C_Fourier_update += time.time() - t1
-
-                        t1 = time.time()
-                        aux[:] = BW(aux)
-                        self.benchmark.D_iProp += time.time() - t1
-
-                        ## apply changes #2
-                        t1 = time.time()
-                        AWK.make_exit(aux, addr, ob, pr, ex, c_a=self._b, c_po=self._a, c_e=-(self._a+self._b))
-                        self.benchmark.E_Build_exit += time.time() - t1
+                        for sl in batch_slices(addr.shape[0], kern.batch_size):
+                            baddr = addr[sl]
+                            baux = aux[:baddr.shape[0] * baddr.shape[1]]
+
+                            t1 = time.time()
+                            AWK.make_aux(baux, baddr, ob, pr, ex, c_po=self._c, c_e=1-self._c)
+                            self.benchmark.A_Build_aux += time.time() - t1
+
+                            ## FFT
+                            t1 = time.time()
+                            FW(baux)
+                            self.benchmark.B_Prop += time.time() - t1
+
+                            ## Deviation from measured data
+                            t1 = time.time()
+                            FUK.fourier_error(baux, baddr, mag[sl], ma[sl], ma_sum[sl])
+                            FUK.error_reduce(baddr, err_fourier[sl])
+                            FUK.fmag_all_update(baux, baddr, mag[sl], ma[sl], err_fourier[sl], pbound)
+                            self.benchmark.C_Fourier_update += time.time() - t1
+
+                            t1 = time.time()
+                            BW(baux)
+                            self.benchmark.D_iProp += time.time() - t1
+
+                            ## apply changes #2
+                            t1 = time.time()
+                            AWK.make_exit(baux, baddr, ob, pr, ex, c_a=self._b, c_po=self._a, c_e=-(self._a+self._b))
+                            self.benchmark.E_Build_exit += time.time() - t1
 
                         err_phot = np.zeros_like(err_fourier)
                         err_exit = np.zeros_like(err_fourier)
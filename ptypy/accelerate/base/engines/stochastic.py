@@ -21,10 +21,64 @@ from ptypy.accelerate.base.engines import projectional_serial
 from ptypy.accelerate.base.kernels import FourierUpdateKernel, AuxiliaryWaveKernel, PoUpdateKernel, PositionCorrectionKernel
 from ptypy.accelerate.base import address_manglers
 from ptypy.accelerate.base import array_utils as au
+from ptypy.accelerate.base.compact import CompactDataMixin
 
 __all__ = ["EPIE_serial", "SDR_serial"]
 
-class _StochasticEngineSerial(_StochasticEngine):
+
+def schedule_batches(order, pos, shape, batch_size, overlap=False):
+    """
+    Group the views in `order` into batches of at most `batch_size` views.
+
+    Unless `overlap` is True, the object windows of the given `shape`
+    at the positions `pos` (one ``(row, column)`` pair per view) never
+    overlap within a batch. Each view goes to the first open batch
+    without a conflict. The windows of open batches are kept in a grid
+    of cells the size of a window, so only the neighbouring cells need
+    to be checked for conflicts.
+
+    Returns a list of index arrays in the order they should be processed.
+    """
+    order = np.asarray(order)
+    if overlap:
+        return [order[j:j + batch_size] for j in range(0, len(order), batch_size)]
+
+    rows, cols = (int(n) for n in shape)
+    cells = {}
+    batches = []
+    batch_cells = []
+    open_batches = []
+    for i, (y, x) in zip(order.tolist(), np.asarray(pos)[order].tolist()):
+        cy, cx = y // rows, x // cols
+        blocked = set()
+        for c in ((cy + dy, cx + dx) for dy in (-1, 0, 1) for dx in (-1, 0, 1)):
+            for b, windows in cells.get(c, {}).items():
+                if b in blocked:
+                    continue
+                for wy, wx in windows:
+                    if abs(wy - y) < rows and abs(wx - x) < cols:
+                        blocked.add(b)
+                        break
+        for b in open_batches:
+            if b not in blocked:
+                break
+        else:
+            b = len(batches)
+            batches.append([])
+            batch_cells.append(set())
+            open_batches.append(b)
+        batches[b].append(i)
+        cells.setdefault((cy, cx), {}).setdefault(b, []).append((y, x))
+        batch_cells[b].add((cy, cx))
+        # Full batches can not conflict anymore
+        if len(batches[b]) == batch_size:
+            open_batches.remove(b)
+            for c in batch_cells[b]:
+                del cells[c][b]
+    return [np.array(b, dtype=order.dtype) for b in batches]
+
+
+class _StochasticEngineSerial(_StochasticEngine, CompactDataMixin, projectional_serial.PoUpdateModeMixin):
     """
     A serialized base implementation of a stochastic algorithm for ptychography
 
@@ -40,6 +94,25 @@ class _StochasticEngineSerial(_StochasticEngine):
     type = bool
     help = A switch for computing the fourier error (this can impact the performance of the engine)
 
+    [batch_size]
+    default = 1
+    type = int
+    lowlim = 1
+    help = Number of views processed together in one update step
+    doc = With a batch size larger than 1, the views are grouped into mini-batches whose
+      exit waves are propagated with one batched FFT and whose object/probe updates are
+      applied together. The probe update of a batch is the average of the updates of its views.
+    userlevel = 2
+
+    [batch_overlap]
+    default = False
+    type = bool
+    help = Allow the views of a mini-batch to overlap on the object
+    doc = If False, a batch only contains views with disjoint object regions, so that its local
+      object updates are independent. If True, consecutive views of the shuffled order are
+      batched and the object updates of overlapping views are added up.
+    userlevel = 2
+
     """
 
     #SUPPORTED_MODELS = [Full, Vanilla, Bragg3dModel, BlockVanilla, BlockFull]
@@ -55,6 +128,7 @@ class _StochasticEngineSerial(_StochasticEngine):
 
         # Stores all information needed with respect to the diffraction storages.
         self.diff_info = {}
+        self.addr_tables = {}
         self.ob_cfact = {}
         self.pr_cfact = {}
         self.kernels = {}
@@ -112,16 +186,22 @@ class _StochasticEngineSerial(_StochasticEngine):
             kern.FUK = FourierUpdateKernel(aux, nmodes)
             kern.FUK.allocate()
 
-            kern.POK = PoUpdateKernel()
+            kern.POK = PoUpdateKernel(mode=self.p.po_update_mode)
             kern.POK.allocate()
 
             kern.AWK = AuxiliaryWaveKernel()
             kern.AWK.allocate()
 
-            kern.FW = geo.propagator.fw
-            kern.BW = geo.propagator.bw
+            kern.FW = geo.propagator.fw_inplace
+            kern.BW = geo.propagator.bw_inplace
             kern.resolution = geo.resolution[0]
 
+            # separate buffer and Fourier kernel for mini-batches
+            if self.p.batch_size > 1:
+                kern.baux = np.zeros((self.p.batch_size * nmodes,) + tuple(geo.shape), dtype=np.complex64)
+                kern.BFUK = FourierUpdateKernel(kern.baux, nmodes)
+                kern.BFUK.allocate()
+
             if self.do_position_refinement:
                 kern.PCK = PositionCorrectionKernel(aux, nmodes, self.p.position_refinement, geo.resolution)
                 kern.PCK.allocate()
@@ -145,19 +225,20 @@ class _StochasticEngineSerial(_StochasticEngine):
             prep = u.Param()
             prep.label = label
             self.diff_info[d.ID] = prep
-            prep.mag = np.sqrt(np.abs(d.data))
-            prep.ma = self.ma.S[d.ID].data.astype(np.float32)
-            prep.ma_sum = prep.ma.sum(-1).sum(-1)
+            self._serialize_frames(prep, d)
             prep.err_phot = np.zeros_like(prep.ma_sum)
             prep.err_fourier = np.zeros_like(prep.ma_sum)
             prep.err_exit = np.zeros_like(prep.ma_sum)
 
-        # Unfortunately this needs to be done for all pods, since
-        # the shape of the probe / object was modified.
-        # TODO: possible scaling issue, remove the need for padding
+        self._release_data()
+
+        # Addresses need to be gathered for all pods, since the shape of
+        # the probe / object may have been modified. Only pods of new
+        # views are looked up.
         for label, d in self.di.storages.items():
             prep = self.diff_info[d.ID]
-            prep.view_IDs, prep.poe_IDs, prep.addr = projectional_serial.serialize_array_access(d)
+            prep.view_IDs, prep.poe_IDs, prep.addr = projectional_serial.serialize_array_access(
+                d, table=self.addr_tables.setdefault(d.ID, u.Param()))
             if self.do_position_refinement:
                 prep.original_addr = np.zeros_like(prep.addr)
                 prep.original_addr[:] = prep.addr
@@ -167,6 +248,12 @@ class _StochasticEngineSerial(_StochasticEngine):
             prep.rng = np.random.default_rng()
             prep.vieworder = np.arange(prep.addr.shape[0])
 
+            # Mini-batches address the full exit wave storage
+            if self.p.batch_size > 1:
+                prep.addr_ex_batch = prep.addr[:,:,2].copy()
+                prep.obn_batch = np.zeros((self.p.batch_size,) + prep.mag.shape[-2:], dtype=np.float32)
+                prep.prn_batch = np.zeros_like(prep.obn_batch)
+
             # Modify addresses, copy pa into ea and remove da/ma
             prep.addr_ex = np.vstack([prep.addr[:,0,2,0], prep.addr[:,-1,2,0]+1]).T
             prep.addr[:,:,2] = prep.addr[:,:,0]
@@ -212,91 +299,31 @@ class _StochasticEngineSerial(_StochasticEngine):
                 vieworder = prep.vieworder
                 prep.rng.shuffle(vieworder)
 
-                # Iterate through views
-                for i in vieworder:
-
-                    # Get local adress and arrays
-                    addr = prep.addr[i,None]
-                    ex_from, ex_to = prep.addr_ex[i]
-                    ex = prep.ex[ex_from:ex_to]
-                    mag = prep.mag[i,None]
-                    ma = prep.ma[i,None]
-                    ma_sum = prep.ma_sum[i,None]
-                    obn = prep.obn
-                    prn = prep.prn
-                    err_phot = prep.err_phot[i,None]
-                    err_fourier = prep.err_fourier[i,None]
-                    err_exit = prep.err_exit[i,None]
-
-                    # position update
-                    self.position_update_local(prep,i)
-
-                    ## build auxilliary wave
-                    t1 = time.time()
-                    AWK.make_aux(aux, addr, ob, pr, ex, c_po=self._c, c_e=1-self._c)
-                    self.benchmark.A_Build_aux += time.time() - t1
-
-                    ## forward FFT
-                    t1 = time.time()
-                    aux[:] = FW(aux)
-                    self.benchmark.B_Prop += time.time() - t1
-
-                    ## Deviation from measured data
-                    t1 = time.time()
-                    if self.p.compute_fourier_error:
-                        FUK.fourier_error(aux, addr, mag, ma, ma_sum)
-                        FUK.error_reduce(addr, err_fourier)
-                    else:
-                        FUK.fourier_deviation(aux, addr, mag)
-                    FUK.fmag_update_nopbound(aux, addr, mag, ma)
-                    self.benchmark.C_Fourier_update += time.time() - t1
-
-                    ## backward FFT
-                    t1 = time.time()
-                    aux[:] = BW(aux)
-                    self.benchmark.D_iProp += time.time() - t1
-
-                    ## build exit wave
-                    t1 = time.time()
-                    AWK.make_exit(aux, addr, ob, pr, ex, c_a=self._b, c_po=self._a, c_e=-(self._a+self._b))
-                    if self.p.compute_exit_error:
-                        FUK.exit_error(aux,addr)
-                        FUK.error_reduce(addr, err_exit)
-                    self.benchmark.E_Build_exit += time.time() - t1
-                    self.benchmark.calls_fourier += 1
-
-                    ## build auxilliary wave (ob * pr product)
-                    t1 = time.time()
-                    AWK.build_aux_no_ex(aux, addr, ob, pr)
-                    self.benchmark.A_Build_aux += time.time() - t1
-
-                    # object update
-                    t1 = time.time()
-                    POK.pr_norm_local(addr, pr, prn)
-                    POK.ob_update_local(addr, ob, pr, ex, aux, prn, a=self._ob_a, b=self._ob_b)
-                    self.benchmark.object_update += time.time() - t1
-                    self.benchmark.calls_object += 1
-
-                    # probe update
-                    t1 = time.time()
-                    if self._object_norm_is_global and self._pr_a == 0:
-                        obn_max = au.max_abs2(ob)
-                        obn[:] = 0
-                    else:
-                        POK.ob_norm_local(addr, ob, obn)
-                        obn_max = obn.max()
-                    if self.p.probe_update_start <= self.curiter:
-                        POK.pr_update_local(addr, pr, ob, ex, aux, obn, obn_max, a=self._pr_a, b=self._pr_b)
-                    self.benchmark.probe_update += time.time() - t1
-                    self.benchmark.calls_probe += 1
-
-                    ## compute log-likelihood
-                    if self.p.compute_log_likelihood:
-                        t1 = time.time()
-                        aux[:] = FW(aux)
-                        FUK.log_likelihood(aux, addr, mag, ma, err_phot)
-                        self.benchmark.F_LLerror += time.time() - t1
+                if self.p.batch_size > 1:
+                    self._iterate_batches(prep, kern, ob, pr)
+                else:
+
+                    # Iterate through views
+                    for i in vieworder:
+
+                        # Get local adress and arrays
+                        addr = prep.addr[i,None]
+                        ex_from, ex_to = prep.addr_ex[i]
+                        ex = prep.ex[ex_from:ex_to]
+                        mag = prep.mag[i,None]
+                        ma = prep.ma[i,None]
+                        ma_sum = prep.ma_sum[i,None]
+                        obn = prep.obn
+                        prn = prep.prn
+                        err_phot = prep.err_phot[i,None]
+                        err_fourier = prep.err_fourier[i,None]
+                        err_exit = prep.err_exit[i,None]
 
+                        # position update
+                        self.position_update_local(prep,i)
+
+                        self._update(FUK, AWK, POK, FW, BW, addr, ob, pr, ex, aux,
+                                     mag, ma, ma_sum, obn, prn, err_phot, err_fourier, err_exit)
 
                 # update errors
                 errs = np.ascontiguousarray(np.vstack([np.hstack(prep.err_fourier),
@@ -312,6 +339,131 @@ class _StochasticEngineSerial(_StochasticEngine):
         #error = parallel.gather_dict(error_dct)
         return error_dct
 
+    def _iterate_batches(self, prep, kern, ob, pr):
+        """
+        Update object and probe with mini-batches of views, in the
+        shuffled view order of `prep`.
+        """
+        FUK = kern.BFUK
+        AWK = kern.AWK
+        POK = kern.POK
+        FW = kern.FW
+        BW = kern.BW
+        nmodes = prep.addr.shape[1]
+        ex = prep.ex
+        obn = prep.obn_batch
+        prn = prep.prn_batch
+
+        # Position refinement may move views by up to max_shift,
+        # which is accounted for when looking for conflicts
+        shape = np.array(kern.aux.shape[-2:])
+        if self.do_position_refinement:
+            shape += 2 * int(np.ceil(self.p.position_refinement.max_shift / kern.resolution))
+        batches = schedule_batches(prep.vieworder, prep.addr[:,0,1,1:], shape,
+                                   self.p.batch_size, overlap=self.p.batch_overlap)
+
+        for idx in batches:
+            nviews = len(idx)
+
+            # position update
+            for i in idx:
+                self.position_update_local(prep, i)
+
+            # Get batch addresses and arrays, the exit wave is addressed
+            # in its storage and the norms have one layer per view
+            addr = prep.addr[idx]
+            addr[:,:,2] = prep.addr_ex_batch[idx]
+            addr[:,:,4,0] = np.arange(nviews)[:,None]
+            aux = kern.baux[:nviews * nmodes]
+            mag = prep.mag[idx]
+            ma = prep.ma[idx]
+            ma_sum = prep.ma_sum[idx]
+            err_phot = prep.err_phot[idx]
+            err_fourier = prep.err_fourier[idx]
+            err_exit = prep.err_exit[idx]
+
+            self._update(FUK, AWK, POK, FW, BW, addr, ob, pr, ex, aux,
+                         mag, ma, ma_sum, obn, prn, err_phot, err_fourier, err_exit, nviews)
+
+            prep.err_phot[idx] = err_phot
+            prep.err_fourier[idx] = err_fourier
+            prep.err_exit[idx] = err_exit
+
+    def _update(self, FUK, AWK, POK, FW, BW, addr, ob, pr, ex, aux,
+                mag, ma, ma_sum, obn, prn, err_phot, err_fourier, err_exit, nviews=1):
+        """
+        Fourier, object and probe update for the views in `addr`, a
+        single view or a batch of `nviews` non-overlapping views.
+        """
+        ## build auxilliary wave
+        t1 = time.time()
+        AWK.make_aux(aux, addr, ob, pr, ex, c_po=self._c, c_e=1-self._c)
+        self.benchmark.A_Build_aux += time.time() - t1
+
+        ## forward FFT
+        t1 = time.time()
+        FW(aux)
+        self.benchmark.B_Prop += time.time() - t1
+
+        ## Deviation from measured data
+        t1 = time.time()
+        if self.p.compute_fourier_error:
+            FUK.fourier_error(aux, addr, mag, ma, ma_sum)
+            FUK.error_reduce(addr, err_fourier)
+        else:
+            FUK.fourier_deviation(aux, addr, mag)
+        FUK.fmag_update_nopbound(aux, addr, mag, ma)
+        self.benchmark.C_Fourier_update += time.time() - t1
+
+        ## backward FFT
+        t1 = time.time()
+        BW(aux)
+        self.benchmark.D_iProp += time.time() - t1
+
+        ## build exit wave
+        t1 = time.time()
+        AWK.make_exit(aux, addr, ob, pr, ex, c_a=self._b, c_po=self._a, c_e=-(self._a+self._b))
+        if self.p.compute_exit_error:
+            FUK.exit_error(aux,addr)
+            FUK.error_reduce(addr, err_exit)
+        self.benchmark.E_Build_exit += time.time() - t1
+        self.benchmark.calls_fourier += 1
+
+        ## build auxilliary wave (ob * pr product)
+        t1 = time.time()
+        AWK.build_aux_no_ex(aux, addr, ob, pr)
+        self.benchmark.A_Build_aux += time.time() - t1
+
+        # object update
+        t1 = time.time()
+        POK.pr_norm_local(addr, pr, prn)
+        POK.ob_update_local(addr, ob, pr, ex, aux, prn, a=self._ob_a, b=self._ob_b)
+        self.benchmark.object_update += time.time() - t1
+        self.benchmark.calls_object += 1
+
+        # probe update, averaged over a batch
+        t1 = time.time()
+        if self._object_norm_is_global and self._pr_a == 0:
+            obn_max = au.max_abs2(ob)
+            obn[:] = 0
+        else:
+            POK.ob_norm_local(addr, ob, obn)
+            obn_max = obn.max()
+        if self.p.probe_update_start <= self.curiter:
+            pr_old = pr.copy() if nviews > 1 else None
+            POK.pr_update_local(addr, pr, ob, ex, aux, obn, obn_max, a=self._pr_a, b=self._pr_b)
+            if nviews > 1:
+                pr[:] = pr_old + (pr - pr_old) / nviews
+        self.benchmark.probe_update += time.time() - t1
+        self.benchmark.calls_probe += 1
+
+        ## compute log-likelihood
+        if self.p.compute_log_likelihood:
+            t1 = time.time()
+            FW(aux)
+            FUK.log_likelihood(aux, addr, mag, ma, err_phot)
+            self.benchmark.F_LLerror += time.time() - t1
+
     def position_update_local(self, prep, i):
         """
         Position refinement update for current view.
@@ -349,7 +501,7 @@ class _StochasticEngineSerial(_StochasticEngine):
 
             # We first need to calculate the current error
             PCK.build_aux(aux, addr, ob, pr)
-            aux[:] = FW(aux)
+            FW(aux)
             if self.p.position_refinement.metric == "fourier":
                 PCK.fourier_error(aux, addr, mag, ma, ma_sum)
                 PCK.error_reduce(addr, err_fourier)
@@ -363,7 +515,7 @@ class _StochasticEngineSerial(_StochasticEngine):
             for i in range(PCK.mangler.nshifts):
                 PCK.mangler.get_address(i, addr, mangled_addr, max_oby, max_obx)
                 PCK.build_aux(aux, mangled_addr, ob, pr)
-                aux[:] = FW(aux)
+                FW(aux)
                 if self.p.position_refinement.metric == "fourier":
                     PCK.fourier_error(aux, mangled_addr, mag, ma, ma_sum)
                     PCK.error_reduce(mangled_addr, err_fourier)
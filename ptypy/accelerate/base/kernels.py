@@ -1,4 +1,5 @@
 import numpy as np
+from numpy.lib.stride_tricks import sliding_window_view
 from ptypy.utils.verbose import logger, log
 from .array_utils import max_abs2, abs2
 
@@ -545,11 +546,48 @@ class AuxiliaryWaveKernel(BaseKernel):
                 aux[ind, :, :] = tmp
         return
 
+def gather_windows(arr, addr, rows, cols):
+    """
+    Stack the ``(rows, cols)`` windows of `arr` addressed by the
+    ``(layer, row, column)`` triplets in `addr` into one array,
+    without a Python-level loop.
+    """
+    if arr.shape[-2:] == (rows, cols):
+        layers = addr[:, 0]
+        # consecutive layers, e.g. the exit waves of a block, are a view
+        if len(layers) and np.all(np.diff(layers) == 1):
+            return arr[layers[0]:layers[-1] + 1]
+        return arr[layers]
+    windows = sliding_window_view(arr, (rows, cols), axis=(-2, -1))
+    return windows[addr[:, 0], addr[:, 1], addr[:, 2]]
+
+
+def scatter_add(arr, addr, values):
+    """
+    Add each frame in `values` to the window of `arr` addressed by the
+    corresponding ``(layer, row, column)`` triplet in `addr`.
+    Contributions are accumulated in the order of `addr`.
+    """
+    rows, cols = values.shape[-2:]
+    for (l, y, x), v in zip(addr.tolist(), values):
+        arr[l, y:y + rows, x:x + cols] += v
+
+
 class PoUpdateKernel(BaseKernel):
 
-    def __init__(self):
+    MODES = ['loop', 'batched']
+
+    def __init__(self, mode='loop'):
 
         super(PoUpdateKernel, self).__init__()
+        if mode not in self.MODES:
+            raise ValueError("Unknown PoUpdateKernel mode '%s', choose from %s" % (mode, self.MODES))
+        self.mode = mode
+        # size of a block of frames processed at once in batched mode
+        self.block_bytes = 2 ** 19
+        # in batched mode, single views and frames with at least this many
+        # pixels are updated view by view, batching no longer pays off there
+        self.batch_max_pixels = 64 * 64
         self.kernels = [
             'pr_update',
             'ob_update',
@@ -558,8 +596,28 @@ class PoUpdateKernel(BaseKernel):
     def allocate(self):
         pass
 
+    def _batched(self, addr, frame_shape):
+        """
+        Whether the views in `addr` with frames of `frame_shape` are
+        updated in batched mode.
+        """
+        return (self.mode == 'batched' and addr.shape[0] * addr.shape[1] > 1
+                and frame_shape[-2] * frame_shape[-1] < self.batch_max_pixels)
+
+    def _blocks(self, flat_addr, frame_shape):
+        """
+        Split the flattened address array into blocks whose stacked
+        frames fit into `block_bytes` (assuming complex64).
+        """
+        nframes = max(1, self.block_bytes // (8 * int(np.prod(frame_shape))))
+        for start in range(0, flat_addr.shape[0], nframes):
+            yield start, flat_addr[start:start + nframes]
+
     def ob_update(self, addr, ob, obn, pr, ex):
 
+        if self._batched(addr, ex.shape):
+            return self._ob_update_batched(addr, ob, obn, pr, ex)
+
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -574,6 +632,9 @@ class PoUpdateKernel(BaseKernel):
 
     def pr_update(self, addr, pr, prn, ob, ex):
 
+        if self._batched(addr, ex.shape):
+            return self._pr_update_batched(addr, pr, prn, ob, ex)
+
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -588,6 +649,9 @@ class PoUpdateKernel(BaseKernel):
 
     def ob_update_ML(self, addr, ob, pr, ex, fac=2.0):
 
+        if self._batched(addr, ex.shape):
+            return self._ob_update_ML_batched(addr, ob, pr, ex, fac)
+
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -599,6 +663,9 @@ class PoUpdateKernel(BaseKernel):
 
     def pr_update_ML(self, addr, pr, ob, ex, fac=2.0):
 
+        if self._batched(addr, ex.shape):
+            return self._pr_update_ML_batched(addr, pr, ob, ex, fac)
+
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -609,6 +676,9 @@ class PoUpdateKernel(BaseKernel):
         return
 
     def ob_update_local(self, addr, ob, pr, ex, aux, prn, a=0., b=1.):
+
+        if self._batched(addr, ex.shape):
+            return self._ob_update_local_batched(addr, ob, pr, ex, aux, prn, a, b)
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -621,6 +691,9 @@ class PoUpdateKernel(BaseKernel):
         return
 
     def pr_update_local(self, addr, pr, ob, ex, aux, obn, obn_max, a=0., b=1.):
+
+        if self._batched(addr, ex.shape):
+            return self._pr_update_local_batched(addr, pr, ob, ex, aux, obn, obn_max, a, b)
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -633,6 +706,9 @@ class PoUpdateKernel(BaseKernel):
         return
 
     def ob_norm_local(self, addr, ob, obn):
+
+        if self._batched(addr, obn.shape):
+            return self._ob_norm_local_batched(addr, ob, obn)
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = obn.shape[-2:]
@@ -647,6 +723,9 @@ class PoUpdateKernel(BaseKernel):
         return
 
     def pr_norm_local(self, addr, pr, prn):
+
+        if self._batched(addr, prn.shape):
+            return self._pr_norm_local_batched(addr, pr, prn)
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = prn.shape[-2:]
@@ -661,6 +740,9 @@ class PoUpdateKernel(BaseKernel):
         return
 
     def ob_update_wasp(self, addr, ob, pr, ex, aux, ob_sum_nmr, ob_sum_dnm, alpha=1):
+
+        if self._batched(addr, ex.shape):
+            return self._ob_update_wasp_batched(addr, ob, pr, ex, aux, ob_sum_nmr, ob_sum_dnm, alpha)
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -676,6 +758,9 @@ class PoUpdateKernel(BaseKernel):
             ob_sum_dnm[obc[0], obc[1]:obc[1] + rows, obc[2]:obc[2] + cols] += pr_abs2
 
     def pr_update_wasp(self, addr, pr, ob, ex, aux, pr_sum_nmr, pr_sum_dnm, beta=1):
+
+        if self._batched(addr, ex.shape):
+            return self._pr_update_wasp_batched(addr, pr, ob, ex, aux, pr_sum_nmr, pr_sum_dnm, beta)
         sh = addr.shape
         flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
         rows, cols = ex.shape[-2:]
@@ -694,6 +779,132 @@ class PoUpdateKernel(BaseKernel):
         is_zero = np.isclose(dnm, 0)
         arr[:] = np.where(is_zero, nmr, nmr / dnm)
 
+    ## Batched variants ##
+    # Frames are processed in blocks: all arithmetic is done on stacks of
+    # windows and quantities that only depend on the probe (object) mode
+    # are computed once per call rather than once per view. The remaining
+    # per-view work is a single in-place slice addition, accumulated in
+    # the same order as the loop, which gives identical results.
+
+    def _ob_update_batched(self, addr, ob, obn, pr, ex):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        pr_conj = pr.conj()
+        pr_abs2 = (pr_conj * pr).real
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc = fa[:, 0], fa[:, 1], fa[:, 2]
+            scatter_add(ob, obc, gather_windows(pr_conj, prc, rows, cols) *
+                        gather_windows(ex, exc, rows, cols))
+            scatter_add(obn, obc, gather_windows(pr_abs2, prc, rows, cols))
+
+    def _pr_update_batched(self, addr, pr, prn, ob, ex):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc = fa[:, 0], fa[:, 1], fa[:, 2]
+            obw = gather_windows(ob, obc, rows, cols)
+            scatter_add(pr, prc, obw.conj() * gather_windows(ex, exc, rows, cols))
+            scatter_add(prn, prc, (obw.conj() * obw).real)
+
+    def _ob_update_ML_batched(self, addr, ob, pr, ex, fac):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        pr_conj = pr.conj()
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc = fa[:, 0], fa[:, 1], fa[:, 2]
+            scatter_add(ob, obc, gather_windows(pr_conj, prc, rows, cols) *
+                        gather_windows(ex, exc, rows, cols) * fac)
+
+    def _pr_update_ML_batched(self, addr, pr, ob, ex, fac):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc = fa[:, 0], fa[:, 1], fa[:, 2]
+            scatter_add(pr, prc, gather_windows(ob, obc, rows, cols).conj() *
+                        gather_windows(ex, exc, rows, cols) * fac)
+
+    def _ob_update_local_batched(self, addr, ob, pr, ex, aux, prn, a, b):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        pr_conj = pr.conj()
+        pr_norm = (1 - a) * prn.max() + a * prn
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc, dic = fa[:, 0], fa[:, 1], fa[:, 2], fa[:, 4]
+            scatter_add(ob, obc, (a + b) * gather_windows(pr_conj, prc, rows, cols) *
+                        (gather_windows(ex, exc, rows, cols) - aux[start:start + fa.shape[0]]) /
+                        gather_windows(pr_norm, dic, rows, cols))
+
+    def _pr_update_local_batched(self, addr, pr, ob, ex, aux, obn, obn_max, a, b):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        ob_norm = (1 - a) * obn_max + a * obn
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc, dic = fa[:, 0], fa[:, 1], fa[:, 2], fa[:, 4]
+            scatter_add(pr, prc, (a + b) * gather_windows(ob, obc, rows, cols).conj() *
+                        (gather_windows(ex, exc, rows, cols) - aux[start:start + fa.shape[0]]) /
+                        gather_windows(ob_norm, dic, rows, cols))
+
+    def _ob_norm_local_batched(self, addr, ob, obn):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        # each object mode should only be counted once
+        flat_addr = flat_addr[flat_addr[:, 0, 0] == 0]
+        rows, cols = obn.shape[-2:]
+        obn[:] = 0.
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            obw = gather_windows(ob, fa[:, 1], rows, cols)
+            scatter_add(obn, fa[:, 4], (obw.conj() * obw).real)
+
+    def _pr_norm_local_batched(self, addr, pr, prn):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        # each probe mode should only be counted once
+        flat_addr = flat_addr[flat_addr[:, 1, 0] == 0]
+        rows, cols = prn.shape[-2:]
+        prn[:] = 0.
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prw = gather_windows(pr, fa[:, 0], rows, cols)
+            scatter_add(prn, fa[:, 4], (prw.conj() * prw).real)
+
+    def _ob_update_wasp_batched(self, addr, ob, pr, ex, aux, ob_sum_nmr, ob_sum_dnm, alpha):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc = fa[:, 0], fa[:, 1], fa[:, 2]
+            prw = gather_windows(pr, prc, rows, cols)
+            pr_conj = prw.conj()
+            pr_abs2 = abs2(prw)
+            exw = gather_windows(ex, exc, rows, cols)
+            deltaEW = exw - aux[start:start + fa.shape[0]]
+            pr_mean = pr_abs2.mean(axis=(-2, -1), keepdims=True)
+
+            scatter_add(ob, obc, 0.5 * pr_conj * deltaEW / (pr_mean * alpha + pr_abs2))
+            scatter_add(ob_sum_nmr, obc, pr_conj * exw)
+            scatter_add(ob_sum_dnm, obc, pr_abs2)
+
+    def _pr_update_wasp_batched(self, addr, pr, ob, ex, aux, pr_sum_nmr, pr_sum_dnm, beta):
+        sh = addr.shape
+        flat_addr = addr.reshape(sh[0] * sh[1], sh[2], sh[3])
+        rows, cols = ex.shape[-2:]
+        for start, fa in self._blocks(flat_addr, (rows, cols)):
+            prc, obc, exc = fa[:, 0], fa[:, 1], fa[:, 2]
+            obw = gather_windows(ob, obc, rows, cols)
+            ob_conj = obw.conj()
+            ob_abs2 = abs2(obw)
+            exw = gather_windows(ex, exc, rows, cols)
+            deltaEW = exw - aux[start:start + fa.shape[0]]
+
+            scatter_add(pr, prc, ob_conj * deltaEW / (beta + ob_abs2))
+            scatter_add(pr_sum_nmr, prc, ob_conj * exw)
+            scatter_add(pr_sum_dnm, prc, ob_abs2)
+
 
 class PositionCorrectionKernel(BaseKernel):
     from ptypy.accelerate.base import address_manglers
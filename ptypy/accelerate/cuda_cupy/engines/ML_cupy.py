@@ -74,6 +74,11 @@ class ML_cupy(ML_serial):
         """
         Prepare for ML reconstruction.
         """
+        if self.p.optimizer != 'cg':
+            raise NotImplementedError("Only the 'cg' optimizer is available on the GPU")
+        if self.p.minibatch_fraction < 1.:
+            raise NotImplementedError("Mini-batches are not available on the GPU")
+
         self.queue = get_context(new_queue=True)
 
         self.qu_htod = cp.cuda.Stream()
@@ -67,6 +67,9 @@ class _ProjectionEngine_cupy(projectional_serial._ProjectionEngine_serial):
         """
         Prepare for reconstruction.
         """
+        if self.p.compact_data or self.p.release_data:
+            raise NotImplementedError("Compact and released frames are not available on the GPU")
+
         # Context, Multi GPU communicator and Stream (needs to be in this order)
         self.queue = get_context(new_queue=False)
         self.multigpu = get_multi_gpu_communicator()
@@ -69,6 +69,9 @@ class _StochasticEngineCupy(_StochasticEngineSerial):
         """
         Prepare for reconstruction.
         """
+        if self.p.compact_data or self.p.release_data:
+            raise NotImplementedError("Compact and released frames are not available on the GPU")
+
         self.queue = get_context(new_queue=True)
 
         # initialise kernels for centring probe if required
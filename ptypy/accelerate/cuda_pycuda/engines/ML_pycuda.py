@@ -78,6 +78,11 @@ class ML_pycuda(ML_serial):
         """
         Prepare for ML reconstruction.
         """
+        if self.p.optimizer != 'cg':
+            raise NotImplementedError("Only the 'cg' optimizer is available on the GPU")
+        if self.p.minibatch_fraction < 1.:
+            raise NotImplementedError("Mini-batches are not available on the GPU")
+
         self.context, self.queue = get_context(new_queue=True)
 
         if self.p.use_cuda_device_memory_pool:
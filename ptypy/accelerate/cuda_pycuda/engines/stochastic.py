@@ -68,6 +68,9 @@ class _StochasticEnginePycuda(_StochasticEngineSerial):
         """
         Prepare for reconstruction.
         """
+        if self.p.compact_data or self.p.release_data:
+            raise NotImplementedError("Compact and released frames are not available on the GPU")
+
         self.context, self.queue = get_context(new_queue=True)
 
         # initialise kernels for centring probe if required
@@ -0,0 +1,27 @@
+#!/usr/bin/env python3
+
+from ptypy.utils import profiling
+import argparse
+
+def ptypy_profile():
+    opt = parse()
+    profile(opt)
+
+def parse():
+    parser = argparse.ArgumentParser(description='Shows a summary of a profile file written with io.profile')
+    parser.add_argument('profile', type=str, help='path to the profile file (.jsonl)')
+    parser.add_argument('-i', '--iterations', dest='per_iteration', action='store_true',
+                        help='also list the timings and counters of every iteration')
+    parser.add_argument('-e', '--engine', dest='engine', type=str, default=None,
+                        help='only show records of engines with this name')
+    args = parser.parse_args()
+    return args
+
+def profile(args):
+    records = profiling.read_profile(args.profile)
+    if args.engine is not None:
+        records = [r for r in records if r.get('engine') == args.engine]
+    print(profiling.summarize(records, per_iteration=args.per_iteration))
+
+if __name__ == "__main__":
+    ptypy_profile()
@@ -179,9 +179,17 @@ class Base(object):
         recs = self._recs[prefix]
         l = len(recs)
         if idx >= l:
+            # Geometric growth keeps re-pointing the records amortized linear
             nl = l + 8192 if idx > 10000 else 2*l
-            recs = np.resize(recs,(nl,))
+            nl = max(nl, l + l // 2)
+            grown = np.zeros((nl,), dtype=recs.dtype)
+            grown[:l] = recs
+            recs = grown
             self._recs[prefix] = recs
+            # Records are views into the table, point them to the new one
+            for o in d.values():
+                if o is not obj and o.numID is not None and o.numID < l:
+                    o._record = recs[o.numID]
         rec = recs[idx] 
         obj._record = rec
         rec['ID'] = nID
@@ -455,6 +463,9 @@ class Storage(Base):
         # MPI flag: is the storage distributed across nodes or are all nodes holding the same copy?
         self._is_scattered = container._is_scattered
 
+        # Field of view and layers cached by reformat(incremental=True)
+        self._fov_cache = None
+
         # Instance attributes
         # self._psize = None
         # SC: defining _psize here leads to failure of the code,
@@ -468,6 +479,58 @@ class Storage(Base):
         """
         return len(self.shape[1:])
 
+    @property
+    def layermap(self):
+        """
+        List mapping the layers of the views to the first axis of the
+        internal buffer.
+        """
+        return self._layermap
+
+    @layermap.setter
+    def layermap(self, v):
+        self._layermap = v
+        # Dict index of the layer slots, kept in sync with the layermap
+        self._layer_slots = dict((l, i) for i, l in enumerate(v))
+
+    def layer_slot(self, layer):
+        """
+        Return the index in the internal buffer of `layer`, or None if
+        `layer` is not in the layermap.
+        """
+        return self._layer_slots.get(layer)
+
+    def put_layers(self, layers, frames):
+        """
+        Copy `frames` into the buffer at the slots of `layers`.
+
+        Parameters
+        ----------
+        layers : list of int
+            Layers present in the layermap
+        frames : list of ndarray or ndarray
+            The frames, one per layer
+        """
+        slots = np.array([self._layer_slots[l] for l in layers], dtype=int)
+        if len(slots) == 0:
+            return
+        if (np.diff(slots) == 1).all():
+            # Contiguous layers, copy straight into the buffer
+            np.stack(frames, out=self.data[slots[0]:slots[-1] + 1])
+        else:
+            self.data[slots] = np.stack(frames)
+
+    def _to_dict(self):
+        res = super(Storage, self)._to_dict()
+        res['layermap'] = res.pop('_layermap')
+        res.pop('_layer_slots', None)
+        res.pop('_fov_cache', None)
+        return res
+
+    def _post_dict_import(self):
+        if 'layermap' in self.__dict__:
+            self.layermap = self.__dict__.pop('layermap')
+
     @property
     def dtype(self):
         return self.owner.dtype if self.owner is not None else None
@@ -568,8 +631,7 @@ class Storage(Base):
             the view is actually on self. Use cautiously.
         """
         if v is None:
-            for v in self.views:
-                self.update_views(v)
+            self._update_view_rows()
             return
 
         if not self.ndim == v.ndim:
@@ -597,7 +659,35 @@ class Storage(Base):
         # else:
         #     v.slayer = self.layermap.index(v.layer)
 
-    def reformat(self, newID=None, update=True):
+    def _update_view_rows(self, rows=None):
+        """
+        Vectorized :py:meth:`update_views` for the views at `rows` of the
+        owner's view table (all active views of this storage if None).
+        """
+        if self.owner is None:
+            return
+        recs = self.owner.view_records
+        if rows is None:
+            rows = self.owner.view_rows(self)
+        if len(rows) == 0:
+            return
+        nd = self.ndim
+        shape = recs['shape'][rows]
+        if (shape[:, nd:] != 0).any():
+            raise ValueError(
+                'Storage %s(ndim=%d) and some of its views have conflicting '
+                'data dimensions' % (self.ID, nd))
+        shape = shape[:, :nd]
+
+        recs['psize'][rows, :nd] = self.psize
+        pcoord = self._to_pix(recs['coord'][rows, :nd])
+        dcoord = np.round(pcoord + 0.00001).astype(int)
+        recs['dcoord'][rows, :nd] = dcoord
+        recs['dlow'][rows, :nd] = dcoord - shape // 2
+        recs['dhigh'][rows, :nd] = dcoord + (shape + 1) // 2
+        recs['sp'][rows, :nd] = pcoord - dcoord
+
+    def reformat(self, newID=None, update=True, incremental=False):
         """
         Crop or pad if required.
 
@@ -612,6 +702,14 @@ class Storage(Base):
             needed, if Views have been recently instantiated. Roughly doubles 
             execution time.
 
+        incremental : bool
+            If True, only the views added since the last reformat of this
+            storage are updated and reduced into the field of view, the
+            others are accounted for by the bounds cached in that call.
+            Falls back to a full reformat if views of this storage have been
+            (de)activated in the meantime. Views that changed coordinates
+            are not detected, use it only where views are appended.
+
         Returns
         -------
         s : Storage
@@ -624,50 +722,63 @@ class Storage(Base):
             s.reformat()
             return s
 
+        # Active views on this storage as rows of the container's view table
+        recs = self.owner.view_records
+        rows = self.owner.view_rows(self)
+
+        # Views already accounted for in the last reformat
+        cache = getattr(self, '_fov_cache', None) if incremental else None
+        if cache is not None:
+            nseen = cache['nrows']
+            split = np.searchsorted(rows, nseen)
+            if np.array_equal(rows[:split], cache['rows']):
+                new_rows = rows[split:]
+            else:
+                cache = None
+
         # Make sure all views are up to date
         # This call takes roughly half the time of .reformat()
-        if update:
-            self.update()
-
-        # List of views on this storage
-        views = self.views
-
-        logger.debug('%s[%s] :: %d views for this storage'
-                     % (self.owner.ID, self.ID, len(views)))
-
-        sh = self.data.shape
-
-        # Loop through all active views to get individual boundaries
-        dlow_fov = [np.inf] * self.ndim
-        dhigh_fov = [-np.inf] * self.ndim
-        layers = []
+        if cache is None:
+            new_rows = rows
+            if update:
+                self.update()
+        elif update and self.owner.original is self.owner:
+            self._update_view_rows(new_rows)
+
+        logger.debug('%s[%s] :: %d views for this storage (%d new)'
+                     % (self.owner.ID, self.ID, len(rows), len(new_rows)))
+
+        # Reduce the regions of interest of the views to the full field
+        # of view and gather the (unique) list of layers
         dims = list(range(self.ndim))
-        for v in views:
-            if not v.active:
-                continue
-
-            # Accumulate the regions of interest to
-            # compute the full field of view
-            for d in dims:
-                dlow_fov[d] = min(dlow_fov[d], v.dlow[d])
-                dhigh_fov[d] = max(dhigh_fov[d], v.dhigh[d])
-                
-            # Gather a (unique) list of layers
-            if v.layer not in layers:
-                layers.append(v.layer)
+        dlow_fov = np.full((self.ndim,), np.inf)
+        dhigh_fov = np.full((self.ndim,), -np.inf)
+        if len(new_rows) > 0:
+            dlow_fov[:] = recs['dlow'][new_rows, :self.ndim].min(axis=0)
+            dhigh_fov[:] = recs['dhigh'][new_rows, :self.ndim].max(axis=0)
+        layers = np.unique(recs['layer'][new_rows])
+        if cache is not None:
+            dlow_fov = np.minimum(dlow_fov, cache['dlow'])
+            dhigh_fov = np.maximum(dhigh_fov, cache['dhigh'])
+            layers = np.union1d(cache['layers'], layers)
 
         # Check if storage is scattered
         # A storage is "scattered" if and only if layer maps are different across nodes.
-        new_layermap = sorted(layers)
+        new_layermap = layers.tolist()
 
         # Update boundaries
         if not self._is_scattered and u.parallel.MPIenabled:
-            dlow_fov[:]  = u.parallel.comm.allreduce(dlow_fov,  u.parallel.MPI.MIN)
-            dhigh_fov[:] = u.parallel.comm.allreduce(dhigh_fov, u.parallel.MPI.MAX)
+            u.parallel.comm.Allreduce(u.parallel.MPI.IN_PLACE, dlow_fov,
+                                      u.parallel.MPI.MIN)
+            u.parallel.comm.Allreduce(u.parallel.MPI.IN_PLACE, dhigh_fov,
+                                      u.parallel.MPI.MAX)
 
         # Return if no views, it is important that this only happens after self._is_scattered is updated 
-        if not views:
+        if len(rows) == 0:
+            self._fov_cache = None
             return self
+        dlow_fov = dlow_fov.astype(int)
+        dhigh_fov = dhigh_fov.astype(int)
 
         sh = self.data.shape
 
@@ -728,26 +839,31 @@ class Storage(Base):
             new_center = self.center
         
         # Deal with layermap
-        if self.layermap != new_layermap:
-            relaid_data = []
-            for i in new_layermap:
-                if i in self.layermap:
-                    # This layer already exists
-                    d = new_data[self.layermap.index(i)]
-                else:
-                    # A new layer
-                    d = np.empty(new_shape[-self.ndim:], self.dtype)
-                    d.fill(self.fill_value)
-                relaid_data.append(d)
-            new_data = np.array(relaid_data)
+        if list(self.layermap) != new_layermap:
+            old_slots = self._layer_slots
+            relaid_data = np.empty((len(new_layermap),)
+                                   + tuple(new_shape[-self.ndim:]), self.dtype)
+            kept = [(i, old_slots[l]) for i, l in enumerate(new_layermap)
+                    if l in old_slots]
+            fresh = [i for i, l in enumerate(new_layermap)
+                     if l not in old_slots]
+            if kept:
+                dst, src = zip(*kept)
+                # This layer already exists
+                relaid_data[list(dst)] = new_data[list(src)]
+            # A new layer
+            relaid_data[fresh] = self.fill_value
+            new_data = relaid_data
             new_shape = new_data.shape
             self.layermap = new_layermap
 
         self.nlayers = len(new_layermap)
         
         # set layer index in the view
-        for v in views:
-            v.dlayer = self.layermap.index(v.layer)
+        lmap = np.asarray(self.layermap)
+        order = np.argsort(lmap, kind='stable')
+        recs['dlayer'][rows] = order[
+            np.searchsorted(lmap[order], recs['layer'][rows])]
 
         logger.debug('%s[%s] :: shape: %s -> %s'
                      % (self.owner.ID, self.ID, str(sh), str(new_shape)))
@@ -755,6 +871,15 @@ class Storage(Base):
         self.data = new_data
         self.shape = new_shape
         self.center = new_center
+
+        # Field of view of the views seen so far, in the new pixel frame
+        shift = 0
+        if needtocrop_or_pad and self.owner.original is self.owner:
+            shift = misfit[:, 0]
+        self._fov_cache = {'nrows': len(recs), 'rows': rows,
+                           'dlow': dlow_fov + shift,
+                           'dhigh': dhigh_fov + shift,
+                           'layers': layers}
                 
     def _to_pix(self, coord):
         """
@@ -1050,8 +1175,8 @@ class Storage(Base):
                 return shift(self.data[
                              v.dlayer, v.dlow[0]:v.dhigh[0], v.dlow[1]:v.dhigh[1],
                              v.dlow[2]:v.dhigh[2]], v.sp)
-        elif v in self.layermap:
-            return self.data[self.layermap.index(v)]
+        elif v in self._layer_slots:
+            return self.data[self._layer_slots[v]]
         else:
             raise ValueError("View or layer '%s' is not present in storage %s"
                              % (v, self.ID))
@@ -1102,8 +1227,8 @@ class Storage(Base):
                           v.dlow[2]:v.dhigh[2],
                           v.dlow[3]:v.dhigh[3],
                           v.dlow[4]:v.dhigh[4]] = (shift(newdata, -v.sp))
-        elif v in self.layermap:
-            self.data[self.layermap.index(v)] = newdata
+        elif v in self._layer_slots:
+            self.data[self._layer_slots[v]] = newdata
         else:
             raise ValueError("View or layer '%s' is not present in storage %s"
                              % (v, self.ID))
@@ -1141,6 +1266,7 @@ class View(Base):
     """
     _fields = Base._fields + \
                [('active', 'b1'),
+                ('sid', '<i8'),
                 ('dlayer', '<i8'),
                 ('layer', '<i8'), 
                 ('dhigh', '(5,)i8'),
@@ -1150,7 +1276,7 @@ class View(Base):
                 ('psize', '(5,)f8'),
                 ('coord', '(5,)f8'),
                 ('sp', '(5,)f8')]
-    __slots__ = Base.__slots__ + ['_ndim', 'storage', 'storageID', '_pod', '_pods', 'error']
+    __slots__ = Base.__slots__ + ['_ndim', 'storage', '_storageID', '_pod', '_pods', 'error']
     ########
     # TODO #
     ########
@@ -1289,7 +1415,10 @@ class View(Base):
 
     def copy(self,ID=None, update = True):
         nView = View(self.owner, ID)
-        nView._record = self._record.copy()
+        # Copy the row in place so that the copy stays in the view table
+        for name in self._record.dtype.names:
+            if name != 'ID':
+                nView._record[name] = self._record[name]
         nView._ndim = self._ndim
         nView.storage = self.storage
         nView.storageID = self.storageID
@@ -1297,6 +1426,15 @@ class View(Base):
             nView.storage.update_views(nView)
         return nView
         
+    @property
+    def storageID(self):
+        return self._storageID
+
+    @storageID.setter
+    def storageID(self, v):
+        self._storageID = v
+        self._record['sid'] = self.owner._storage_code(v)
+
     @property
     def active(self):
         return self._record['active'] 
@@ -1587,6 +1725,9 @@ class Container(Base):
         # boolean parameter for distributed containers
         self._is_scattered = (distribution == "scattered")
 
+        # Integer codes of storage IDs for the 'sid' column of the view table
+        self._storage_codes = {}
+
     @property
     def copies(self):
         """
@@ -1698,6 +1839,53 @@ class Container(Base):
                 sz += s.data.nbytes
         return sz
 
+    def _storage_code(self, ID):
+        """
+        Integer code of storage `ID` as used in the view table.
+        """
+        if ID is None:
+            return -1
+        codes = self.original._storage_codes
+        code = codes.get(ID)
+        if code is None:
+            code = len(codes)
+            codes[ID] = code
+        return code
+
+    @property
+    def view_records(self):
+        """
+        Columnar table of all views of the original container as a numpy
+        structured array with one row per view in the order of
+        ``self.original.V``. The rows are the views' records, i.e.
+        writing to a column modifies the views.
+        """
+        orig = self.original
+        n = len(orig.V)
+        if n == 0:
+            return np.zeros((0,), dtype=View._fields)
+        return orig._recs[VIEW_PREFIX][1:n + 1]
+
+    def view_rows(self, s=None, active_only=True):
+        """
+        Return the row indices into :py:attr:`view_records` of the views
+        forwarded to :any:`Storage` `s` (all storages if None).
+
+        Parameters
+        ----------
+        s : Storage or None
+            The storage to look for.
+        active_only : True or False
+                 If True (default), return only active views.
+        """
+        recs = self.view_records
+        sel = np.ones((len(recs),), dtype=bool)
+        if active_only:
+            sel &= recs['active']
+        if s is not None:
+            sel &= (recs['sid'] == self.original._storage_codes.get(s.ID, -2))
+        return np.flatnonzero(sel)
+
     def views_in_storage(self, s, active_only=True):
         """
         Return a list of views on :any:`Storage` `s`.
@@ -1710,8 +1898,8 @@ class Container(Base):
                  If True (default), return only active views.
         """
         if active_only:
-            return [v for v in self.original.V.values()
-                    if v.active and (v.storageID == s.ID)]
+            views = list(self.original.V.values())
+            return [views[i] for i in self.view_rows(s)]
         else:
             return [v for v in self.original.V.values()
                     if (v.storage.ID == s.ID)]
@@ -1812,7 +2000,7 @@ class Container(Base):
         # Return new storage
         return s
 
-    def reformat(self, also_in_copies=False):
+    def reformat(self, also_in_copies=False, incremental=False):
         """
         Reformats all storages in this container.
 
@@ -1820,12 +2008,16 @@ class Container(Base):
         ----------
         also_in_copies : bool
             If True, also reformat associated copies of this container
+
+        incremental : bool
+            If True, only account for views added since the last reformat,
+            see :py:meth:`Storage.reformat`
         """
         for ID, s in self.storages.items():
-            s.reformat()
+            s.reformat(incremental=incremental)
             if also_in_copies:
                 for c in self.copies:
-                    c.S[ID].reformat()
+                    c.S[ID].reformat(incremental=incremental)
 
     def report(self):
         """
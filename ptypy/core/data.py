@@ -980,9 +980,9 @@ class PtyScan(object):
                 raw = {}
                 pos = {}
                 weights = {}
-            # Distribute raw data across nodes according to indices
-            raw = parallel.bcast_dict(raw, indices.node)
-            weights = parallel.bcast_dict(weights, indices.node)
+            # Send each node its share of the raw data
+            raw = parallel.scatter_dict(raw, indices.node)
+            weights = parallel.scatter_dict(weights, indices.node)
 
         # (re)distribute position information - every node should now be
         # aware of all positions
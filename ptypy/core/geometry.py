@@ -6,11 +6,15 @@ This file is part of the PTYPY package.
     :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
     :license: see LICENSE for details.
 """
+import os
+import threading
+import weakref
 import numpy as np
 import scipy.fft
 
 from .. import utils as u
 from ..utils.verbose import logger
+from ..utils.profiling import profiler
 from .classes import Base, GEO_PREFIX
 from ..utils.descriptor import EvalDescriptor
 
@@ -116,6 +120,14 @@ class Geo(Base):
     choices = 'numpy', 'scipy', 'fftw'
     userlevel = 1
 
+    [fft_workers]
+    type = int
+    default = 1
+    help = Number of threads per FFT
+    doc = Passed on as ``workers`` to scipy and as ``threads`` to pyFFTW.
+          Use -1 to use all available CPUs. Ignored for numpy.
+    userlevel = 2
+
     [shape]
     type = int, tuple
     default = 256
@@ -438,17 +450,45 @@ def get_propagator(geo_dct, **kwargs):
     Helper function to determine propagator to be attached to Geometry class.
     """
     if geo_dct['propagation'] == 'farfield':
-        return BasicFarfieldPropagator(geo_dct, ffttype=geo_dct["ffttype"], **kwargs)
+        return BasicFarfieldPropagator(geo_dct, ffttype=geo_dct["ffttype"],
+                                       workers=geo_dct.get("fft_workers", 1), **kwargs)
     else:
-        return BasicNearfieldPropagator(geo_dct, ffttype=geo_dct["ffttype"], **kwargs)
+        return BasicNearfieldPropagator(geo_dct, ffttype=geo_dct["ffttype"],
+                                        workers=geo_dct.get("fft_workers", 1), **kwargs)
+
+
+def _write_back(x, y):
+    """
+    Copy the transform result `y` into `x`, unless the transform already
+    wrote into the memory of `x`.
+    """
+    if not np.may_share_memory(x, y):
+        x[...] = y
+    return x
+
+
+def _counted(fft):
+    """
+    Wrap the 2D transform `fft` such that the number of transformed
+    frames is counted by the profiler.
+    """
+    def counted(x):
+        if profiler.active:
+            profiler.count('ffts', x.size // (x.shape[-2] * x.shape[-1]))
+        return fft(x)
+    return counted
 
 
 class FFTchooser(object):
     """
     Chooses the desired FFT algo, and assigns scaling.
     If pyFFTW is not available, falls back to scipy.
+
+    Besides ``fft`` and ``ifft``, which return a new array, the in-place
+    variants ``fft_inplace`` and ``ifft_inplace`` transform the last two
+    axes of a (stack of) array(s) in its own memory and return it.
     """
-    def __init__(self, ffttype='scipy'):
+    def __init__(self, ffttype='scipy', workers=1):
         """
         Parameters
         ----------
@@ -460,23 +500,65 @@ class FFTchooser(object):
             - 'scipy' for scipy.fft.fft2
             - 2 or 4-tuple of (forward_fft2(), inverse_fft2(),
               [scaling, inverse_scaling])
+
+        workers : int
+            Number of threads per transform for scipy and pyFFTW,
+            -1 uses all available CPUs.
         """
         self.ffttype = ffttype
+        self.workers = workers
+        self.fft_inplace = None
+        self.ifft_inplace = None
+        # pyFFTW plans of each thread, keyed by (shape, dtype, direction).
+        # They are released together with the thread, e.g. when the
+        # thread pool of an engine is shut down.
+        self._plans = weakref.WeakKeyDictionary()
 
     def _FFTW_fft(self):
         pyfftw.interfaces.cache.enable()
         pyfftw.interfaces.cache.set_keepalive_time(15.0)
         pe = 'FFTW_MEASURE'
-        self.fft = lambda x: fftw_np.fft2(x, planner_effort=pe)
-        self.ifft = lambda x: fftw_np.ifft2(x, planner_effort=pe)
+        threads = self.workers if self.workers > 0 else os.cpu_count()
+        self._fft = lambda x: fftw_np.fft2(x, planner_effort=pe, threads=threads)
+        self._ifft = lambda x: fftw_np.ifft2(x, planner_effort=pe, threads=threads)
+        self.fft, self.ifft = self._fft, self._ifft
+        self.fft_inplace = lambda x: self._fftw_inplace(x, 'FFTW_FORWARD')
+        self.ifft_inplace = lambda x: self._fftw_inplace(x, 'FFTW_BACKWARD')
+
+    def _fftw_inplace(self, x, direction):
+        """
+        Execute a cached in-place pyFFTW plan on `x`. A plan is created
+        once per shape and dtype, so a fixed batch shape is planned only once.
+        """
+        if not x.flags.c_contiguous or x.dtype not in (np.complex64, np.complex128):
+            fft = self._fft if direction == 'FFTW_FORWARD' else self._ifft
+            return _write_back(x, fft(x))
+        # Executing a plan on new arrays is not thread-safe, so threads
+        # get their own plans
+        plans = self._plans.setdefault(threading.current_thread(), {})
+        key = (x.shape, x.dtype, direction)
+        plan = plans.get(key)
+        if plan is None:
+            # Planning with FFTW_MEASURE overwrites the arrays, use a dummy
+            a = pyfftw.empty_aligned(x.shape, dtype=x.dtype)
+            threads = self.workers if self.workers > 0 else os.cpu_count()
+            plan = pyfftw.FFTW(a, a, axes=(-2, -1), direction=direction,
+                               flags=('FFTW_MEASURE', 'FFTW_UNALIGNED'),
+                               threads=threads)
+            plans[key] = plan
+        plan(x, x)
+        return x
 
     def _scipy_fft(self):
-        self.fft = lambda x: scipy.fft.fft2(x).astype(x.dtype)
-        self.ifft = lambda x: scipy.fft.ifft2(x).astype(x.dtype)
+        w = self.workers
+        self.fft = lambda x: scipy.fft.fft2(x, workers=w).astype(x.dtype, copy=False)
+        self.ifft = lambda x: scipy.fft.ifft2(x, workers=w).astype(x.dtype, copy=False)
+        self.fft_inplace = lambda x: _write_back(x, scipy.fft.fft2(x, overwrite_x=True, workers=w))
+        self.ifft_inplace = lambda x: _write_back(x, scipy.fft.ifft2(x, overwrite_x=True, workers=w))
 
     def _numpy_fft(self):
-        self.fft = lambda x: np.ascontiguousarray(np.fft.fft2(x).astype(x.dtype))
-        self.ifft = lambda x: np.ascontiguousarray(np.fft.ifft2(x).astype(x.dtype))
+        self.fft = lambda x: np.ascontiguousarray(np.fft.fft2(x).astype(x.dtype, copy=False))
+        self.ifft = lambda x: np.ascontiguousarray(np.fft.ifft2(x).astype(x.dtype, copy=False))
 
     def assign_scaling(self, shape):
         if isinstance(self.ffttype, tuple) and len(self.ffttype) > 2:
@@ -502,6 +584,16 @@ class FFTchooser(object):
             self.fft = self.ffttype[0]
             self.ifft = self.ffttype[1]
 
+        # Generic in-place fallback: transform and copy back
+        if self.fft_inplace is None:
+            fft, ifft = self.fft, self.ifft
+            self.fft_inplace = lambda x: _write_back(x, fft(x))
+            self.ifft_inplace = lambda x: _write_back(x, ifft(x))
+
+        # Count transforms for the profiler
+        self.fft, self.ifft, self.fft_inplace, self.ifft_inplace = [
+            _counted(f) for f in (self.fft, self.ifft, self.fft_inplace, self.ifft_inplace)]
+
         return (self.fft, self.ifft)
 
 
@@ -515,7 +607,7 @@ class BasicFarfieldPropagator(object):
     coordinates are rolled periodically, just like in the conventional fft case.
     """
 
-    def __init__(self, geo_pars=None, ffttype='scipy', **kwargs):
+    def __init__(self, geo_pars=None, ffttype='scipy', workers=1, **kwargs):
         """
         Parameters
         ----------
@@ -530,6 +622,9 @@ class BasicFarfieldPropagator(object):
             - 'scipy' for scipy.fft.fft2
             - 2 or 4-tuple of (forward_fft2(), inverse_fft2(),
               [scaling, inverse_scaling])
+
+        workers : int
+            Number of threads per FFT, see :py:class:`FFTchooser`.
         """
         # Instance attributes
         self.crop_pad = None
@@ -542,6 +637,8 @@ class BasicFarfieldPropagator(object):
         self.post_fft = None
         self.pre_ifft = None
         self.post_ifft = None
+        self.post_fft_sc = None
+        self.post_ifft_isc = None
 
         # Get default parameters and update
         self.p = u.Param(Geo.DEFAULT)
@@ -549,8 +646,10 @@ class BasicFarfieldPropagator(object):
             self.dtype = kwargs['dtype']
         else:
             self.dtype = np.complex128
-        self.FFTch = FFTchooser(ffttype)
+        self.FFTch = FFTchooser(ffttype, workers)
         self.fft, self.ifft = self.FFTch.assign_fft()
+        self.fft_inplace = self.FFTch.fft_inplace
+        self.ifft_inplace = self.FFTch.ifft_inplace
         self.update(geo_pars, **kwargs)
 
     def update(self, geo_pars=None, **kwargs):
@@ -631,6 +730,9 @@ class BasicFarfieldPropagator(object):
         self.post_ifft = self.pre_fft.conj()
         self.sc, self.isc = self.FFTch.assign_scaling(self.sh)
 
+        # Scaling folded into the post factors for the in-place transforms
+        self.post_fft_sc = (self.post_fft * self.sc).astype(self.dtype)
+        self.post_ifft_isc = (self.post_ifft * self.isc).astype(self.dtype)
 
     def fw(self, W):
         """
@@ -670,6 +772,32 @@ class BasicFarfieldPropagator(object):
         else:
             return w
 
+    def fw_inplace(self, W):
+        """
+        Forward propagates wavefront W (or a stack of wavefronts) in place,
+        without temporary arrays, and returns it.
+        """
+        if (self.crop_pad != 0).any():
+            W[...] = self.fw(W)
+            return W
+        W *= self.pre_fft
+        self.fft_inplace(W)
+        W *= self.post_fft_sc
+        return W
+
+    def bw_inplace(self, W):
+        """
+        Backward propagates wavefront W (or a stack of wavefronts) in place,
+        without temporary arrays, and returns it.
+        """
+        if (self.crop_pad != 0).any():
+            W[...] = self.bw(W)
+            return W
+        W *= self.pre_ifft
+        self.ifft_inplace(W)
+        W *= self.post_ifft_isc
+        return W
+
 
 def translate_to_pix(sh, center):
     """
@@ -694,7 +822,7 @@ class BasicNearfieldPropagator(object):
     Basic two step (i.e. two ffts) Nearfield Propagator.
     """
 
-    def __init__(self, geo_pars=None, ffttype='scipy', **kwargs):
+    def __init__(self, geo_pars=None, ffttype='scipy', workers=1, **kwargs):
         """
         Parameters
         ----------
@@ -709,6 +837,9 @@ class BasicNearfieldPropagator(object):
             - 'scipy' for scipy.fft.fft2
             - 2 or 4-tuple of (forward_fft2(),inverse_fft2(),
               [scaling,inverse_scaling])
+
+        workers : int
+            Number of threads per FFT, see :py:class:`FFTchooser`.
         """
         # Instance attributes
         self.sh = None
@@ -721,8 +852,10 @@ class BasicNearfieldPropagator(object):
         self.p = u.Param(Geo.DEFAULT)
         self.dtype = kwargs['dtype'] if 'dtype' in kwargs else np.complex128
         self.update(geo_pars, **kwargs)
-        self.FFTch = FFTchooser(ffttype)
+        self.FFTch = FFTchooser(ffttype, workers)
         self.fft, self.ifft = self.FFTch.assign_fft()
+        self.fft_inplace = self.FFTch.fft_inplace
+        self.ifft_inplace = self.FFTch.ifft_inplace
 
     def update(self, geo_pars=None, **kwargs):
         """
@@ -771,6 +904,24 @@ class BasicNearfieldPropagator(object):
         """
         return self.ifft(self.fft(W) * self.ikernel)
 
+    def fw_inplace(self, W):
+        """
+        Forward propagates wavefront W (or a stack of wavefronts) in place
+        and returns it.
+        """
+        self.fft_inplace(W)
+        W *= self.kernel
+        return self.ifft_inplace(W)
+
+    def bw_inplace(self, W):
+        """
+        Backward propagates wavefront W (or a stack of wavefronts) in place
+        and returns it.
+        """
+        self.fft_inplace(W)
+        W *= self.ikernel
+        return self.ifft_inplace(W)
+
 
 ############
 # TESTING ##
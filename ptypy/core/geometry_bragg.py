@@ -8,7 +8,8 @@ from .geometry import Geo as _Geo
 from ..utils.descriptor import EvalDescriptor
 from .classes import Container, Storage, View
 import numpy as np
-from scipy.ndimage.interpolation import map_coordinates
+
+ndi = u.lazy_import('scipy.ndimage')
 
 __all__ = ['Geo_Bragg']
 
@@ -489,10 +490,10 @@ class Geo_Bragg(_Geo):
 
         # interpolate
         if np.iscomplexobj(S_2d.data):
-            S_3d.data[0][:] = map_coordinates(np.abs(S_2d.data[layer]), (zi, yi))
-            S_3d.data[0][:] *= np.exp(1j * map_coordinates(np.angle(S_2d.data[layer]), (zi, yi)))
+            S_3d.data[0][:] = ndi.map_coordinates(np.abs(S_2d.data[layer]), (zi, yi))
+            S_3d.data[0][:] *= np.exp(1j * ndi.map_coordinates(np.angle(S_2d.data[layer]), (zi, yi)))
         else:
-            S_3d.data[0][:] = map_coordinates(S_2d.data[layer], (zi, yi))
+            S_3d.data[0][:] = ndi.map_coordinates(S_2d.data[layer], (zi, yi))
 
         #import ipdb; ipdb.set_trace()
 
@@ -13,6 +13,7 @@ This file is part of the PTYPY package.
     :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
     :license: see LICENSE for details.
 """
+import logging
 import numpy as np
 import time
 from collections import OrderedDict
@@ -82,6 +83,14 @@ class ScanModel(object):
     choices = ['numpy', 'scipy', 'fftw']
     userlevel = 1
 
+    [fft_workers]
+    type = int
+    default = 1
+    help = Number of threads per FFT
+    doc = Passed on as ``workers`` to scipy and as ``threads`` to pyFFTW.
+          Use -1 to use all available CPUs.
+    userlevel = 2
+
     [data]
     default =
     type = @scandata.*
@@ -218,7 +227,9 @@ class ScanModel(object):
         #dp = self.ptyscan.auto(self.frames_per_call)
 
         self.data_available = (dp != data.EOS)
-        logger.debug(u.verbose.report(dp))
+        # Formatting the whole data packet is expensive, only do it if shown
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(u.verbose.report(dp))
 
         if dp == data.WAIT or not self.data_available:
             return None
@@ -244,26 +255,22 @@ class ScanModel(object):
             # This scan is brand new so we create storages for it
             self.diff = self.Cdiff.new_storage(shape=sh, psize=self.psize, padonly=True,
                                                layermap=None)
-            old_diff_views = []
-            old_diff_layers = []
+            old_diff_views = {}
         else:
             # ok storage exists already. Views most likely also. We store them so we can update their status later.
-            old_diff_views = self.Cdiff.views_in_storage(self.diff, active_only=False)
-            old_diff_layers = []
-            for v in old_diff_views:
-                old_diff_layers.append(v.layer)
+            old_diff_views = {}
+            for v in self.Cdiff.views_in_storage(self.diff, active_only=False):
+                old_diff_views.setdefault(v.layer, v)
 
         # Same for mask
         if self.mask is None:
             self.mask = self.Cmask.new_storage(shape=sh, psize=self.psize, padonly=True,
                                                layermap=None)
-            old_mask_views = []
-            old_mask_layers = []
+            old_mask_views = {}
         else:
-            old_mask_views = self.Cmask.views_in_storage(self.mask, active_only=False)
-            old_mask_layers = []
-            for v in old_mask_views:
-                old_mask_layers.append(v.layer)
+            old_mask_views = {}
+            for v in self.Cmask.views_in_storage(self.mask, active_only=False):
+                old_mask_views.setdefault(v.layer, v)
 
         # this is a hack for now
         dp = self._new_data_extra_analysis(dp)
@@ -301,14 +308,14 @@ class ScanModel(object):
 
             # check here: is there already a view to this layer? Is it active?
             try:
-                old_view = old_diff_views[old_diff_layers.index(index)]
+                old_view = old_diff_views[index]
                 old_active = old_view.active
                 old_view.active = active
 
                 logger.debug(
                     'Diff view with layer/index %s of scan %s exists. \nSetting view active state from %s to %s' % (
                         index, label, old_active, active))
-            except ValueError:
+            except KeyError:
                 v = View(self.Cdiff, accessrule=AR_diff)
                 diff_views.append(v)
                 logger.debug(
@@ -318,30 +325,27 @@ class ScanModel(object):
                 positions.append(pos)
 
             try:
-                old_view = old_mask_views[old_mask_layers.index(index)]
+                old_view = old_mask_views[index]
                 old_view.active = active
-            except ValueError:
+            except KeyError:
                 v = View(self.Cmask, accessrule=AR_mask)
                 mask_views.append(v)
 
         # so now we should have the right views to this storages. Let them reformat()
         # that will create the right sizes and the datalist access
-        self.diff.reformat()
-        self.mask.reformat()
+        self.diff.reformat(incremental=True)
+        self.mask.reformat(incremental=True)
         report_time('creating views and storages')
         logger.info('Inserting data in diff and mask storages')
 
-        # Second pass: copy the data 
-        # Benchmark: scales quadratic (!!) with number of frames per node.
-        for dct in dp['iterable']:
-            if dct['data'] is None:
-                continue
-            diff_data = dct['data']
-            idx = dct['index']
-
-            # FIXME: Find a more transparent way than this.
-            self.diff.data[self.diff.layermap.index(idx)][:] = diff_data
-            self.mask.data[self.mask.layermap.index(idx)][:] = dct.get('mask', np.ones_like(diff_data))
+        # Second pass: copy the data in bulk into the slots of the layers
+        frames = [dct for dct in dp['iterable'] if dct['data'] is not None]
+        if frames:
+            self.diff.put_layers([dct['index'] for dct in frames],
+                                 [dct['data'] for dct in frames])
+            self.mask.put_layers([dct['index'] for dct in frames],
+                                 [dct.get('mask', np.ones_like(dct['data']))
+                                  for dct in frames])
 
         # Update maximum nr. of frames in a block
         self.max_frames_per_block = self.diff.nlayers
@@ -600,7 +604,7 @@ class BlockScanModel(ScanModel):
             mask_views.append(mv)
 
             if active:
-                l = indices_node.index(index)
+                l = diff.layer_slot(index)
                 dv.dlayer = l
                 mv.dlayer = l
                 dv.data[:] = maybe_data
@@ -786,6 +790,7 @@ class _Vanilla(object):
         geo_pars.center = center
         geo_pars.propagation = self.p.propagation
         geo_pars.ffttype = self.p.ffttype
+        geo_pars.fft_workers = self.p.fft_workers
         geo_pars.psize = psize
 
         # make a Geo instance and fix resolution
@@ -1078,6 +1083,7 @@ class _Full(object):
         # Add propagation info from this scan model
         geo_pars.propagation = self.p.propagation
         geo_pars.ffttype = self.p.ffttype
+        geo_pars.fft_workers = self.p.fft_workers
 
         # The multispectral case will have multiple geometries
         for ii, fac in enumerate(self.p.coherence.energies):
@@ -1546,6 +1552,7 @@ class Bragg3dModel(Vanilla):
         geo_pars = u.Param({key: common[key] for key in get_keys})
         geo_pars.propagation = self.p.propagation
         geo_pars.ffttype = self.p.ffttype
+        geo_pars.fft_workers = self.p.fft_workers
         # take extra Bragg information into account
         psize = tuple(common['psize'])
         geo_pars.psize = (self.ptyscan.common.rocking_step,) + psize
@@ -1694,7 +1701,7 @@ class ModelManager(object):
                 ilog_message('%s: loading data for scan %s (reformatting probe/obj/exit)'  %(type(scan).__name__,label))
                 self.ptycho.probe.reformat(True)
                 self.ptycho.obj.reformat(True)
-                self.ptycho.exit.reformat(True)
+                self.ptycho.exit.reformat(True, incremental=True)
 
                 # Initialize probe/object/exit
                 ilog_message('%s: loading data for scan %s (initializing probe/obj/exit)'  %(type(scan).__name__,label))
@@ -8,8 +8,10 @@ This file is part of the PTYPY package.
     :license: see LICENSE for details.
 """
 import numpy as np
+import os
 import time
 import json
+import threading
 from . import paths
 from collections import OrderedDict
 
@@ -17,6 +19,7 @@ from .. import utils as u
 from ..utils.verbose import logger, _, report, headerline, log, LogTime
 from ..utils.verbose import ilog_message, ilog_streamer, ilog_newline
 from ..utils import parallel
+from ..utils.profiling import profiler
 from .. import engines
 from .classes import Base, Container, Storage, PTYCHO_PREFIX
 from .manager import ModelManager
@@ -208,6 +211,16 @@ class Ptycho(Base):
     help = Auto-save file name (or format string)
     doc = Auto-save file name or format string (constructed against runtime dictionary)
 
+    [io.autosave.threaded]
+    default = False
+    type = bool
+    help = Background saving switch
+    doc = If ``True``, the master node copies probe and object and writes the file in a
+      background thread while the reconstruction continues. At most one save is in flight
+      at any time and no process waits for it to complete. This also applies to the final
+      save at the end of each engine; :py:meth:`finalize` waits for pending saves.
+    userlevel = 2
+
     [io.autoplot]
     default = Param
     type = Param
@@ -276,6 +289,28 @@ class Ptycho(Base):
     choices = ['all', 'loading', 'engine_init', 'engine_prepare', 'engine_iterate', 'engine_finalize']
     userlevel = 2
 
+    [io.profile]
+    default = Param
+    type = Param
+    help = Per-iteration profiling options
+    doc = Records the wall time of the engine phases, the number of FFTs, the bytes moved by
+      MPI allreduce and the peak memory for every call of the engine's ``iterate``, one JSON
+      line per process. Summarize a profile file with ``ptypy.profile``.
+
+    [io.profile.active]
+    default = False
+    type = bool
+    help = Activation switch
+    userlevel = 2
+
+    [io.profile.file]
+    default = "profiles/%(run)s.jsonl"
+    type = str
+    help = Profile file name (or format string)
+    doc = Format string constructed against the runtime dictionary. Relative paths are relative
+      to ``io.home``. Records are appended to an existing file.
+    userlevel = 2
+
     [scans]
     default = None
     type = Param
@@ -363,6 +398,8 @@ class Ptycho(Base):
         self.plotter = None
         self.record_positions = False
         self._jupyter_client = None
+        self._save_thread = None
+        self._save_error = None
 
         # Early boot strapping
         self._configure()
@@ -658,14 +695,16 @@ class Ptycho(Base):
 
             # Prepare the engine
             ilog_message('%s: initializing engine' %engine.p.name)
-            with LogTime(self.p.io.benchmark == 'all') as t:
+            if self.p.io.profile.active:
+                profiler.start(self.paths.get_path(self._profile_file(), self.runtime))
+            with LogTime(self.p.io.benchmark == 'all') as t, profiler.phase('engine_init'):
                 engine.initialize()
             if (self.p.io.benchmark == 'all') and parallel.master: self.benchmark.engine_init += t.duration
 
             # One .prepare() is always executed, as Ptycho may hold data
             ilog_message('%s: preparing engine' %engine.p.name)
             self.new_data = [(d.label, d) for d in self.diff.S.values()]
-            with LogTime(self.p.io.benchmark == 'all') as t:
+            with LogTime(self.p.io.benchmark == 'all') as t, profiler.phase('engine_prepare'):
                 engine.prepare()
             if (self.p.io.benchmark == 'all') and parallel.master: self.benchmark.engine_prepare += t.duration
 
@@ -679,14 +718,14 @@ class Ptycho(Base):
                 parallel.barrier()
 
                 # Check for new data
-                with LogTime(self.p.io.benchmark == 'all') as t:
+                with LogTime(self.p.io.benchmark == 'all') as t, profiler.phase('data_load'):
                     self.new_data = self.model.new_data()
                 if (self.p.io.benchmark == 'all') and parallel.master: self.benchmark.data_load += t.duration
 
                 # Last minute preparation before a contiguous block of
                 # iterations
                 if self.new_data:
-                    with LogTime(self.p.io.benchmark == 'all') as t:
+                    with LogTime(self.p.io.benchmark == 'all') as t, profiler.phase('engine_prepare'):
                         engine.prepare()
                     if (self.p.io.benchmark == 'all') and parallel.master: self.benchmark.engine_prepare += t.duration
 
@@ -699,7 +738,7 @@ class Ptycho(Base):
                     if engine.curiter % auto_save.interval == 0:
                         auto = self.paths.auto_file(self.runtime)
                         logger.info(headerline('Autosaving'))
-                        self.save_run(auto, 'dump')
+                        self.save_run(auto, 'dump', threaded=auto_save.threaded)
                         self.runtime.last_save = engine.curiter
                         logger.info(headerline())
 
@@ -740,13 +779,15 @@ class Ptycho(Base):
             ilog_newline()
 
             # Done. Let the engine finish up
-            with LogTime(self.p.io.benchmark == 'all') as t:
+            with LogTime(self.p.io.benchmark == 'all') as t, profiler.phase('engine_finalize'):
                 engine.finalize()
             if (self.p.io.benchmark == 'all') and parallel.master: self.benchmark.engine_finalize += t.duration
+            profiler.record(event='finalize', engine=engine.p.name, iteration=engine.curiter)
+            profiler.stop()
 
             # Save
             if self.p.io.rfile:
-                self.save_run(kind=self.p.io.rformat)
+                self.save_run(kind=self.p.io.rformat, threaded=self.p.io.autosave.threaded)
             else:
                 pass
             # Time the initialization
@@ -780,8 +821,23 @@ class Ptycho(Base):
             if not self.engines: self.init_engine()
             self.runtime.allstart = time.asctime()
             self.runtime.allstop = None
+            carry = 0
             for engine in self.engines.values():
+                # Iterations saved by an earlier engine that stopped early
+                engine.numiter += carry
                 self.run(engine=engine)
+                carry = 0
+                if engine.p.stopping.carry_over and engine.stop_reason is not None:
+                    carry = engine.numiter - engine.curiter
+
+    def _profile_file(self):
+        """
+        Format string of the profile file, relative to ``io.home``.
+        """
+        fname = self.p.io.profile.file
+        if not fname.startswith(os.path.sep):
+            fname = self.paths.home + fname
+        return fname
 
     def finalize(self):
         """
@@ -789,6 +845,7 @@ class Ptycho(Base):
         """
         # 'allstop' will be interpreted as 'quit' on threaded plot clients
         self.runtime.allstop = time.asctime()
+        self.wait_for_save()
         if parallel.master and self.interactor is not None:
             self.interactor.process_requests()
         if self.plotter and self.p.io.autoplot.make_movie:
@@ -887,7 +944,7 @@ class Ptycho(Base):
             P.init_data()
         return P
 
-    def save_run(self, alt_file=None, kind='minimal', force_overwrite=True):
+    def save_run(self, alt_file=None, kind='minimal', force_overwrite=True, threaded=False):
         """
         Save run to file.
 
@@ -905,11 +962,21 @@ class Ptycho(Base):
                   storages, positions and runtime information is saved.
                 - *'full_flat'*, (almost) complete environment
 
+        threaded : bool
+            If True, the storage data is copied and the file is written
+            in a background thread on the master node. A previous
+            background save is waited for first, so at most one is in
+            flight. There is no barrier in this case. Ignored for
+            *'fullflat'*.
+
         """
         from . import save_load
         from .. import io
 
         dest_file = None
+        threaded = threaded and kind != 'fullflat'
+        if threaded:
+            self.wait_for_save()
 
         if parallel.master:
 
@@ -1039,18 +1106,59 @@ class Ptycho(Base):
                 for ID, S in self.obj.storages.items():
                     content.positions[ID] = np.array([v.coord for v in S.views if v.pod.pr_view.layer==0])
 
-            h5opt = io.h5options['UNSUPPORTED']
-            io.h5options['UNSUPPORTED'] = 'ignore'
-            logger.info('Saving to %s' % dest_file)
-            io.h5write(dest_file, header=header, content=content)
-            io.h5options['UNSUPPORTED'] = h5opt
+            if threaded:
+                # Snapshot everything the main thread keeps modifying
+                for dct in list(content.probe.values()) + list(content.obj.values()):
+                    dct['data'] = dct['data'].copy()
+                content.runtime.iter_info = list(content.runtime.iter_info)
+                self._save_thread = threading.Thread(target=self._write_run_background,
+                                                     args=(dest_file, header, content),
+                                                     name='ptypy_save')
+                self._save_thread.start()
+            else:
+                self._write_run(dest_file, header, content)
         else:
             pass
         # We have to wait for all processes, just in case the script isn't
         # finished after saving
-        parallel.barrier()
+        if not threaded:
+            parallel.barrier()
         return dest_file
 
+    @staticmethod
+    def _write_run(dest_file, header, content):
+        from ..io import h5rw
+        logger.info('Saving to %s' % dest_file)
+        # Unsupported types are skipped for this write only, the global
+        # h5options may be in use by the main thread at the same time
+        h5rw.h5write(dest_file, unsupported='ignore', header=header, content=content)
+
+    def _write_run_background(self, dest_file, header, content):
+        # Keep the error for wait_for_save to raise it in the main thread
+        try:
+            self._write_run(dest_file, header, content)
+        except Exception as e:
+            self._save_error = e
+
+    def wait_for_save(self):
+        """
+        Block until a background save started by :py:meth:`save_run`
+        has been written. Errors of the save are raised here, on the
+        master as they are and as RuntimeError on the other nodes.
+        This is a collective call.
+        """
+        if self._save_thread is not None:
+            self._save_thread.join()
+            self._save_thread = None
+        error, self._save_error = self._save_error, None
+        # Only the master saves, the other nodes must not wait for it
+        # in the next collective call if it fails
+        message = parallel.bcast(None if error is None else repr(error))
+        if error is not None:
+            raise error
+        elif message is not None:
+            raise RuntimeError('Saving on the master node failed: %s' % message)
+
     def print_stats(self, table_format=None, detail='summary'):
         """
         Calculates the memory usage and other info of ptycho instance
@@ -1164,9 +1272,10 @@ class Ptycho(Base):
         This function redistributes data among nodes, so that each
         node becomes in charge of a contiguous block of scanning
         positions.
-        Each node is associated with a domain of the scanning pattern,
-        and communication happens node-to-node after each has worked
-        out which of its pods are not part of its domain.
+        Each node is associated with a domain of the scanning pattern.
+        After each node has worked out which of its pods are not part of
+        its domain, the frames and masks of all these pods are packed per
+        destination and exchanged at once with :py:func:`parallel.alltoallv`.
         """
         t0 = time.time()
         
@@ -1254,33 +1363,63 @@ class Ptycho(Base):
             for name in ['Cdiff', 'Cmask']:
                 self.containers[name].reformat()
     
-            # transfer data
+            # Views to send to / receive from each process, in the same
+            # order on both sides
+            send_names = [[] for r in range(N)]
+            recv_names = [[] for r in range(N)]
+            for name in sorted(pairs):
+                source, dest = pairs[name]
+                if source == parallel.rank:
+                    send_names[dest].append(name)
+                if dest == parallel.rank:
+                    recv_names[source].append(name)
+
+            # transfer data and masks, packed per destination
+            nbytes = 0
+            for kind, dtype in [('data', self.diff.dtype), ('mask', np.uint8)]:
+                sendcounts = [sum(int(np.prod(views[n].shape)) for n in names) for names in send_names]
+                recvcounts = [sum(int(np.prod(views[n].shape)) for n in names) for names in recv_names]
+                sendbuf = np.empty((sum(sendcounts),), dtype=dtype)
+                i = 0
+                for names in send_names:
+                    for n in names:
+                        frame = views[n].data if kind == 'data' else views[n].pod.mask
+                        sendbuf[i:i + frame.size] = frame.ravel()
+                        i += frame.size
+                recvbuf = np.empty((sum(recvcounts),), dtype=dtype)
+                nbytes += parallel.alltoallv(sendbuf, sendcounts, recvbuf, recvcounts)
+                i = 0
+                for names in recv_names:
+                    for n in names:
+                        view = views[n]
+                        frame = recvbuf[i:i + int(np.prod(view.shape))].reshape(view.shape)
+                        if kind == 'data':
+                            view.data = frame
+                        else:
+                            view.pod.mask = frame.astype(bool)
+                        i += frame.size
+
+            # Sent views are no longer handled here
             transferred = 0
-            for name, (source,dest) in pairs.items():
-                view = views[name]
-                if parallel.rank == source:
-                    parallel.send(view.data, dest=dest)
-                    parallel.send(view.pod.mask, dest=dest)
+            for names in send_names:
+                for n in names:
+                    view = views[n]
                     view.active = False
                     view.pod.ma_view.active = False
                     view.pod.ex_view.active = False
                     transferred += 1
-                if dest == parallel.rank:
-                    # your turn to receive
-                    view.data = parallel.receive()
-                    view.pod.mask = parallel.receive()
-                parallel.barrier()
-                
+
             for name in ['Cdiff', 'Cmask', 'Cexit']:
                 self.containers[name].reformat()
-                
+
             transferred = parallel.comm.reduce(transferred)
+            nbytes = parallel.comm.reduce(nbytes)
             t1 = time.time()
-    
+
             if parallel.master:
-                logger.info('Redistributed data, moved %u pods in %.2f s'
-                            %  (transferred, t1 - t0))
-    
+                logger.info('Redistributed data, moved %u pods (%.1f MB) in %.2f s'
+                            % (transferred, nbytes / 1e6, t1 - t0))
+
         return positions, label
 
     def _best_decomposition(self, N):
@@ -14,7 +14,7 @@ __all__ = ['WASP_serial']
 
 
 @register()
-class WASP_serial(WASP):
+class WASP_serial(WASP, projectional_serial.PoUpdateModeMixin):
     """
     Weighted Average of Sequential Projections
 
@@ -35,6 +35,7 @@ class WASP_serial(WASP):
     default = False
     type = bool
     help = A switch for computing the fourier error (this can impact the performance of the engine)
+
     """
 
     def __init__(self, ptycho_parent, pars=None):
@@ -44,6 +45,7 @@ class WASP_serial(WASP):
 
         # Stores all information needed with respect to the diffraction storages.
         self.diff_info = {}
+        self.addr_tables = {}
         self.kernels = {}
 
     def engine_initialize(self):
@@ -104,14 +106,14 @@ class WASP_serial(WASP):
             kern.FUK = FourierUpdateKernel(aux, nmodes)
             kern.FUK.allocate()
 
-            kern.POK = PoUpdateKernel()
+            kern.POK = PoUpdateKernel(mode=self.p.po_update_mode)
             kern.POK.allocate()
 
             kern.AWK = AuxiliaryWaveKernel()
             kern.AWK.allocate()
 
-            kern.FW = geo.propagator.fw
-            kern.BW = geo.propagator.bw
+            kern.FW = geo.propagator.fw_inplace
+            kern.BW = geo.propagator.bw_inplace
             kern.resolution = geo.resolution[0]
 
             if self.do_position_refinement:
@@ -147,12 +149,13 @@ class WASP_serial(WASP):
             prep.err_fourier = np.zeros_like(prep.ma_sum)
             prep.err_exit = np.zeros_like(prep.ma_sum)
 
-        # Unfortunately this needs to be done for all pods, since
-        # the shape of the probe / object was modified.
-        # TODO: possible scaling issue, remove the need for padding
+        # Addresses need to be gathered for all pods, since the shape of
+        # the probe / object may have been modified. Only pods of new
+        # views are looked up.
         for label, d in self.di.storages.items():
             prep = self.diff_info[d.ID]
-            prep.view_IDs, prep.poe_IDs, prep.addr = projectional_serial.serialize_array_access(d)
+            prep.view_IDs, prep.poe_IDs, prep.addr = projectional_serial.serialize_array_access(
+                d, table=self.addr_tables.setdefault(d.ID, u.Param()))
             if self.do_position_refinement:
                 prep.original_addr = np.zeros_like(prep.addr)
                 prep.original_addr[:] = prep.addr
@@ -254,7 +257,7 @@ class WASP_serial(WASP):
 
                     ## forward FFT
                     t1 = time.time()
-                    aux[:] = FW(aux)
+                    FW(aux)
                     self.benchmark.B_Prop += time.time() - t1
 
                     ## Deviation from measured data
@@ -269,7 +272,7 @@ class WASP_serial(WASP):
 
                     ## backward FFT
                     t1 = time.time()
-                    aux[:] = BW(aux)
+                    BW(aux)
                     self.benchmark.D_iProp += time.time() - t1
 
                     ## build exit wave
@@ -301,7 +304,7 @@ class WASP_serial(WASP):
                     ## compute log-likelihood
                     if self.p.compute_log_likelihood:
                         t1 = time.time()
-                        aux[:] = FW(aux)
+                        FW(aux)
                         FUK.log_likelihood(aux, addr, mag, ma, err_phot)
                         self.benchmark.F_LLerror += time.time() - t1
 
@@ -388,7 +391,7 @@ class WASP_serial(WASP):
 
                 # We need to re-calculate the current error
                 PCK.build_aux(aux, addr, ob, pr)
-                aux[:] = FW(aux)
+                FW(aux)
                 if self.p.position_refinement.metric == "fourier":
                     PCK.fourier_error(aux, addr, mag, ma, ma_sum)
                     PCK.error_reduce(addr, err_fourier)
@@ -402,7 +405,7 @@ class WASP_serial(WASP):
                 for i in range(PCK.mangler.nshifts):
                     PCK.mangler.get_address(i, addr, mangled_addr, max_oby, max_obx)
                     PCK.build_aux(aux, mangled_addr, ob, pr)
-                    aux[:] = FW(aux)
+                    FW(aux)
                     if self.p.position_refinement.metric == "fourier":
                         PCK.fourier_error(aux, mangled_addr, mag, ma, ma_sum)
                         PCK.error_reduce(mangled_addr, err_fourier)
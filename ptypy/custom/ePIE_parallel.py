@@ -8,9 +8,11 @@ that this algorithm is not a strict parallelization of the original
 ePIE algorithm. The number of nodes affects reconstruction as
 described in the publication.
 
-This class does not carry out the slimmed object sharing described in
-Nashed et al., but instead shares the entire object array as done in
-for example the PTYPY implementation of the Differece Map algorithm.
+By default this class shares the entire object array as done in for
+example the PTYPY implementation of the Differece Map algorithm. With
+``sparse_allreduce``, each node only holds its own object tile and
+exchanges the parts that overlap with the tiles of other nodes, which
+is close to the slimmed object sharing described in Nashed et al.
 
 Note that these PTYPY-specific reconstruction options are not
 (yet) implemented:
@@ -84,6 +86,20 @@ class EPIEParallel(BaseEngine):
     help = Redistribute views to form blocks
     doc = Whether or not to redistribute data among nodes to keep each node's views in a contiguous geographic block, even if new data is added during reconstruction.
 
+    [sparse_allreduce]
+    default = False
+    type = bool
+    help = Only exchange overlapping object regions between nodes
+    doc = Each node only holds the object within the bounding box of its own views (its tile),
+      so that the object memory per node scales with the tile size. At each synchronization the
+      object is exchanged with the nodes whose tiles overlap instead of reducing the whole object,
+      so the communication volume scales with the overlap of the tiles. The master node keeps the
+      full object for saving and plotting, the tiles are collected there at the end of every call
+      to ``iterate``. All nodes hold the full object again once the engine is finalized. The
+      reconstruction is the same as without this option, only the communication differs.
+      Falls back to full reductions if ``obj_smooth_std`` is set.
+    userlevel = 2
+
     [average_probe]
     default = False
     type = bool
@@ -142,6 +158,11 @@ class EPIEParallel(BaseEngine):
 
         # Instance attributes
         self.ob_nodecover = None
+        self.ob_regions = {}
+        self.ob_origins = {}
+        self.ob_full = {}
+        self.all_regions = None
+        self.ob_max = None
         self.mean_power = None
 
         self.ptycho.citations.add_article(
@@ -173,16 +194,19 @@ class EPIEParallel(BaseEngine):
         if self.p.redistribute_data:
             self._redestribute_data()
 
-        # mark the pixels covered per node
-        self.ob_nodecover.fill(0.0)
-        for name, pod in self.pods.items():
-            if pod.active:
-                self.ob_nodecover[pod.ob_view] = 1
-        self.nodemask = np.array(list(self.ob_nodecover.S.values())[0].data[0],
-                                 dtype=bool)
+        if self._sparse_allreduce():
+            self._prepare_tiles()
+        else:
+            # mark the pixels covered per node
+            self.ob_nodecover.fill(0.0)
+            for name, pod in self.pods.items():
+                if pod.active:
+                    self.ob_nodecover[pod.ob_view] = 1
+            self.nodemask = np.array(list(self.ob_nodecover.S.values())[0].data[0],
+                                     dtype=bool)
 
-        # communicate this over MPI
-        parallel.allreduceC(self.ob_nodecover)
+            # communicate this over MPI
+            parallel.allreduceC(self.ob_nodecover)
 
         # Mean power in the data
         mean_power = 0.
@@ -278,8 +302,7 @@ class EPIEParallel(BaseEngine):
                 # probe.
                 if do_update_probe:
                     logger.debug(pre_str + '----- ePIE probe update -----')
-                    object_max = np.max(
-                        np.abs(list(self.ob.S.values())[0].data.max())**2)
+                    object_max = self._object_max()
                     pod.probe += (self.p.beta
                                   * np.conj(pod.object) / object_max
                                   * (pod.exit - exit_))
@@ -315,13 +338,24 @@ class EPIEParallel(BaseEngine):
                 # contributed to, and zero the rest to avoid weird
                 # feedback.
                 list(self.ob.S.values())[0].data[0] *= self.nodemask
-                parallel.allreduceC(self.ob)
+                if self._sparse_allreduce():
+                    # exchange only where the tiles of the nodes overlap,
+                    # the rest of the object is not held by this node
+                    for name, s in self.ob.S.items():
+                        region, origin = self.ob_regions[name], self.ob_origins[name]
+                        parallel.allreduce_region(s.data, region, origin)
+                        y0, y1, x0, x1 = self._shift(region, origin)
+                        s.data[..., y0:y1, x0:x1] /= (
+                            np.abs(self.ob_nodecover.S[name].data[..., y0:y1, x0:x1]) + 1e-5)
+                    self._share_object_max()
+                else:
+                    parallel.allreduceC(self.ob)
 
-                # the reduced sum should be an average, and the
-                # denominator (the number of contributing nodes) varies
-                # across the object.
-                for name, s in self.ob.S.items():
-                    s.data /= (np.abs(self.ob_nodecover.S[name].data) + 1e-5)
+                    # the reduced sum should be an average, and the
+                    # denominator (the number of contributing nodes) varies
+                    # across the object.
+                    for name, s in self.ob.S.items():
+                        s.data /= (np.abs(self.ob_nodecover.S[name].data) + 1e-5)
 
                 # average the probe across nodes, if requested
                 if self.p.average_probe and do_update_probe:
@@ -333,6 +367,13 @@ class EPIEParallel(BaseEngine):
 
             self.curiter += 1
 
+        # assemble the full object from the tiles on the master node
+        if self._sparse_allreduce():
+            t3 = time.time()
+            for name, s in self.ob.S.items():
+                parallel.gather_regions(s.data, self.ob_regions[name], self.ob_origins[name])
+            tc += time.time() - t3
+
         logger.info('Time spent in Fourier update: %.2f' % tf)
         logger.info('Time spent in Overlap update: %.2f' % to)
         logger.info('Time spent in communication:  %.2f' % tc)
@@ -347,6 +388,13 @@ class EPIEParallel(BaseEngine):
         """
         Try deleting every helper container.
         """
+        # all nodes hold the full object again
+        if self._sparse_allreduce():
+            for name, s in self.ob.S.items():
+                data = parallel.bcast(s.data if parallel.master else None)
+                if not parallel.master:
+                    self._set_frame(s, data, self.ob_full[name][1])
+
         containers = [self.ob_nodecover, ]
 
         for c in containers:
@@ -356,6 +404,132 @@ class EPIEParallel(BaseEngine):
 
         del containers
 
+    def _sparse_allreduce(self):
+        return (self.p.sparse_allreduce and parallel.size > 1
+                and self.p.obj_smooth_std is None)
+
+    def _prepare_tiles(self):
+        """
+        Restrict the object storages of this node to its tile, the master
+        node keeps the full object. Regions are given in the pixel frame
+        of the master's storages, ``ob_origins`` holds the position of
+        the first pixel of each local storage in that frame.
+        """
+        for name, s in self.ob.S.items():
+            # the frame of the full object, new data may have changed it
+            shape, center = parallel.comm.bcast((s.shape, s.center) if parallel.master else None)
+            self.ob_full[name] = (shape, center)
+            if not parallel.master:
+                s.center = center
+
+            # the tile of this node is the bounding box of its views
+            views = [pod.ob_view for pod in self.pods.values()
+                     if pod.active and pod.ob_view.storageID == name]
+            region = (0, 0, 0, 0)
+            if views:
+                low = np.maximum(np.min([v.dlow for v in views], axis=0), 0)
+                high = np.minimum(np.max([v.dhigh for v in views], axis=0), shape[-2:])
+                region = (low[0], high[0], low[1], high[1])
+            self.ob_regions[name] = region
+
+            data = parallel.scatter_regions(s.data, region)
+            origin = (0, 0)
+            if not parallel.master:
+                origin = (region[0], region[2])
+                self._set_frame(s, data, center - origin)
+            self.ob_origins[name] = origin
+
+            # the node coverage only within the local storage
+            nc = self.ob_nodecover.S[name]
+            self._set_frame(nc, np.zeros(s.data.shape, dtype=nc.dtype), s.center)
+
+        # mark the pixels covered per node
+        for name, pod in self.pods.items():
+            if pod.active:
+                self.ob_nodecover[pod.ob_view] = 1
+        self.nodemask = np.array(list(self.ob_nodecover.S.values())[0].data[0],
+                                 dtype=bool)
+        for name, nc in self.ob_nodecover.S.items():
+            parallel.allreduce_region(nc.data, self.ob_regions[name], self.ob_origins[name])
+
+        # maximum of the object outside the tile of each node
+        name, s = list(self.ob.S.items())[0]
+        tile = self.ob_regions[name]
+        self.all_regions = parallel.comm.allgather(tile)
+        maxima = None
+        if parallel.master:
+            ny, nx = s.data.shape[-2:]
+            maxima = [self._region_max(s.data, self._subtract((0, ny, 0, nx), other))
+                      for other in self.all_regions]
+        self.ob_max = parallel.comm.scatter(maxima)
+
+    @staticmethod
+    def _set_frame(s, data, center):
+        """
+        Replace the data of storage `s` by `data`, whose pixel
+        ``center`` is the origin of the physical coordinates.
+        """
+        s.data = data
+        s.shape = data.shape
+        s._fov_cache = None
+        s.center = center
+
+    @staticmethod
+    def _shift(region, origin):
+        """
+        `region` in the pixel frame of a storage starting at `origin`.
+        """
+        y0, y1, x0, x1 = region
+        return y0 - origin[0], y1 - origin[0], x0 - origin[1], x1 - origin[1]
+
+    def _object_max(self):
+        """
+        Maximum of ``|object|**2`` used to normalize the probe update.
+        In sparse mode, only the tile of this node is up to date. Outside
+        of it, the object is the one of the last synchronization, whose
+        maximum is kept in ``ob_max``.
+        """
+        name, s = list(self.ob.S.items())[0]
+        if not self._sparse_allreduce():
+            return u.abs2(s.data).max()
+        tile = self._shift(self.ob_regions[name], self.ob_origins[name])
+        return max(self._region_max(s.data, [tile]), self.ob_max)
+
+    def _share_object_max(self):
+        """
+        Update the maximum of the object outside the tile of this node.
+        Each node sends every other node the maximum over the part of
+        its own tile that lies outside the tile of that node.
+        """
+        name, s = list(self.ob.S.items())[0]
+        tile, origin = self.ob_regions[name], self.ob_origins[name]
+        maxima = [self._region_max(s.data, [self._shift(r, origin) for r in self._subtract(tile, other)])
+                  for other in self.all_regions]
+        self.ob_max = max(parallel.comm.alltoall(maxima))
+
+    @staticmethod
+    def _region_max(a, regions):
+        """
+        Maximum of ``|a|**2`` within the list of (y0, y1, x0, x1)
+        `regions`, zero if they are empty.
+        """
+        return max([u.abs2(a[..., y0:y1, x0:x1]).max() for y0, y1, x0, x1 in regions
+                    if y1 > y0 and x1 > x0], default=0.)
+
+    @staticmethod
+    def _subtract(region, other):
+        """
+        Split the part of `region` outside of `other` into up to four
+        (y0, y1, x0, x1) regions.
+        """
+        y0, y1, x0, x1 = region
+        oy0, oy1 = min(max(other[0], y0), y1), max(min(other[1], y1), y0)
+        ox0, ox1 = min(max(other[2], x0), x1), max(min(other[3], x1), x0)
+        if oy1 <= oy0 or ox1 <= ox0:
+            return [region]
+        return [(y0, oy0, x0, x1), (oy1, y1, x0, x1),
+                (oy0, oy1, x0, ox0), (oy0, oy1, ox1, x1)]
+
     def _redestribute_data(self):
         """
         This function redistributes data among nodes, so that each
@@ -383,8 +557,8 @@ class EPIEParallel(BaseEngine):
         xlims = np.array(xlims) + np.array([-1, 1]) * np.diff(xlims) * .001
         ylims = np.array(ylims) + np.array([-1, 1]) * np.diff(ylims) * .001
         # the domains sizes
-        dx = np.diff(xlims) / layout[1]
-        dy = np.diff(ylims) / layout[0]
+        dx = np.diff(xlims)[0] / layout[1]
+        dy = np.diff(ylims)[0] / layout[0]
 
         # now, the node number corresponding to a coordinate (x, y) is
         def __node(x, y):
@@ -483,6 +657,8 @@ class EPIEParallel(BaseEngine):
 
                 # shift the exit waves, loop through different exit wave views
                 for pv in pr_s.views:
+                    if not pv.pod.active:
+                        continue
                     pv.pod.exit = u.shift_zoom(pv.pod.exit, (1.,)*2,
                             (c1[0], c1[1]), (c2[0], c2[1]))
 
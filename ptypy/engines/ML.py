@@ -17,6 +17,7 @@ import time
 from .. import utils as u
 from ..utils.verbose import logger
 from ..utils import parallel
+from ..utils.profiling import profiler
 from .utils import Cnorm2, Cdot
 from . import register
 from .base import BaseEngine, PositionCorrectionEngine
@@ -106,6 +107,71 @@ class ML(PositionCorrectionEngine):
     help = How many coefficients to be used in the the linesearch
     doc = choose between the 'quadratic' approximation (default) or 'all'
 
+    [optimizer]
+    default = cg
+    type = str
+    help = Method used to compute the search directions
+    doc = One of:
+      - ``'cg'`` : Polak-Ribiere conjugate gradient
+      - ``'lbfgs'`` : limited-memory BFGS quasi-Newton directions, built from the last
+        ``lbfgs_memory`` object/probe steps and gradient changes
+    choices = 'cg','lbfgs'
+    userlevel = 2
+
+    [lbfgs_memory]
+    default = 5
+    type = int
+    lowlim = 1
+    help = Number of step/gradient pairs kept by the L-BFGS optimizer
+    doc = Each pair costs two copies of the object and two copies of the probe.
+    userlevel = 2
+
+    [minibatch_fraction]
+    default = 1.
+    type = float
+    lowlim = 0.0
+    uplim = 1.0
+    help = Fraction of the diffraction frames used per iteration
+    doc = Gradient and line-search coefficients are estimated from a random subset of the
+      diffraction frames of this size, scaled up to the full data set. A new subset is drawn
+      every iteration. With ``1.`` all frames are used. See ``minibatch_schedule``.
+      The serial engines draw whole blocks of ``batch_size`` frames instead of single
+      frames and require ``batch_size`` to be set.
+    userlevel = 2
+
+    [minibatch_schedule]
+    default = constant
+    type = str
+    help = How the mini-batch fraction grows with the iterations
+    doc = One of:
+      - ``'constant'`` : always ``minibatch_fraction``
+      - ``'linear'`` : grows linearly to the full data set within ``minibatch_ramp`` iterations
+      - ``'geometric'`` : grows by a constant factor to the full data set within ``minibatch_ramp`` iterations
+    choices = 'constant','linear','geometric'
+    userlevel = 2
+
+    [minibatch_ramp]
+    default = 50
+    type = int
+    lowlim = 1
+    help = Number of iterations until the mini-batch schedule reaches the full data set
+    userlevel = 2
+
+    [minibatch_sampling]
+    default = random
+    type = str
+    help = How the frames of a mini-batch are drawn
+    doc = One of:
+      - ``'random'`` : independent uniform draws in every iteration
+      - ``'reshuffle'`` : without replacement across iterations, i.e. all frames are
+        used once before any is used again, which reduces the variance of the estimates
+        accumulated over a pass through the data
+      - ``'stratified'`` : one draw from each of equally sized groups of consecutive frames,
+        which spreads the batch evenly over the scan and reduces the variance of the
+        object gradient
+    choices = 'random','reshuffle','stratified'
+    userlevel = 2
+
     """
 
     SUPPORTED_MODELS = [Full, Vanilla, Bragg3dModel, BlockVanilla, BlockFull, GradFull, BlockGradFull]
@@ -140,6 +206,14 @@ class ML(PositionCorrectionEngine):
 
         # Other
         self.tmin = None
+        self.lbfgs = None
+
+        # Mini-batch: names of the diffraction views used in this iteration
+        # (None for all of them), scale to the full data set and
+        # permutation of the frames not yet used by 'reshuffle' sampling
+        self.batch = None
+        self.batch_scale = 1.
+        self._batch_queue = None
         self.ML_model = None
         self.smooth_gradient = None
         self.scale_p_o = None
@@ -174,6 +248,10 @@ class ML(PositionCorrectionEngine):
 
         self.tmin = 1.
 
+        # Quasi-Newton history
+        if self.p.optimizer == 'lbfgs':
+            self.lbfgs = LBFGS(self.ob, self.pr, self.p.lbfgs_memory)
+
         # Other options
         self.smooth_gradient = prepare_smoothing_preconditioner(
             self.p.smooth_gradient)
@@ -216,6 +294,7 @@ class ML(PositionCorrectionEngine):
         ta = time.time()
         for it in range(num):
             t1 = time.time()
+            self._select_batch()
             error_dct = self.ML_model.new_grad()
             new_ob_grad, new_pr_grad = self.ob_grad_new, self.pr_grad_new
             tg += time.time() - t1
@@ -255,43 +334,56 @@ class ML(PositionCorrectionEngine):
                 self.scale_p_o = self.p.scale_probe_object
 
             ############################
-            # Compute next conjugate
+            # Compute next search direction
             ############################
-            if self.curiter == 0:
-                bt = 0.
+            if self.lbfgs is not None:
+                self.lbfgs.keep_gradient(self.ob_grad, self.pr_grad)
+                self.ob_grad << new_ob_grad
+                self.pr_grad << new_pr_grad
+                self.lbfgs.update(self.ob_grad, self.pr_grad)
+                self.lbfgs.direction(self.ob_grad, self.pr_grad,
+                                     self.ob_h, self.pr_h, self.scale_p_o,
+                                     self.smooth_gradient)
             else:
-                bt_num = (self.scale_p_o
-                          * (Cnorm2(new_pr_grad)
-                             - np.real(Cdot(new_pr_grad, self.pr_grad)))
-                          + (Cnorm2(new_ob_grad)
-                             - np.real(Cdot(new_ob_grad, self.ob_grad))))
+                if self.curiter == 0:
+                    bt = 0.
+                else:
+                    bt_num = (self.scale_p_o
+                              * (Cnorm2(new_pr_grad)
+                                 - np.real(Cdot(new_pr_grad, self.pr_grad)))
+                              + (Cnorm2(new_ob_grad)
+                                 - np.real(Cdot(new_ob_grad, self.ob_grad))))
 
-                bt_denom = self.scale_p_o*Cnorm2(self.pr_grad) + Cnorm2(self.ob_grad)
+                    bt_denom = self.scale_p_o*Cnorm2(self.pr_grad) + Cnorm2(self.ob_grad)
 
-                bt = max(0, bt_num/bt_denom)
+                    bt = max(0, bt_num/bt_denom)
+                    # gradients of different mini-batches can be far apart,
+                    # restart the conjugate directions if they are
+                    if self.batch is not None and bt > 1.:
+                        bt = 0.
 
-            # logger.info('Polak-Ribiere coefficient: %f ' % bt)
+                # logger.info('Polak-Ribiere coefficient: %f ' % bt)
 
-            self.ob_grad << new_ob_grad
-            self.pr_grad << new_pr_grad
+                self.ob_grad << new_ob_grad
+                self.pr_grad << new_pr_grad
 
-            dt = self.ptycho.FType
-            # 3. Next conjugate
-            self.ob_h *= bt / self.tmin
+                # 3. Next conjugate
+                self.ob_h *= bt / self.tmin
 
-            # Smoothing preconditioner
-            if self.smooth_gradient:
-                for name, s in self.ob_h.storages.items():
-                    s.data[:] -= self.smooth_gradient(self.ob_grad.storages[name].data)
-            else:
-                self.ob_h -= self.ob_grad
+                # Smoothing preconditioner
+                if self.smooth_gradient:
+                    for name, s in self.ob_h.storages.items():
+                        s.data[:] -= self.smooth_gradient(self.ob_grad.storages[name].data)
+                else:
+                    self.ob_h -= self.ob_grad
 
-            self.pr_h *= bt / self.tmin
-            self.pr_grad *= self.scale_p_o
-            self.pr_h -= self.pr_grad
+                self.pr_h *= bt / self.tmin
+                self.pr_grad *= self.scale_p_o
+                self.pr_h -= self.pr_grad
 
             # In principle, the way things are now programmed this part
             # could be iterated over in a real Newton-Raphson style.
+            dt = self.ptycho.FType
             t2 = time.time()
             if self.p.poly_line_coeffs == "all":
                 B = self.ML_model.poly_line_all_coeffs(self.ob_h, self.pr_h)
@@ -316,6 +408,8 @@ class ML(PositionCorrectionEngine):
             self.pr_h *= self.tmin
             self.ob += self.ob_h
             self.pr += self.pr_h
+            if self.lbfgs is not None:
+                self.lbfgs.store_step(self.ob_h, self.pr_h)
             # Newton-Raphson loop would end here
 
             # Position correction
@@ -327,10 +421,71 @@ class ML(PositionCorrectionEngine):
             # increase iteration counter
             self.curiter +=1
 
+        profiler.add_time('gradient', tg)
+        profiler.add_time('line_search', tc)
         logger.info('Time spent in gradient calculation: %.2f' % tg)
         logger.info('  ....  in coefficient calculation: %.2f' % tc)
         return error_dct  # np.array([[self.ML_model.LL[0]] * 3])
 
+    def _batch_fraction(self):
+        """
+        Fraction of the diffraction frames to use in this iteration.
+        """
+        f0 = self.p.minibatch_fraction
+        if f0 >= 1. or self.p.minibatch_schedule == 'constant':
+            return f0
+        t = min(self.curiter / float(self.p.minibatch_ramp), 1.)
+        if self.p.minibatch_schedule == 'linear':
+            return f0 + (1. - f0) * t
+        else:
+            return f0 ** (1. - t)
+
+    def _select_batch(self):
+        """
+        Draw the diffraction views used in this iteration.
+        """
+        fraction = self._batch_fraction()
+        if fraction >= 1.:
+            self.batch = None
+            self.batch_scale = 1.
+            return
+        names = [name for name, v in self.di.views.items() if v.active]
+        n = min(len(names), max(1, int(np.ceil(fraction * len(names)))))
+        self.batch = set(names[i] for i in self._draw_batch(len(names), n))
+        self._set_batch_scale(len(names), n)
+
+    def _draw_batch(self, nitems, n):
+        """
+        Indices of `n` out of `nitems` items for the next mini-batch,
+        according to ``minibatch_sampling``.
+        """
+        if self.p.minibatch_sampling == 'stratified':
+            edges = np.linspace(0, nitems, n + 1).astype(int)
+            return edges[:-1] + (np.random.random(n) * np.diff(edges)).astype(int)
+        elif self.p.minibatch_sampling == 'reshuffle':
+            total, queue = self._batch_queue or (None, None)
+            if total != nitems:
+                queue = np.random.permutation(nitems)
+            idx = queue[:n]
+            if idx.size < n:
+                # start a new pass through the data
+                queue = np.random.permutation(nitems)
+                queue = queue[~np.isin(queue, idx)]
+                idx = np.concatenate([idx, queue[:n - idx.size]])
+            queue = queue[~np.isin(queue, idx)]
+            self._batch_queue = (nitems, queue)
+            return idx
+        else:
+            return np.random.choice(nitems, n, replace=False)
+
+    def _set_batch_scale(self, ntotal, nbatch):
+        """
+        Ratio of all to selected frames across all nodes.
+        """
+        counts = np.array([ntotal, nbatch], dtype=np.float64)
+        parallel.allreduce(counts)
+        self.batch_scale = counts[0] / max(counts[1], 1.)
+
     def _post_iterate_update(self):
         """
         Enables modification at the end of each ML iteration.
@@ -353,6 +508,10 @@ class ML(PositionCorrectionEngine):
         del self.pr_grad_new
         del self.ptycho.containers[self.pr_h.ID]
         del self.pr_h
+        if self.lbfgs is not None:
+            for c in self.lbfgs.containers:
+                del self.ptycho.containers[c.ID]
+            self.lbfgs = None
 
         # Save floating intensities into runtime
         self.ptycho.runtime["float_intens"] = parallel.gather_dict(self.ML_model.float_intens_coeff)
@@ -426,6 +585,25 @@ class BaseModel(object):
             except:
                 pass
 
+    def _batch_views(self):
+        """
+        Active diffraction views of the current mini-batch.
+        """
+        batch = self.engine.batch
+        for dname, diff_view in self.di.views.items():
+            if diff_view.active and (batch is None or dname in batch):
+                yield dname, diff_view
+
+    def _batch_rescale(self, *sums):
+        """
+        Scale sums over the mini-batch (arrays or containers) in place
+        to estimates for all diffraction frames.
+        """
+        scale = self.engine.batch_scale
+        if scale != 1.:
+            for a in sums:
+                a *= scale
+
     def new_grad(self):
         """
         Compute a new gradient direction according to the noise model.
@@ -496,9 +674,7 @@ class GaussianModel(BaseModel):
         error_dct = {}
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and intensities for this view
             w = self.weights[diff_view]
@@ -539,6 +715,7 @@ class GaussianModel(BaseModel):
         self.ob_grad.allreduce()
         self.pr_grad.allreduce()
         parallel.allreduce(LL)
+        self._batch_rescale(self.ob_grad, self.pr_grad, LL)
 
         # Object regularizer
         if self.regularizer:
@@ -560,9 +737,7 @@ class GaussianModel(BaseModel):
         Brenorm = 1. / self.LL[0]**2
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and intensities for this view
             w = self.weights[diff_view]
@@ -605,6 +780,8 @@ class GaussianModel(BaseModel):
 
         parallel.allreduce(B)
 
+        self._batch_rescale(B)
+
         # Object regularizer
         if self.regularizer:
             for name, s in self.ob.storages.items():
@@ -631,9 +808,7 @@ class GaussianModel(BaseModel):
             Brenorm = 1. / self.LL[0]**2
 
             # Outer loop: through diffraction patterns
-            for dname, diff_view in self.di.views.items():
-                if not diff_view.active:
-                    continue
+            for dname, diff_view in self._batch_views():
 
                 # Weights and intensities for this view
                 w = self.weights[diff_view]
@@ -690,6 +865,8 @@ class GaussianModel(BaseModel):
 
             parallel.allreduce(B)
 
+            self._batch_rescale(B)
+
             # Object regularizer
             if self.regularizer:
                 for name, s in self.ob.storages.items():
@@ -739,9 +916,7 @@ class PoissonModel(BaseModel):
         error_dct = {}
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Mask and intensities for this view
             I = diff_view.data
@@ -782,6 +957,7 @@ class PoissonModel(BaseModel):
         self.ob_grad.allreduce()
         self.pr_grad.allreduce()
         parallel.allreduce(LL)
+        self._batch_rescale(self.ob_grad, self.pr_grad, LL)
 
         # Object regularizer
         if self.regularizer:
@@ -803,9 +979,7 @@ class PoissonModel(BaseModel):
         Brenorm = 1/(self.tot_measpts * self.LL[0])**2
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and intensities for this view
             I = diff_view.data
@@ -847,6 +1021,8 @@ class PoissonModel(BaseModel):
 
         parallel.allreduce(B)
 
+        self._batch_rescale(B)
+
         # Object regularizer
         if self.regularizer:
             for name, s in self.ob.storages.items():
@@ -872,9 +1048,7 @@ class PoissonModel(BaseModel):
         Brenorm = 1/(self.tot_measpts * self.LL[0])**2
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and intensities for this view
             I = diff_view.data
@@ -931,6 +1105,8 @@ class PoissonModel(BaseModel):
 
         parallel.allreduce(B)
 
+        self._batch_rescale(B)
+
         # Object regularizer
         if self.regularizer:
             for name, s in self.ob.storages.items():
@@ -995,9 +1171,7 @@ class EuclidModel(BaseModel):
         error_dct = {}
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and amplitudes for this view
             w = self.weights[diff_view]
@@ -1038,6 +1212,7 @@ class EuclidModel(BaseModel):
         self.ob_grad.allreduce()
         self.pr_grad.allreduce()
         parallel.allreduce(LL)
+        self._batch_rescale(self.ob_grad, self.pr_grad, LL)
 
         # Object regularizer
         if self.regularizer:
@@ -1059,9 +1234,7 @@ class EuclidModel(BaseModel):
         Brenorm = 1. / self.LL[0]**2
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and amplitudes for this view
             w = self.weights[diff_view]
@@ -1103,6 +1276,8 @@ class EuclidModel(BaseModel):
 
         parallel.allreduce(B)
 
+        self._batch_rescale(B)
+
         # Object regularizer
         if self.regularizer:
             for name, s in self.ob.storages.items():
@@ -1129,9 +1304,7 @@ class EuclidModel(BaseModel):
         Brenorm = 1. / self.LL[0]**2
 
         # Outer loop: through diffraction patterns
-        for dname, diff_view in self.di.views.items():
-            if not diff_view.active:
-                continue
+        for dname, diff_view in self._batch_views():
 
             # Weights and amplitudes for this view
             w = self.weights[diff_view]
@@ -1193,6 +1366,8 @@ class EuclidModel(BaseModel):
 
         parallel.allreduce(B)
 
+        self._batch_rescale(B)
+
         # Object regularizer
         if self.regularizer:
             for name, s in self.ob.storages.items():
@@ -1210,6 +1385,135 @@ class EuclidModel(BaseModel):
         return B
 
 
+class LBFGS(object):
+    """
+    Limited-memory BFGS search directions for the object and probe.
+
+    The last `memory` steps ``s`` and gradient changes ``y`` are kept in
+    copies of the object and probe containers. The initial inverse
+    Hessian is the probe/object scaling of the conjugate gradient,
+    rescaled with the most recent pair, and the smoothing
+    preconditioner on the object if there is one.
+    """
+
+    def __init__(self, ob, pr, memory):
+        self.memory = memory
+        slots = range(memory + 1)
+        self.ob_s = [ob.copy(ob.ID + '_lbfgs_s%d' % i, fill=0.) for i in slots]
+        self.ob_y = [ob.copy(ob.ID + '_lbfgs_y%d' % i, fill=0.) for i in slots]
+        self.pr_s = [pr.copy(pr.ID + '_lbfgs_s%d' % i, fill=0.) for i in slots]
+        self.pr_y = [pr.copy(pr.ID + '_lbfgs_y%d' % i, fill=0.) for i in slots]
+        self.containers = self.ob_s + self.ob_y + self.pr_s + self.pr_y
+
+        # (slot, 1 / <s, y>) of the accepted pairs, oldest first
+        self.pairs = []
+        # slot of the last step, waiting for its gradient change
+        self.slot = 0
+        self.pending = False
+
+    @staticmethod
+    def dot(ob1, pr1, ob2, pr2, scale=1.):
+        """
+        Real inner product of two object/probe pairs, the probe part
+        weighted with `scale`.
+        """
+        return np.real(Cdot(ob1, ob2)) + scale * np.real(Cdot(pr1, pr2))
+
+    def reset(self):
+        """
+        Forget the history.
+        """
+        self.pairs = []
+        self.pending = False
+
+    def store_step(self, ob_h, pr_h):
+        """
+        Keep the step that was just applied to object and probe.
+        """
+        self.ob_s[self.slot] << ob_h
+        self.pr_s[self.slot] << pr_h
+        self.pending = True
+
+    def keep_gradient(self, ob_grad, pr_grad):
+        """
+        Keep the gradient before the last step, to be called before it
+        is replaced by the new gradient.
+        """
+        if self.pending:
+            self.ob_y[self.slot] << ob_grad
+            self.pr_y[self.slot] << pr_grad
+
+    def update(self, ob_grad, pr_grad):
+        """
+        Complete the last step with the gradient change to `ob_grad`,
+        `pr_grad`. Pairs with non-positive curvature are dropped.
+        """
+        if not self.pending:
+            return
+        self.pending = False
+        i = self.slot
+        for y, g in ((self.ob_y[i], ob_grad), (self.pr_y[i], pr_grad)):
+            y *= -1.
+            y += g
+        sy = self.dot(self.ob_s[i], self.pr_s[i], self.ob_y[i], self.pr_y[i])
+        if not sy > 0:
+            return
+        self.pairs.append((i, 1. / sy))
+        if len(self.pairs) > self.memory:
+            self.pairs.pop(0)
+        used = [j for j, rho in self.pairs]
+        self.slot = [j for j in range(self.memory + 1) if j not in used][0]
+
+    def direction(self, ob_grad, pr_grad, ob_h, pr_h, scale_p_o=1., smooth=None):
+        """
+        Write the search direction for the gradient `ob_grad`, `pr_grad`
+        into `ob_h`, `pr_h` (two-loop recursion). `smooth` is applied to
+        the object arrays, like the smoothing of the conjugate direction.
+        Falls back to the scaled steepest descent and clears the history
+        if the result is not a descent direction.
+        """
+        ob_h << ob_grad
+        pr_h << pr_grad
+        alphas = []
+        for i, rho in reversed(self.pairs):
+            a = rho * self.dot(self.ob_s[i], self.pr_s[i], ob_h, pr_h)
+            _axpy(-a, self.ob_y[i], ob_h)
+            _axpy(-a, self.pr_y[i], pr_h)
+            alphas.append(a)
+
+        gamma = 1.
+        if self.pairs:
+            i, rho = self.pairs[-1]
+            gamma = 1. / (rho * self.dot(self.ob_y[i], self.pr_y[i],
+                                         self.ob_y[i], self.pr_y[i], scale_p_o))
+        ob_h *= gamma
+        pr_h *= gamma * scale_p_o
+        if smooth is not None:
+            for s in ob_h.storages.values():
+                s.data[:] = smooth(s.data)
+
+        for (i, rho), a in zip(self.pairs, reversed(alphas)):
+            b = rho * self.dot(self.ob_y[i], self.pr_y[i], ob_h, pr_h)
+            _axpy(a - b, self.ob_s[i], ob_h)
+            _axpy(a - b, self.pr_s[i], pr_h)
+        ob_h *= -1.
+        pr_h *= -1.
+
+        if self.pairs and not self.dot(ob_h, pr_h, ob_grad, pr_grad) < 0:
+            logger.debug('L-BFGS direction is not a descent direction, resetting history.')
+            self.reset()
+            self.direction(ob_grad, pr_grad, ob_h, pr_h, scale_p_o, smooth)
+
+
+def _axpy(a, x, y):
+    """
+    In-place ``y += a * x`` for containers `x` and `y`.
+    """
+    a = float(a)
+    for name, s in y.storages.items():
+        s.data += a * x.storages[name].data
+
+
 class Regul_del2(object):
     """\
     Squared gradient regularizer (Gaussian prior).
@@ -12,6 +12,7 @@ import numpy as np
 import time
 from .. import utils as u
 from ..utils import parallel
+from ..utils.profiling import profiler
 from ..utils.verbose import logger, headerline, log
 from .posref import AnnealingRefine, GridSearchRefine
 
@@ -71,11 +72,79 @@ class BaseEngine(object):
     help = If True, save the local map of errors into the runtime dictionary.
     userlevel = 2
 
+    [record_local_error_interval]
+    default = 1
+    type = int
+    lowlim = 1
+    help = Iteration interval for gathering the local map of errors
+    doc = With ``record_local_error``, the errors of all views are gathered on the master
+      process every this many iterations. In between, and without ``record_local_error``,
+      only the mean, minimum, maximum and a histogram of the errors are reduced.
+    userlevel = 2
+
+    [stopping]
+    default = Param
+    type = Param
+    help = Convergence-based early stopping
+    doc = Once all data is loaded, the engine finishes before ``numiter`` iterations if its error
+      has stopped decreasing or has reached a target value. The decision is taken on the master
+      process and shared with all processes.
+
+    [stopping.active]
+    default = False
+    type = bool
+    help = Activation switch
+    userlevel = 2
+
+    [stopping.metric]
+    default = auto
+    type = str
+    help = Error metric watched by the stopping policy
+    doc = One of the components of the reconstruction error:
+      - ``'fourier'`` : Fourier magnitude error
+      - ``'photon'`` : photon error, the log-likelihood for the ML engines
+      - ``'exit'`` : exit wave change
+      - ``'auto'`` : photon error if it is computed, else the Fourier error
+    choices = 'auto','fourier','photon','exit'
+    userlevel = 2
+
+    [stopping.rtol]
+    default = 1e-3
+    type = float
+    lowlim = 0.0
+    help = Minimal relative improvement over the patience window
+    doc = The engine stops if the lowest error of the last ``patience`` iterations is not
+      lower than ``(1 - rtol)`` times the lowest error before.
+    userlevel = 2
+
+    [stopping.patience]
+    default = 10
+    type = int
+    lowlim = 1
+    help = Number of iterations without sufficient improvement before stopping
+    userlevel = 2
+
+    [stopping.target]
+    default = None
+    type = float, None
+    help = Stop once the error is at or below this value
+    userlevel = 2
+
+    [stopping.carry_over]
+    default = False
+    type = bool
+    help = Add the iterations saved by stopping early to the next engine
+    doc = Only applies when :py:meth:`Ptycho.run` runs all engines in sequence.
+    userlevel = 2
+
     """
 
     # Define with which models this engine can work.
     COMPATIBLE_MODELS = []
 
+    # Logarithmic bins of the error histograms, a quarter decade wide
+    ERROR_HIST_EDGES = 10. ** np.arange(-8., 12.1, 0.25)
+
     def __init__(self, ptycho, pars=None):
         """
         Base reconstruction engine.
@@ -91,6 +160,10 @@ class BaseEngine(object):
         p = self.DEFAULT.copy()
         if pars is not None:
             p.update(pars)
+        # Fill in missing entries of the stopping policy
+        stopping = self.DEFAULT.stopping.copy()
+        stopping.update(p.stopping)
+        p.stopping = stopping
         self.p = p
 
         self.finished = False
@@ -110,6 +183,9 @@ class BaseEngine(object):
         self.probe_support = None
         self.t = None
         self.error = None
+        self.stop_reason = None
+        self._stop_history = []
+        self._benchmark_last = {}
 
     def initialize(self):
         """
@@ -123,6 +199,9 @@ class BaseEngine(object):
         logger.info(headerline('', 'l', '='))
 
         self.curiter = 0
+        self.stop_reason = None
+        self._stop_history = []
+        self._next_local_error = 0
         if self.ptycho.runtime.iter_info:
             self.alliter = self.ptycho.runtime.iter_info[-1]['iterations']
         else:
@@ -259,18 +338,26 @@ class BaseEngine(object):
         # Prepare runtime
         self._fill_runtime()
 
+        # Stop early if converged
+        if self.p.stopping.active and not self.finished:
+            self.finished = self._check_stopping(niter_contiguous)
+
+        # Stream timings and counters of this call
+        self._profile_record(niter_contiguous)
+
         parallel.barrier()
 
     def _fill_runtime(self):
         local_error = None
+        stats = None
         if isinstance(self.error, np.ndarray) and (len(self.error)== 3):
             error = self.error
         elif isinstance(self.error, dict):
-            local_error = u.parallel.gather_dict(self.error)
-            if local_error:
-                error = np.array(list(local_error.values())).mean(0)
-            else:
-                error = np.zeros((3,))
+            stats = self._error_statistics(self.error)
+            error = stats['mean']
+            if self.p.record_local_error and self.curiter >= self._next_local_error:
+                local_error = u.parallel.gather_dict(self.error)
+                self._next_local_error = self.curiter + self.p.record_local_error_interval
         else:
             logger.error("Reconstruction error should be dictionary or ndarray of shape (3,)")
         info = dict(
@@ -281,11 +368,113 @@ class BaseEngine(object):
             duration=time.time() - self.t,
             error=error
         )
+        if stats is not None:
+            info.update(error_min=stats['min'], error_max=stats['max'])
+            self.ptycho.runtime.error_hist = stats['hist']
+            self.ptycho.runtime.error_hist_edges = self.ERROR_HIST_EDGES
 
         self.ptycho.runtime.iter_info.append(info)
         if self.p.record_local_error and (local_error is not None):
             self.ptycho.runtime.error_local = local_error
 
+    def _check_stopping(self, num):
+        """
+        Evaluate the stopping policy after a call of :py:meth:`iterate`
+        with `num` iterations. The master process decides, such that all
+        processes stop at the same iteration.
+        """
+        reason = self._stop_criterion(num) if parallel.master else None
+        reason = parallel.bcast(reason)
+        if reason is None:
+            return False
+        self.stop_reason = reason
+        logger.info('%s stopped early after %d of %d iterations: %s'
+                    % (self.p.name, self.curiter, self.numiter, reason))
+        return True
+
+    def _stop_criterion(self, num):
+        """
+        Reason for stopping, or None. Watches the error of the latest entry
+        of the runtime's ``iter_info``.
+        """
+        p = self.p.stopping
+        # Only iterations on the complete data set count
+        if not self.ptycho.model.end_of_scan:
+            self._stop_history = []
+            return None
+        error = np.asarray(self.ptycho.runtime.iter_info[-1]['error'])
+        if p.metric == 'auto':
+            k = 1 if error[1] != 0 else 0
+        else:
+            k = ['fourier', 'photon', 'exit'].index(p.metric)
+        err = float(error[k])
+        if not np.isfinite(err):
+            return None
+        history = self._stop_history
+        history.append(err)
+
+        if p.target is not None and err <= p.target:
+            return 'error %.6g reached the target %.6g' % (err, p.target)
+
+        # Entries of the history within the patience window
+        n = int(np.ceil(p.patience / float(num)))
+        if len(history) > n and min(history[-n:]) > (1. - p.rtol) * min(history[:-n]):
+            return ('error improved by less than a fraction %g within %d iterations'
+                    % (p.rtol, n * num))
+        return None
+
+    def _profile_record(self, num):
+        """
+        Pass the duration of the last call of :py:meth:`iterate` and the
+        increments of the engine's ``benchmark`` timers to the profiler
+        and write a record.
+        """
+        if not profiler.active:
+            return
+        profiler.add_time('iterate', time.time() - self.t)
+        for name, value in getattr(self, 'benchmark', {}).items():
+            if not isinstance(value, (int, float)):
+                continue
+            last = self._benchmark_last.get(name, 0)
+            delta = value - last if value >= last else value
+            self._benchmark_last[name] = value
+            if name.startswith('calls'):
+                profiler.count(name, delta)
+            else:
+                profiler.add_time(name, delta)
+        profiler.record(event='iteration',
+                        engine=self.p.name,
+                        iteration=self.curiter,
+                        iterations=num,
+                        error=self.ptycho.runtime.iter_info[-1]['error'])
+
+    def _error_statistics(self, error):
+        """
+        Mean, minimum, maximum and histogram of the per-view errors in the
+        dict `error` over all processes, reduced with a single allreduce.
+
+        The histogram has one row per error component and counts errors
+        below, within and above the bins of ``ERROR_HIST_EDGES``.
+        """
+        errs = np.array(list(error.values()), dtype=np.float64).reshape(-1, 3)
+        nb = len(self.ERROR_HIST_EDGES) + 1
+        hist = np.zeros((3, nb))
+        for k in range(3):
+            hist[k] = np.bincount(np.searchsorted(self.ERROR_HIST_EDGES, errs[:, k]), minlength=nb)
+        if len(errs):
+            emax, emin = errs.max(0), errs.min(0)
+        else:
+            emax = emin = np.full((3,), -np.inf)
+            emin = -emin
+        # sum, count, histogram, maximum, -minimum
+        buf = np.concatenate([errs.sum(0), [len(errs)], hist.ravel(), emax, -emin])
+        parallel.allreduce_sum_max(buf, 6)
+        count = buf[3]
+        return dict(mean=buf[:3] / count if count else np.zeros((3,)),
+                    hist=buf[4:-6].reshape(3, nb),
+                    max=buf[-6:-3],
+                    min=-buf[-3:])
+
     def finalize(self):
         """
         Clean up after iterations are done.
@@ -388,6 +577,13 @@ class PositionCorrectionEngine(BaseEngine):
     default = False
     type = bool
     help = record movement of positions
+
+    [position_refinement.batch_size]
+    default = 64
+    type = int
+    lowlim = 1
+    help = Number of candidate positions evaluated together
+    doc = Candidate shifts of a view are propagated as one stack of this many object patches.
     """
 
     POSREF_ENGINES = {
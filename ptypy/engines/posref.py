@@ -63,10 +63,9 @@ class PositionRefine(object):
         np.float
             The calculated fourier error
         '''
-        af2 = np.zeros_like(di_view.data)
-        for name, pod in di_view.pods.items():
-            af2 += pod.downsample(u.abs2(pod.fw(pod.probe*obj)))
-        return np.sum(di_view.pod.mask * (np.sqrt(af2) - np.sqrt(np.abs(di_view.data)))**2) / di_view.pod.mask.sum()
+        af2 = self._model_intensity(di_view, obj)
+        return np.sum(di_view.pod.mask * (np.sqrt(af2) - np.sqrt(np.abs(di_view.data)))**2,
+                      axis=(-2, -1)) / di_view.pod.mask.sum()
 
     def estimate_photon_metric(self, di_view, obj):
         '''
@@ -84,10 +83,89 @@ class PositionRefine(object):
         np.float
             The calculated fourier error
         '''
-        af2 = np.zeros_like(di_view.data)
+        af2 = self._model_intensity(di_view, obj)
+        return (np.sum(di_view.pod.mask * (af2 - di_view.data)**2 / (di_view.data + 1.),
+                       axis=(-2, -1)) / np.prod(af2.shape[-2:]))
+
+    def _model_intensity(self, di_view, obj):
+        '''
+        Model intensity of `di_view` for the object patch `obj`, or for
+        each patch of a stack of patches with one batched propagation.
+        '''
+        if obj.ndim > di_view.data.ndim and not self._can_batch(di_view):
+            return np.array([self._model_intensity(di_view, o) for o in obj])
+        af2 = np.zeros(obj.shape[:-2] + di_view.data.shape[-2:],
+                       dtype=di_view.data.dtype)
         for name, pod in di_view.pods.items():
             af2 += pod.downsample(u.abs2(pod.fw(pod.probe*obj)))
-        return (np.sum(di_view.pod.mask * (af2 - di_view.data)**2 / (di_view.data + 1.)) / np.prod(af2.shape))
+        return af2
+
+    @staticmethod
+    def _can_batch(di_view):
+        '''
+        Whether the propagators of the pods of `di_view` act on stacks.
+        '''
+        for name, pod in di_view.pods.items():
+            crop_pad = getattr(pod.geometry.propagator, 'crop_pad', 0)
+            if pod.geometry.resample != 1 or np.any(crop_pad != 0):
+                return False
+        return True
+
+    def _candidate_patches(self, ob_view, coords):
+        '''
+        Cuts the object patches of `ob_view` at all positions `coords`
+        out of its storage, without moving the view.
+
+        Parameters
+        ----------
+        ob_view : ptypy.core.classes.View
+            The object view.
+
+        coords : numpy.ndarray
+            A (N, 2) array of candidate coordinates.
+
+        Returns
+        -------
+        numpy.ndarray, numpy.ndarray
+            The (M, ...) stack of patches of the M candidates that lie
+            within the storage, and their indices into `coords`.
+        '''
+        s = ob_view.storage
+        shape = ob_view.shape
+        # Same pixel arithmetic as Storage.update_views
+        dcoord = np.round(s._to_pix(coords) + 0.00001).astype(int)
+        dlow = dcoord - shape // 2
+        valid = np.flatnonzero((dlow >= 0).all(axis=1)
+                               & (dlow + shape <= s.shape[-2:]).all(axis=1))
+        rows = dlow[valid, 0, None] + np.arange(shape[0])
+        cols = dlow[valid, 1, None] + np.arange(shape[1])
+        patches = s.data[ob_view.dlayer][rows[:, :, None], cols[:, None, :]]
+        return patches, valid
+
+    def _best_candidate(self, di_view, coords, error):
+        '''
+        Evaluates the error metric for all candidate coordinates `coords`
+        of the object view of `di_view` in batches of candidates.
+
+        Returns
+        -------
+        int, float
+            The index of the first candidate with the lowest error below
+            `error` (None if there is none) and its error.
+        '''
+        ob_view = di_view.pod.ob_view
+        best = None
+        for start in range(0, len(coords), self.p.batch_size):
+            chunk = coords[start:start + self.p.batch_size]
+            patches, valid = self._candidate_patches(ob_view, chunk)
+            if len(valid) == 0:
+                continue
+            errors = self.fourier_error(di_view, patches)
+            i = np.argmin(errors)
+            if errors[i] < error:
+                error = errors[i]
+                best = start + valid[i]
+        return best, error
 
     def cleanup(self):
         '''
@@ -170,6 +248,7 @@ class AnnealingRefine(PositionRefine):
         # This can be optimized by saving existing iteration fourier error...
         error = self.fourier_error(di_view, ob_view.data)
         
+        deltas = []
         for i in range(self.p.nshifts):
             # Generate coordinate shift in one of the 4 cartesian quadrants
             a, b = np.random.uniform(np.max(psize), self.max_shift_dist, 2)
@@ -178,24 +257,15 @@ class AnnealingRefine(PositionRefine):
             if np.linalg.norm(delta) > self.p.max_shift:
                 # Positions drifted too far, skip this position
                 continue
-
-            # Move view to new position
-            new_coord = initial_coord + delta 
-            ob_view.coord = new_coord
-            ob_view.storage.update_views(ob_view)
-            data = ob_view.data
-            
-            # catch bad slicing
-            if not np.allclose(data.shape, ob_view.shape):
-                continue 
-                
-            new_error = self.fourier_error(di_view, data)
-
-            if new_error < error:
-                # keep
-                error = new_error
-                coord = new_coord
-                log(4, "Position correction: %s, coord: %s, delta: %s" % (di_view.ID, coord, delta))
+            deltas.append(delta)
+
+        # Evaluate all shifts at once, the view only moves to the winner
+        if deltas:
+            deltas = np.array(deltas)
+            best, error = self._best_candidate(di_view, initial_coord + deltas, error)
+            if best is not None:
+                coord = initial_coord + deltas[best]
+                log(4, "Position correction: %s, coord: %s, delta: %s" % (di_view.ID, coord, deltas[best]))
           
         ob_view.coord = coord
         ob_view.storage.update_views(ob_view)        
@@ -283,27 +353,11 @@ class GridSearchRefine(PositionRefine):
         within_bound = (deltas[0]**2 + deltas[1]**2) < (max_bound_pix**2)
         deltas = (deltas[:,within_bound] * np.min(psize)).T
 
-        for i in range(deltas.shape[0]):
-            # Current shift
-            delta = deltas[i]
-
-            # Move view to new position
-            new_coord = initial_coord + delta 
-            ob_view.coord = new_coord
-            ob_view.storage.update_views(ob_view)
-            data = ob_view.data
-            
-            # catch bad slicing
-            if not np.allclose(data.shape, ob_view.shape):
-                continue 
-                
-            new_error = self.fourier_error(di_view, data)
-
-            if new_error < error:
-                # keep
-                error = new_error
-                coord = new_coord
-                log(4, "Position correction: %s, coord: %s, delta: %s" % (di_view.ID, coord, delta))
+        # Evaluate the whole grid, the view only moves to the winner
+        best, error = self._best_candidate(di_view, initial_coord + deltas, error)
+        if best is not None:
+            coord = initial_coord + deltas[best]
+            log(4, "Position correction: %s, coord: %s, delta: %s" % (di_view.ID, coord, deltas[best]))
      
         ob_view.coord = coord
         ob_view.storage.update_views(ob_view)        
@@ -12,6 +12,7 @@ import time
 from .. import utils as u
 from ..utils.verbose import logger, log
 from ..utils import parallel
+from ..utils.profiling import profiler
 from .utils import projection_update_generalized, log_likelihood
 from . import register
 from .base import PositionCorrectionEngine
@@ -217,6 +218,9 @@ class _ProjectionEngine(PositionCorrectionEngine):
             # count up
             self.curiter +=1
 
+        profiler.add_time('fourier_update', tf)
+        profiler.add_time('overlap_update', to)
+        profiler.add_time('position_update', tp)
         logger.info('Time spent in Fourier update: %.2f' % tf)
         logger.info('Time spent in Overlap update: %.2f' % to)
         logger.info('Time spent in Position update: %.2f' % tp)
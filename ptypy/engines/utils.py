@@ -11,7 +11,6 @@ This file is part of the PTYPY package.
 import numpy as np
 from .. import utils as u
 from .. import parallel
-from scipy.sparse.linalg import eigsh
 
 # This dynamic loas could easily be generalized to other types.
 def dynamic_load(path, baselist, fail_silently = True):
@@ -492,6 +491,7 @@ def reduce_dimension(a, dim, local_indices=None):
     parallel.allreduce(M)
 
     # Diagonalise the matrix
+    from scipy.sparse.linalg import eigsh
     eigval, eigvec = eigsh(M, k=dim + 2, which='LM')
 
     # Generate the modes
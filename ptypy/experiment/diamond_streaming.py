@@ -14,6 +14,8 @@ import numpy as np
 from ptypy import utils as u
 from ptypy.core.data import PtyScan
 from ptypy.experiment import register
+from ptypy.experiment.zmq_receiver import FrameRingBuffer, ZmqReceiver
+from ptypy.utils import parallel
 from ptypy.utils.verbose import log
 
 @register()
@@ -40,7 +42,15 @@ class DiamondZMQLoader(PtyScan):
     [chunksize]
     default = 50
     type = int
-    help = Nr. of frames (chunks) to be pulled at once from the socket
+    help = Deprecated, frames are received continuously by a background thread
+
+    [buffer_size]
+    default = 500
+    type = int
+    lowlim = 1
+    help = Nr. of frames held in the receive buffer
+    doc = Frames are received into a ring buffer of this many frames and released once
+      they have been loaded. Reception pauses while the buffer is full.
 
     [logfile]
     default = /tmp/ptypy_streaming_log.json
@@ -53,24 +63,25 @@ class DiamondZMQLoader(PtyScan):
         self.p.update(pars, in_place_depth=99)
         super().__init__(self.p, **kwargs)
 
+        # Frames are only received by the master process,
+        # which distributes them to the other processes in load()
+        self.load_in_parallel = False
+
         # ZMQ Context
         self.context = zmq.Context()
-        
+
         # Create socket to request some information and ask for metadata
-        self.metadata_socket = self.context.socket(zmq.REQ) 
-        self.metadata_socket.connect(self.p.metadata)
-        
-        # Socket to pull main data
-        self.datastream_socket = self.context.socket(zmq.PULL)
-        self.datastream_socket.connect(self.p.datastream)
-        self.connected = True
-
-        # Meta information
-        self.metadata_socket.send(b"Start")
-        log(4, 'Waiting for metadata...')
-        self.metadata = pickle.loads(self.metadata_socket.recv())
-        log(4, "Metadata recieved")
-        
+        self.metadata = None
+        if parallel.master:
+            self.metadata_socket = self.context.socket(zmq.REQ)
+            self.metadata_socket.connect(self.p.metadata)
+            self.metadata_socket.send(b"Start")
+            log(4, 'Waiting for metadata...')
+            self.metadata = pickle.loads(self.metadata_socket.recv())
+            log(4, "Metadata recieved")
+        self.metadata = parallel.bcast(self.metadata)
+        self.connected = parallel.master
+
         # Setting meta/info parameters
         self.data_dtype = self.metadata["dtype"]
         self.data_shape = self.metadata["shape"]
@@ -84,24 +95,37 @@ class DiamondZMQLoader(PtyScan):
         self.meta.distance = self.p.distance
         self.info.psize = self.p.psize
 
-        # Create empty memory
-        self._data = np.empty(shape=self.data_shape, dtype=self.data_dtype)
-        self._pos = np.empty(shape=(self.data_shape[0], 2), dtype=float)
-        self.framecount = 0
-
         # Logging
         self.log = {}
         self.log["start"] = time.time()
-        
-    def fetch(self,chunksize=1):
-        if not self.connected:
-            return
-        # Fetch data from socket
-        for i in range(chunksize):
-            databuf, posxbuf, posybuf = self.datastream_socket.recv_multipart()
-            self._data[self.framecount] = np.frombuffer(databuf,dtype=self.data_dtype).reshape(self.frame_shape)
-            self._pos[self.framecount] = np.array([float(posybuf.decode()), float(posxbuf.decode())])
-            self.framecount += 1
+
+        # Receive frames in the background into preallocated memory
+        self.buffer = None
+        self.receiver = None
+        if parallel.master:
+            self.buffer = FrameRingBuffer(min(self.num_frames, self.p.buffer_size),
+                                          self.frame_shape, self.data_dtype)
+            self.receiver = ZmqReceiver(self.context, self._connect, self._receive, self.buffer)
+            self.receiver.start()
+
+    def _connect(self, context):
+        # Socket to pull main data, created in the receiver thread
+        socket = context.socket(zmq.PULL)
+        socket.connect(self.p.datastream)
+        return [socket]
+
+    def _receive(self, n, parts):
+        databuf, posxbuf, posybuf = parts
+        frame = self.buffer.next_frame()
+        if frame is None:
+            return True
+        frame[:] = np.frombuffer(databuf, dtype=self.data_dtype).reshape(self.frame_shape)
+        self.buffer.commit_frame((float(posybuf.decode()), float(posxbuf.decode())))
+        return self.buffer.num_frames == self.num_frames
+
+    @property
+    def framecount(self):
+        return self.buffer.available
 
     def check(self, frames=None, start=None):
         """
@@ -132,26 +156,25 @@ class DiamondZMQLoader(PtyScan):
         if frames is None:
             frames = self.min_frames
 
-        if (self.num_frames - self.framecount) > self.p.chunksize:
-            chunksize = self.p.chunksize
-        else:
-            chunksize = 1
-        self.fetch(chunksize)
-            
         # Check how many frames are available
         available = self.framecount
-        new_frames = available - start        
+        new_frames = available - start
         # not reached expected nr. of frames
         if new_frames <= frames:
             # but its last chunk of scan so load it anyway
-            if available == self.num_frames:
-                frames_accessible = new_frames    
+            if available == self.num_frames or self.buffer.finished:
+                frames_accessible = new_frames
                 end_of_scan = 1
                 if self.connected:
                     self.finish()
                     # end all ZMQ communications
+                    self.receiver.stop()
                     self.context.destroy()
-                    self.connected = False                    
+                    self.connected = False
+            # or the buffer is full and needs to be emptied
+            elif self.buffer.full:
+                frames_accessible = new_frames
+                end_of_scan = 0
             # otherwise, do nothing
             else:
                 end_of_scan = 0
@@ -175,17 +198,15 @@ class DiamondZMQLoader(PtyScan):
             and whose values are the respective frame / position according
             to the scan point index. `weight` and `positions` may be empty
         """
-        intensities = {}
-        positions = {}
         weights = {}
         log(4, "Loading...")
         log(4, f"indices = {indices}")
+        intensities, positions = self.buffer.get(indices)
         for ind in indices:
-            intensities[ind] = self._data[ind]
-            positions[ind] = self._pos[ind]
             weights[ind] = np.ones(len(intensities[ind]))
-            #print(f"Loaded index {ind} with pos {positions[ind]} and data {intensities[ind].sum()}")
-                        
+        if len(indices):
+            self.buffer.release(max(indices) + 1)
+
         return intensities, positions, weights
 
     def finish(self):
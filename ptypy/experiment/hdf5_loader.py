@@ -19,6 +19,7 @@ from ptypy.utils.verbose import log
 from ptypy.utils.array_utils import _translate_to_pix
 
 import os
+import copy
 from multiprocessing import Pool, RawArray
 
 @register()
@@ -909,6 +910,23 @@ class Hdf5Loader(PtyScan):
 
 @register()
 class Hdf5LoaderFast(Hdf5Loader):
+    """
+    Hdf5Loader reading frames with a pool of worker processes into
+    shared memory. The pool and the shared buffers are kept alive for
+    the lifetime of the scan.
+
+    Defaults:
+
+    [prefetch]
+    default = False
+    type = bool
+    help = Read the next chunk of frames in the background
+    doc = While the current chunk is being processed, the worker pool already
+      reads the frames that are expected to be requested next into a second
+      shared buffer. If the guess turns out to be wrong, the frames are read
+      as usual.
+    """
+
     def __init__(self, pars=None, **kwargs):
         super().__init__(pars=pars, **kwargs)
         self.cpu_count_per_rank = max(len(os.sched_getaffinity(0)) // parallel.size,1)
@@ -916,6 +934,24 @@ class Hdf5LoaderFast(Hdf5Loader):
         self.intensities_array = None
         self.weights_array = None
 
+        # Worker pool and shared buffers, (re)created when more
+        # frames than `_capacity` are requested at once
+        self._pool = None
+        self._capacity = 0
+        self._intensities_raw_arrays = []
+        self._weights_raw_arrays = []
+        self._buffer_id = 0
+
+        # Pending prefetch as (src_slices, buffer_id, async result)
+        self._prefetch = None
+
+        # Slice generator matching the load method chosen in Hdf5Loader
+        self._frame_slices = {
+            'load_unmapped_raster_scan': self._unmapped_raster_slices,
+            'load_mapped_and_raster_scan': self._mapped_raster_slices,
+            'load_mapped_and_arbitrary_scan': self._mapped_arbitrary_slices,
+        }.get(getattr(self.load, '__name__', None))
+
     @staticmethod
     def subtract_dark(raw, dark):
         """
@@ -927,7 +963,7 @@ class Hdf5LoaderFast(Hdf5Loader):
         return corr
 
     @staticmethod
-    def _init_worker(intensities_raw_array, weights_raw_array,
+    def _init_worker(intensities_raw_arrays, weights_raw_arrays,
                      intensities_handle,
                      weights_handle,
                      darkfield_handle,
@@ -938,9 +974,11 @@ class Hdf5LoaderFast(Hdf5Loader):
                      darkfield_laid_out_like_data,
                      flatfield_laid_out_like_data):
         Hdf5LoaderFast.worker_intensities_handle = intensities_handle
-        Hdf5LoaderFast.worker_intensities_array = np.frombuffer(intensities_raw_array, intensities_dtype, -1).reshape(array_shape)
+        Hdf5LoaderFast.worker_intensities_arrays = [np.frombuffer(raw, intensities_dtype, -1).reshape(array_shape)
+                                                    for raw in intensities_raw_arrays]
         Hdf5LoaderFast.worker_weights_handle = weights_handle
-        Hdf5LoaderFast.worker_weights_array = np.frombuffer(weights_raw_array, weights_dtype, -1).reshape(array_shape) if weights_raw_array else None
+        Hdf5LoaderFast.worker_weights_arrays = [np.frombuffer(raw, weights_dtype, -1).reshape(array_shape) if raw else None
+                                                for raw in weights_raw_arrays]
         Hdf5LoaderFast.worker_mask_laid_out_like_data = mask_laid_out_like_data
         Hdf5LoaderFast.worker_darkfield_handle = darkfield_handle
         Hdf5LoaderFast.worker_darkfield_laid_out_like_data = darkfield_laid_out_like_data
@@ -953,16 +991,16 @@ class Hdf5LoaderFast(Hdf5Loader):
         Copy intensities/weights into memory and correct for
         darkfield/flatfield if they exist
         '''
-        indexed_frame_slices, dest_slices = slices
+        indexed_frame_slices, dest_slices, buffer_id = slices
         frame_slices = tuple(np.array(indexed_frame_slices)[-2:])
 
         # Handle / target array for intensities
         src_intensities  = Hdf5LoaderFast.worker_intensities_handle
-        dest_intensities = Hdf5LoaderFast.worker_intensities_array
+        dest_intensities = Hdf5LoaderFast.worker_intensities_arrays[buffer_id]
 
         # Handle / target array for mask/weights
         src_weights  = Hdf5LoaderFast.worker_weights_handle
-        dest_weights = Hdf5LoaderFast.worker_weights_array
+        dest_weights = Hdf5LoaderFast.worker_weights_arrays[buffer_id]
         mask_laid_out_like_data = Hdf5LoaderFast.worker_mask_laid_out_like_data
 
         # Handle for darkfield
@@ -996,42 +1034,127 @@ class Hdf5LoaderFast(Hdf5Loader):
             else:
                 dest_intensities[dest_slices] /= src_flatfield[frame_slices].squeeze()
 
-    def _setup_raw_intensity_buffer(self, dtype, sh):
-        npixels = int(np.prod(sh))
-        if (self.intensities_array is not None) and (self.intensities_array.size == npixels):
+    def _setup_pool(self, nframes):
+        """
+        Make sure the shared buffers hold at least `nframes` frames.
+        Buffers and worker pool are only recreated if they are too small.
+        """
+        if self._pool is not None and nframes <= self._capacity:
             return
-        self._intensities_raw_array = RawArray(np.ctypeslib.as_ctypes_type(dtype), npixels)
-        self.intensities_array = np.frombuffer(self._intensities_raw_array, self.intensities_dtype, -1).reshape(sh)
-
-    def _setup_raw_weights_buffer(self, dtype, sh):
+        self._close_pool()
+        self._capacity = nframes
+        sh = (nframes,) + tuple(self.frame_shape)
         npixels = int(np.prod(sh))
-        if (self.weights_array is not None) and (self.weights_array.size == npixels):
-            return
+        nbuffers = 2 if self.p.prefetch else 1
+        self._intensities_raw_arrays = [RawArray(np.ctypeslib.as_ctypes_type(self.intensities_dtype), npixels)
+                                        for i in range(nbuffers)]
         if self.mask is not None:
-            self._weights_raw_array = RawArray(np.ctypeslib.as_ctypes_type(dtype), npixels)
-            self.weights_array = np.frombuffer(self._weights_raw_array, dtype, -1).reshape(sh)
+            self._weights_raw_arrays = [RawArray(np.ctypeslib.as_ctypes_type(self.mask_dtype), npixels)
+                                        for i in range(nbuffers)]
         else:
-            self._weights_raw_array = None
-            self.weights_array = np.ones(sh, dtype=int)
+            self._weights_raw_arrays = [None] * nbuffers
+        self._buffer_id = 0
+        self._pool = Pool(self.cpu_count_per_rank,
+                          initializer=Hdf5LoaderFast._init_worker,
+                          initargs=(self._intensities_raw_arrays, self._weights_raw_arrays,
+                                    self.intensities, self.mask, self.darkfield, self.flatfield,
+                                    self.intensities_dtype, self.mask_dtype,
+                                    sh, self.mask_laid_out_like_data,
+                                    self.darkfield_laid_out_like_data,
+                                    self.flatfield_field_laid_out_like_data))
+
+    def _close_pool(self):
+        """
+        Shut down the worker pool, discarding any pending prefetch.
+        """
+        if self._prefetch is not None:
+            self._prefetch[2].wait()
+            self._prefetch = None
+        if self._pool is not None:
+            self._pool.close()
+            self._pool.join()
+            self._pool = None
+
+    def _buffer_arrays(self, buffer_id, nframes):
+        sh = (self._capacity,) + tuple(self.frame_shape)
+        intensities = np.frombuffer(self._intensities_raw_arrays[buffer_id], self.intensities_dtype, -1).reshape(sh)
+        if self._weights_raw_arrays[buffer_id] is not None:
+            weights = np.frombuffer(self._weights_raw_arrays[buffer_id], self.mask_dtype, -1).reshape(sh)[:nframes]
+        else:
+            weights = np.ones((nframes,) + tuple(self.frame_shape), dtype=int)
+        return intensities[:nframes], weights
 
-    def load_multiprocessing(self, src_slices):
-        sh = (len(src_slices),) + self.frame_shape
-        self._setup_raw_intensity_buffer(self.intensities_dtype, sh)
-        self._setup_raw_weights_buffer(self.mask_dtype, sh)
+    def _read_async(self, src_slices, buffer_id):
         dest_slices = [np.s_[i:i+1] for i in range(len(src_slices))]
+        return self._pool.map_async(self._read_intensities_and_weights,
+                                    zip(src_slices, dest_slices, [buffer_id] * len(src_slices)))
 
-        with Pool(self.cpu_count_per_rank,
-                  initializer=Hdf5LoaderFast._init_worker,
-                  initargs=(self._intensities_raw_array, self._weights_raw_array,
-                            self.intensities, self.mask, self.darkfield, self.flatfield,
-                            self.intensities_dtype, self.mask_dtype,
-                            sh, self.mask_laid_out_like_data,
-                            self.darkfield_laid_out_like_data,
-                            self.flatfield_field_laid_out_like_data)) as p:
-            p.map(self._read_intensities_and_weights, zip(src_slices, dest_slices))
+    def load_multiprocessing(self, src_slices):
+        """
+        Read the frames of `src_slices` into ``intensities_array`` and
+        ``weights_array``. These are copies, the shared buffers are
+        overwritten by the next prefetch.
+        """
+        self._setup_pool(len(src_slices))
 
-    def load_unmapped_raster_scan(self, indices):
+        prefetched = False
+        if self._prefetch is not None:
+            slices, buffer_id, result = self._prefetch
+            self._prefetch = None
+            try:
+                result.get()
+                if slices == src_slices:
+                    self._buffer_id = buffer_id
+                    prefetched = True
+            except Exception as e:
+                log(2, 'Prefetching frames failed (%s), reading them again.' % e)
+
+        if not prefetched:
+            self._read_async(src_slices, self._buffer_id).get()
+
+        intensities, weights = self._buffer_arrays(self._buffer_id, len(src_slices))
+        self.intensities_array = intensities.copy()
+        self.weights_array = weights.copy() if self._weights_raw_arrays[self._buffer_id] is not None else weights
+
+    def _next_indices(self):
+        """
+        Predict the indices the next call to load() is going to ask for,
+        following the logic of PtyScan.get_data_chunk.
+        """
+        indices = getattr(self, 'indices', None)
+        if indices is None:
+            return []
+        start = self.framestart
+        step = min(len(indices.chunk), self.num_frames - start)
+        if step <= 0:
+            return []
+        chunk = list(range(start, start + step))
+        if not self.load_in_parallel:
+            return chunk
+        lm = copy.deepcopy(parallel.loadmanager)
+        return [chunk[k] for k in lm.assign(chunk)[parallel.rank]]
+
+    def _start_prefetch(self):
+        """
+        Start reading the next chunk into the buffer that is not in use.
+        """
+        if not self.p.prefetch or self._frame_slices is None:
+            return
+        next_indices = self._next_indices()
+        if not next_indices or len(next_indices) > self._capacity:
+            return
+        slices = self._frame_slices(next_indices)
+        buffer_id = 1 - self._buffer_id
+        self._prefetch = (slices, buffer_id, self._read_async(slices, buffer_id))
+
+    def _finalize(self):
+        """
+        Close the worker pool and any open HDF5 files.
+        """
+        self._close_pool()
+        super()._finalize()
 
+    def _unmapped_raster_slices(self, indices):
         slices = []
         for ii in indices:
             slow_idx, fast_idx = self.preview_indices[:, ii]
@@ -1041,7 +1164,33 @@ class Hdf5LoaderFast(Hdf5Loader):
             if self._is_spectro_scan and self.p.outer_index is not None:
                 indexed_frame_slices = (self.p.outer_index,) + indexed_frame_slices
             slices.append(indexed_frame_slices)
+        return slices
 
+    def _mapped_raster_slices(self, indices):
+        slices = []
+        for ii in indices:
+            index = self.preview_indices[:, ii]
+            indexed_frame_slices = tuple(index)
+            indexed_frame_slices += self.frame_slices
+            if self._is_spectro_scan and self.p.outer_index is not None:
+                indexed_frame_slices = (self.p.outer_index,) + indexed_frame_slices
+            slices.append(indexed_frame_slices)
+        return slices
+
+    def _mapped_arbitrary_slices(self, indices):
+        slices = []
+        for ii in indices:
+            jj = self.preview_indices[ii]
+            indexed_frame_slices = (jj,)
+            indexed_frame_slices += self.frame_slices
+            if self._is_spectro_scan and self.p.outer_index is not None:
+                indexed_frame_slices = (self.p.outer_index,) + indexed_frame_slices
+            slices.append(indexed_frame_slices)
+        return slices
+
+    def load_unmapped_raster_scan(self, indices):
+
+        slices = self._unmapped_raster_slices(indices)
         self.load_multiprocessing(slices)
 
         intensities = {}
@@ -1052,20 +1201,13 @@ class Hdf5LoaderFast(Hdf5Loader):
             weights[ii], intensities[ii] = self.get_corrected_intensities(self.weights_array[k], self.intensities_array[k], ii, slices[k])
             positions[ii] = np.array([self.slow_axis[slow_idx, fast_idx] * self.p.positions.slow_multiplier,
                                       self.fast_axis[slow_idx, fast_idx] * self.p.positions.fast_multiplier])
+        self._start_prefetch()
         log(3, 'Data loaded successfully.')
         return intensities, positions, weights
 
     def load_mapped_and_raster_scan(self, indices):
 
-        slices = []
-        for ii in indices:
-            index = self.preview_indices[:, ii]
-            indexed_frame_slices = tuple(index)
-            indexed_frame_slices += self.frame_slices
-            if self._is_spectro_scan and self.p.outer_index is not None:
-                indexed_frame_slices = (self.p.outer_index,) + indexed_frame_slices
-            slices.append(indexed_frame_slices)
-
+        slices = self._mapped_raster_slices(indices)
         self.load_multiprocessing(slices)
 
         intensities = {}
@@ -1076,20 +1218,13 @@ class Hdf5LoaderFast(Hdf5Loader):
             weights[ii], intensities[ii] = self.get_corrected_intensities(self.weights_array[k], self.intensities_array[k], ii, slices[k])
             positions[ii] = np.array([self.slow_axis[slow_idx, fast_idx] * self.p.positions.slow_multiplier,
                                       self.fast_axis[slow_idx, fast_idx] * self.p.positions.fast_multiplier])
+        self._start_prefetch()
         log(3, 'Data loaded successfully.')
         return intensities, positions, weights
 
     def load_mapped_and_arbitrary_scan(self, indices):
 
-        slices = []
-        for ii in indices:
-            jj = self.preview_indices[ii]
-            indexed_frame_slices = (jj,)
-            indexed_frame_slices += self.frame_slices
-            if self._is_spectro_scan and self.p.outer_index is not None:
-                indexed_frame_slices = (self.p.outer_index,) + indexed_frame_slices
-            slices.append(indexed_frame_slices)
-
+        slices = self._mapped_arbitrary_slices(indices)
         self.load_multiprocessing(slices)
 
         intensities = {}
@@ -1100,6 +1235,7 @@ class Hdf5LoaderFast(Hdf5Loader):
             weights[ii], intensities[ii] = self.get_corrected_intensities(self.weights_array[k], self.intensities_array[k], ii, slices[k])
             positions[ii] = np.array([self.slow_axis[jj] * self.p.positions.slow_multiplier,
                                       self.fast_axis[jj] * self.p.positions.fast_multiplier])
+        self._start_prefetch()
         log(3, 'Data loaded successfully.')
         return intensities, positions, weights
 
@@ -6,26 +6,38 @@ https://github.com/alexbjorling/contrast
 import numpy as np
 import zmq
 from zmq.utils import jsonapi as json
-import time
-import bitshuffle
+import pickle
 import struct
 
 from ..core.data import PtyScan
 from .. import utils as u
 from . import register
+from .zmq_receiver import FrameRingBuffer, ZmqReceiver
 from ..utils import parallel
 
 logger = u.verbose.logger
 
+# Only needed for frames from a separate detector stream
+bitshuffle = u.lazy_import('bitshuffle')
 
-def decompress(data, shape, dtype):
+
+def decompress(data, shape, dtype, out=None):
+    """
+    Decompresses a bslz4 frame, which starts with a 12 byte header of
+    the uncompressed size (uint64) and the block size in bytes (uint32),
+    both big-endian. bitshuffle has no output argument, so with `out`
+    the frame is decompressed into a temporary array and copied.
+    """
     block_size = struct.unpack('>I', data[8:12])[0] // dtype.itemsize
     data = np.frombuffer(data[12:], np.int8)
     output = bitshuffle.decompress_lz4(arr=data,
                                        shape=shape,
                                        dtype=dtype,
                                        block_size=block_size)
-    return output
+    if out is None:
+        return output
+    out[:] = output
+    return out
 
 
 @register()
@@ -82,83 +94,109 @@ class NanomaxZmqScan(PtyScan):
     help = Take images from a separate stream - port
     doc =
 
+    [buffer_size]
+    default = 500
+    type = int
+    lowlim = 1
+    help = Nr. of frames held in the receive buffer
+    doc = Frames and positions are received into a ring buffer of this many frames and
+      released once they have been loaded. Frame reception pauses while the buffer is
+      full, positions from a separate stream are always received.
+
     """
 
     def __init__(self, *args, **kwargs):
         super(NanomaxZmqScan, self).__init__(*args, **kwargs)
         self.context = zmq.Context()
 
-        # main socket
-        socket = self.context.socket(zmq.SUB)
-        socket.connect("tcp://%s:%u" % (self.info.host, self.info.port))
-        socket.setsockopt(zmq.SUBSCRIBE, b"") # subscribe to all topics
-        self.socket = socket
-
         # separate detector socket
         self.stream_images = None not in (self.info.detector_host,
                                           self.info.detector_port)
-        if self.stream_images and parallel.master:
-            det_socket = self.context.socket(zmq.PULL)
+        self.end_of_stream = False
+
+        # Frames and positions are received in the background on the master node
+        self.buffer = None
+        self.receiver = None
+        if parallel.master:
+            self.buffer = FrameRingBuffer(self.info.buffer_size)
+            self.receiver = ZmqReceiver(self.context, self._connect, self._receive, self.buffer,
+                                        paused=self._paused)
+            self.receiver.start()
+
+    def _connect(self, context):
+        """
+        Create the sockets in the receiver thread.
+        """
+        # main socket
+        socket = context.socket(zmq.SUB)
+        socket.connect("tcp://%s:%u" % (self.info.host, self.info.port))
+        socket.setsockopt(zmq.SUBSCRIBE, b"") # subscribe to all topics
+        sockets = [socket]
+        if self.stream_images:
+            det_socket = context.socket(zmq.PULL)
             det_socket.connect("tcp://%s:%u" % (self.info.detector_host, self.info.detector_port))
-            self.det_socket = det_socket
+            sockets.append(det_socket)
+        return sockets
 
-        self.latest_pos_index_received = -1
-        self.latest_det_index_received = -1
-        self.incoming = {}
-        self.incoming_det = {}
+    def _paused(self, n):
+        """
+        Leave the detector socket (n=1) unread while no frame slot is free,
+        the main socket keeps delivering the positions that free them.
+        """
+        return n == 1 and self.buffer.full
 
-    def check(self, frames=None, start=None):
+    def _receive(self, n, parts):
         """
-        Only called on the master node.
+        Store a message from the main (n=0) or detector (n=1) socket,
+        returns True once the scan is complete.
         """
-        end_of_scan, end_of_det_stream = False, False
-
-        # get all frames from the main socket
-        while True:
-            try:
-                msg = self.socket.recv_pyobj(flags=zmq.NOBLOCK)
-                headers = ('path' in msg.keys())
-                if not headers:
-                    self.latest_pos_index_received += 1
-                    self.incoming[self.latest_pos_index_received] = msg
-                elif msg['path'] in ('interrupted', 'finished'):
-                    end_of_scan = True
-                    break
-            except zmq.ZMQError:
-                # no more data available - working around bug in ptypy here
-                if self.latest_pos_index_received < self.info.min_frames * parallel.size:
-                    logger.info('have %u frames, waiting...' % (self.latest_pos_index_received + 1))
-                    time.sleep(.5)
-                else:
-                    break
-
-        # get all frames from the detector socket
-        while self.stream_images:
-            try:
-                parts = self.det_socket.recv_multipart(flags=zmq.NOBLOCK)
-                info = json.loads(parts[0])
-                shape = info['shape']
-                dtype = np.dtype(info['type'])
-                img = decompress(parts[1], shape, dtype)
-                self.latest_det_index_received += 1
-                self.incoming_det[self.latest_det_index_received] = img
-
-            except zmq.ZMQError:
-                # no more data available - working around bug in ptypy here
-                if self.latest_det_index_received < self.info.min_frames * parallel.size:
-                    logger.info('have %u detector frames, waiting...' % (self.latest_det_index_received + 1))
-                    time.sleep(.5)
+        if n == 0:
+            msg = pickle.loads(parts[0])
+            headers = ('path' in msg.keys())
+            if not headers:
+                pos = -np.array((msg[self.info.yMotor], msg[self.info.xMotor])) * 1e-6
+                if self.stream_images:
+                    if not self.buffer.put_position(pos):
+                        return True
                 else:
-                    break
+                    img = np.asarray(msg[self.info.detector])
+                    frame = self.buffer.next_frame(img.shape, img.dtype)
+                    if frame is None:
+                        return True
+                    frame[:] = img
+                    self.buffer.commit_frame(pos)
+            elif msg['path'] in ('interrupted', 'finished'):
+                self.end_of_stream = True
+        else:
+            info = json.loads(parts[0])
+            shape = info['shape']
+            dtype = np.dtype(info['type'])
+            frame = self.buffer.next_frame(shape, dtype)
+            if frame is None:
+                return True
+            decompress(parts[1], shape, dtype, out=frame)
+            self.buffer.commit_frame()
+        # all frames of the finished scan received
+        return self.end_of_stream and self.buffer.num_frames >= self.buffer.num_positions
 
-        logger.info('-------------------------------------')
-        logger.info(self.incoming.keys())
-        logger.info(self.incoming_det.keys())
-        logger.info('-------------------------------------')
-        ind = self.latest_pos_index_received
-        if self.stream_images:
-            ind = min(ind, self.latest_det_index_received)
-        return (ind - start + 1), (end_of_scan and end_of_det_stream)
+    def check(self, frames=None, start=None):
+        """
+        Only called on the master node.
+        """
+        if start is None:
+            start = self.framestart
+        available = self.buffer.available
+        end_of_scan = self.buffer.finished and available == self.buffer.num_positions
+        new_frames = available - start
+
+        # wait for enough frames for all nodes - working around bug in ptypy here
+        if not (end_of_scan or self.buffer.full) and new_frames < self.info.min_frames * parallel.size:
+            logger.info('have %u frames, waiting...' % available)
+            return 0, False
+        if frames is not None:
+            new_frames = min(new_frames, frames)
+            end_of_scan = end_of_scan and (start + new_frames == available)
+        return new_frames, end_of_scan
 
     def load(self, indices):
         raw, weight, pos = {}, {}, {}
@@ -166,44 +204,23 @@ class NanomaxZmqScan(PtyScan):
         # communication
         if parallel.master:
             # send data to each node
+            stop = max(indices) + 1 if len(indices) else 0
             for node in range(1, parallel.size):
                 node_inds = parallel.receive(source=node)
-                dct = {i:self.incoming[i] for i in node_inds}
-                if self.stream_images:
-                    # merge streamed images
-                    for i in node_inds:
-                        dct[i][self.info.detector] = self.incoming_det[i]
-                parallel.send(dct, dest=node)
-                for i in node_inds:
-                    del self.incoming[i]
-                    if self.stream_images:
-                        del self.incoming_det[i]
+                parallel.send(self.buffer.get(node_inds), dest=node)
+                if len(node_inds):
+                    stop = max(stop, max(node_inds) + 1)
 
             # take data for this node
-            dct = {i: self.incoming[i] for i in indices}
-            if self.stream_images:
-                # merge streamed images
-                for i in indices:
-                    dct[i][self.info.detector] = self.incoming_det[i]
-            for i in indices:
-                del self.incoming[i]
-                if self.stream_images:
-                    del self.incoming_det[i]
+            raw, pos = self.buffer.get(indices)
+            self.buffer.release(stop)
         else:
             # receive data from the master node
             parallel.send(indices, dest=0)
-            dct = parallel.receive(source=0)
+            raw, pos = parallel.receive(source=0)
 
-        # repackage data and return
+        # weights
         for i in  indices:
-            raw[i] = dct[i][self.info.detector]
-#            pos[i] = np.array([
-#                        dct[i][self.info.xMotor],
-#                        dct[i][self.info.yMotor],
-#                        ]) * 1e-6
-            x = dct[i][self.info.xMotor]
-            y = dct[i][self.info.yMotor]
-            pos[i] = -np.array((y, x)) * 1e-6
             weight[i] = np.ones_like(raw[i])
             weight[i][np.where(raw[i] == 2**32-1)] = 0
 
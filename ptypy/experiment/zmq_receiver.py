@@ -0,0 +1,227 @@
+# -*- coding: utf-8 -*-
+"""
+Background reception of streamed frames for the ZMQ streaming PtyScans.
+
+A :py:class:`ZmqReceiver` thread receives messages as soon as they arrive
+and writes frames and positions into a preallocated
+:py:class:`FrameRingBuffer`. The ``check`` and ``load`` methods of the
+PtyScan only read its counters and copy slots, such that network
+reception and reconstruction overlap.
+
+This file is part of the PTYPY package.
+
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import threading
+import numpy as np
+import zmq
+
+from ..utils.verbose import logger
+
+__all__ = ['FrameRingBuffer', 'ZmqReceiver']
+
+
+class FrameRingBuffer(object):
+    """
+    Preallocated ring buffer of frames and scan positions.
+
+    A single writer appends frames and positions in acquisition order,
+    the reader accesses them by their scan point index. Frames and
+    positions are counted separately, as they may arrive on different
+    streams. A frame slot is only reused once its scan point has been
+    released with :py:meth:`release`, the writer waits until then.
+    Positions never wait, their array grows instead if they run ahead
+    of the frames by more than its length.
+    """
+
+    def __init__(self, capacity, frame_shape=None, dtype=None):
+        """
+        Parameters
+        ----------
+        capacity : int
+            Number of frames held at most.
+        frame_shape, dtype : tuple, numpy.dtype, optional
+            Frame layout. If not given, the frames are allocated on the
+            first call of :py:meth:`next_frame`.
+        """
+        self.capacity = int(capacity)
+        self.frames = None
+        if frame_shape is not None:
+            self.frames = np.empty((self.capacity,) + tuple(frame_shape), dtype=dtype)
+        self.positions = np.zeros((self.capacity, 2))
+        self.num_frames = 0
+        self.num_positions = 0
+        self.released = 0
+        self.finished = False
+        self.closed = False
+        self._cond = threading.Condition()
+
+    @property
+    def available(self):
+        """
+        Number of scan points with both a frame and a position.
+        """
+        return min(self.num_frames, self.num_positions)
+
+    @property
+    def full(self):
+        """
+        True if the writer has to wait for scan points to be released.
+        """
+        return self.num_frames - self.released >= self.capacity
+
+    def _wait_for_slot(self):
+        # Called with the lock held. Returns False if closed while waiting.
+        while self.full and not self.closed:
+            self._cond.wait(0.1)
+        return not self.closed
+
+    def _store_position(self, position):
+        # Called with the lock held. Doubles the position array if needed,
+        # keeping the unreleased positions at their index modulo its length.
+        size = len(self.positions)
+        if self.num_positions - self.released >= size:
+            positions = np.zeros((2 * size, 2))
+            live = np.arange(self.released, self.num_positions)
+            positions[live % (2 * size)] = self.positions[live % size]
+            self.positions = positions
+        self.positions[self.num_positions % len(self.positions)] = position
+        self.num_positions += 1
+
+    def next_frame(self, shape=None, dtype=None):
+        """
+        Array of the slot that receives the next frame. Waits while the
+        buffer is full and returns None if it has been closed.
+
+        Write into the slot, then call :py:meth:`commit_frame`.
+        """
+        with self._cond:
+            if self.frames is None:
+                self.frames = np.empty((self.capacity,) + tuple(shape), dtype=dtype)
+            if not self._wait_for_slot():
+                return None
+            return self.frames[self.num_frames % self.capacity]
+
+    def commit_frame(self, position=None):
+        """
+        Mark the frame slot returned by :py:meth:`next_frame` as written
+        and store the frame's `position` if it comes along with it.
+        """
+        with self._cond:
+            if position is not None:
+                self._store_position(position)
+            self.num_frames += 1
+            self._cond.notify_all()
+
+    def put_position(self, position):
+        """
+        Append a position received separately from its frame, without
+        waiting. Returns False if the buffer has been closed.
+        """
+        with self._cond:
+            if self.closed:
+                return False
+            self._store_position(position)
+            self._cond.notify_all()
+        return True
+
+    def get(self, indices):
+        """
+        Copies of the frames and positions of scan points `indices`,
+        as dictionaries keyed by index.
+        """
+        frames, positions = {}, {}
+        with self._cond:
+            for i in indices:
+                if not self.released <= i < self.available:
+                    raise IndexError('Scan point %d is not in the buffer (%d-%d)'
+                                     % (i, self.released, self.available - 1))
+                frames[i] = self.frames[i % self.capacity].copy()
+                positions[i] = self.positions[i % len(self.positions)].copy()
+        return frames, positions
+
+    def release(self, stop):
+        """
+        Allow the slots of all scan points before `stop` to be overwritten.
+        """
+        with self._cond:
+            self.released = max(self.released, min(int(stop), self.available))
+            self._cond.notify_all()
+
+    def finish(self):
+        """
+        Signal that no more frames will arrive.
+        """
+        with self._cond:
+            self.finished = True
+            self._cond.notify_all()
+
+    def close(self):
+        """
+        Stop a writer that waits for free slots.
+        """
+        with self._cond:
+            self.closed = True
+            self._cond.notify_all()
+
+
+class ZmqReceiver(threading.Thread):
+    """
+    Daemon thread that polls zmq sockets and hands every received
+    multipart message to a callback.
+
+    The sockets are created by `connect` within the thread, as zmq
+    sockets must not be shared between threads. `receive` is called with
+    the position of the socket in the list returned by `connect` and the
+    message parts. Sockets for which the optional `paused` callback
+    returns True, called with the same position, are not read until it
+    returns False, such that a full buffer does not block the others.
+    The thread ends when `receive` returns True, when :py:meth:`stop` is
+    called, or on an error, which is kept in ``error``. Frames received
+    until then remain in the buffer.
+    """
+
+    def __init__(self, context, connect, receive, buffer, poll_timeout=100, paused=None):
+        super().__init__(daemon=True, name='ZmqReceiver')
+        self.context = context
+        self.connect = connect
+        self.receive = receive
+        self.buffer = buffer
+        self.poll_timeout = poll_timeout
+        self.paused = paused
+        self.error = None
+        self._stop_event = threading.Event()
+
+    def run(self):
+        sockets = []
+        try:
+            sockets = self.connect(self.context)
+            poller = zmq.Poller()
+            for socket in sockets:
+                poller.register(socket, zmq.POLLIN)
+            done = False
+            while not done and not self._stop_event.is_set():
+                if self.paused is not None:
+                    for n, socket in enumerate(sockets):
+                        poller.register(socket, 0 if self.paused(n) else zmq.POLLIN)
+                events = dict(poller.poll(self.poll_timeout))
+                for n, socket in enumerate(sockets):
+                    if socket in events and not done:
+                        done = bool(self.receive(n, socket.recv_multipart()))
+        except Exception as e:
+            self.error = e
+            logger.error('Receiving streamed frames failed: %s' % e)
+        finally:
+            for socket in sockets:
+                socket.close(linger=0)
+            self.buffer.finish()
+
+    def stop(self, timeout=None):
+        """
+        End reception and wait for the thread to finish.
+        """
+        self._stop_event.set()
+        self.buffer.close()
+        if self.is_alive():
+            self.join(timeout)
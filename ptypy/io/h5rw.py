@@ -53,7 +53,7 @@ class Str_to_Slice(object):
 str_to_slice = Str_to_Slice()
 
 
-def _h5write(filename, mode, *args, **kwargs):
+def _h5write(filename, mode, *args, unsupported=None, **kwargs):
     """\
     _h5write(filename, mode, {'var1'=..., 'var2'=..., ...})
     _h5write(filename, mode, var1=..., var2=..., ...)
@@ -71,11 +71,15 @@ def _h5write(filename, mode, *args, **kwargs):
     * dictionaries
 
     (Setting the option UNSUPPORTED equal to 'ignore' eliminates
-    unsupported types. Default is 'fail', which raises an error.)
+    unsupported types. Default is 'fail', which raises an error.
+    `unsupported` overrides the option for this call only, without
+    changing the global h5options.)
 
     The file mode can be chosen according to the h5py documentation.
     It defaults to overwriting an existing file.
     """
+    if unsupported is None:
+        unsupported = h5options['UNSUPPORTED']
 
     filename = os.path.abspath(os.path.expanduser(filename))
 
@@ -250,9 +254,9 @@ def _h5write(filename, mode, *args, **kwargs):
         elif type(a) in STR_CONVERT:
             dset = _store_string(group, str(a), name)
         else:
-            if h5options['UNSUPPORTED'] == 'fail':
+            if unsupported == 'fail':
                 raise RuntimeError('Unsupported data type : %s' % type(a))
-            elif h5options['UNSUPPORTED'] == 'pickle':
+            elif unsupported == 'pickle':
                 dset = _store_pickle(group, a, name)
             else:
                 dset = None
@@ -279,7 +283,7 @@ def _h5write(filename, mode, *args, **kwargs):
     return
 
 
-def h5write(filename, *args, **kwargs):
+def h5write(filename, *args, unsupported=None, **kwargs):
     """\
     h5write(filename, {'var1'=..., 'var2'=..., ...})
     h5write(filename, var1=..., var2=..., ...)
@@ -296,17 +300,19 @@ def h5write(filename, *args, **kwargs):
     * dictionaries
 
     (Setting the option UNSUPPORTED equal to 'ignore' eliminates
-    unsupported types. Default is 'fail', which raises an error.)
+    unsupported types. Default is 'fail', which raises an error.
+    `unsupported` overrides the option for this call only, without
+    changing the global h5options.)
 
     The file mode can be chosen according to the h5py documentation.
     It defaults to overwriting an existing file.
     """
 
-    _h5write(filename, 'w', *args, **kwargs)
+    _h5write(filename, 'w', *args, unsupported=unsupported, **kwargs)
     return
 
 
-def h5append(filename, *args, **kwargs):
+def h5append(filename, *args, unsupported=None, **kwargs):
     """\
     h5append(filename, {'var1'=..., 'var2'=..., ...})
     h5append(filename, var1=..., var2=..., ...)
@@ -323,13 +329,15 @@ def h5append(filename, *args, **kwargs):
     * dictionaries
 
     (Setting the option UNSUPPORTED equal to 'ignore' eliminates
-    unsupported types. Default is 'fail', which raises an error.)
+    unsupported types. Default is 'fail', which raises an error.
+    `unsupported` overrides the option for this call only, without
+    changing the global h5options.)
 
     The file mode can be chosen according to the h5py documentation.
     It defaults to overwriting an existing file.
     """
 
-    _h5write(filename, 'a', *args, **kwargs)
+    _h5write(filename, 'a', *args, unsupported=unsupported, **kwargs)
     return
 
 
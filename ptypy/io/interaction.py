@@ -10,7 +10,6 @@ This file is part of the PTYPY package.
     :license: see LICENSE for details.
 """
 
-import zmq
 import time
 import string
 import random
@@ -22,8 +21,12 @@ import re
 import json
 
 from ..utils.verbose import logger
+from ..utils.misc import lazy_import
 from .. import defaults_tree
 
+# Only imported once a server or client is started
+zmq = lazy_import('zmq')
+
 __all__ = ['Server', 'Client']
 
 DEBUG = lambda x: None
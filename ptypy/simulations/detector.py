@@ -13,7 +13,9 @@ This file is part of the PTYPY package.
     :license: see LICENSE for details.
 """
 import numpy as np
-from scipy import ndimage as ndi
+from ..utils.misc import lazy_import
+
+ndi = lazy_import('scipy.ndimage')
 
 __all__=['shot','Detector','conv','fill2D']
 
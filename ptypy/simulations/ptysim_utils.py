@@ -10,10 +10,11 @@ This file is part of the PTYPY package.
 import numpy as np
 import os
 import time
-from scipy import ndimage
 
 
 from ptypy import utils as u
+
+ndimage = u.lazy_import('scipy.ndimage')
 #from ptypy.core import data
 
 __all__ = ['exp_positions']
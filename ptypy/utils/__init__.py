@@ -16,9 +16,33 @@ from .verbose import *
 from .citations import *
 from . import descriptor
 from . import parallel
-from .. import __has_matplotlib__ as hmpl
-if hmpl:
-    from .plot_utils import *
-    from .plot_client import PlotClient, MPLClient, spawn_MPLClient, MPLplotter
-del hmpl
+from . import profiling
+from .. import __has_matplotlib__
+
+# Plotting imports matplotlib.pyplot, which is slow. Its names are
+# therefore only imported on first access (PEP 562).
+_lazy_names = {
+    'plot_utils': ['pause', 'rmphaseramp', 'plot_storage', 'imsave', 'imload',
+                   'complex2hsv', 'complex2rgb', 'hsv2rgb', 'rgb2complex', 'rgb2hsv',
+                   'hsv2complex', 'franzmap', 'PtyAxis'],
+    'plot_client': ['PlotClient', 'MPLClient', 'spawn_MPLClient', 'MPLplotter'],
+}
+_lazy_attrs = dict((name, mod) for mod, names in _lazy_names.items() for name in names)
+
+
+def __getattr__(name):
+    mod = _lazy_attrs.get(name)
+    if mod is None or not __has_matplotlib__:
+        raise AttributeError("module %r has no attribute %r" % (__name__, name))
+    from importlib import import_module
+    value = getattr(import_module('.' + mod, __name__), name)
+    globals()[name] = value
+    return value
+
+
+def __dir__():
+    names = list(globals())
+    if __has_matplotlib__:
+        names += list(_lazy_attrs)
+    return sorted(names)
 
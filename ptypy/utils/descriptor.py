@@ -14,6 +14,10 @@ This file is part of the PTYPY package.
 """
 
 import ast
+import atexit
+import hashlib
+import json
+import os
 from collections import OrderedDict
 import textwrap
 from copy import deepcopy
@@ -21,7 +25,7 @@ from copy import deepcopy
 from .parameters import Param
 
 
-__all__ = ['Descriptor', 'ArgParseDescriptor', 'EvalDescriptor']
+__all__ = ['Descriptor', 'ArgParseDescriptor', 'EvalDescriptor', 'DescriptorCache', 'descriptor_cache']
 
 
 class CODES(object):
@@ -256,7 +260,8 @@ class Descriptor(object):
 
     def add_child(self, desc, copy=False):
         if copy:
-            desc = deepcopy(desc)
+            # Copy only desc and its descendants, not the tree it may be attached to
+            desc = deepcopy(desc, {id(desc.parent): desc.parent})
         self[desc.name] = desc
 
     def prune_child(self, name):
@@ -390,6 +395,14 @@ class Descriptor(object):
 
         return parser
 
+    def from_sections(self, sections):
+        """
+        Load Parameter defaults from a list of ``(name, options)`` pairs,
+        as returned by :py:func:`parse_sections`.
+        """
+        for sec, options in sections:
+            self.new_child(name=sec, options=dict(options))
+
     def from_string(self, s, strict=False, **kwargs):
         """
         Load Parameter from string using Python's ConfigParser
@@ -445,6 +458,135 @@ class Descriptor(object):
         return s.getvalue().strip()
 
 
+def parse_sections(s):
+    """
+    Parse the parameter sections in string `s` with Python's ConfigParser.
+
+    Returns a list of ``(name, options)`` pairs, one per section.
+    """
+    from configparser import RawConfigParser as Parser
+    parser = Parser(strict=False)
+    parser.read_string(textwrap.dedent(s))
+    return [(sec, dict(parser.items(sec))) for sec in parser.sections()]
+
+
+class DescriptorCache(object):
+    """
+    Persistent cache of the parameter sections parsed from class docstrings.
+
+    Parsing the docstrings of all engines and PtyScan classes with
+    ConfigParser is a noticeable part of the import time. The parsed
+    sections are stored in a JSON file per ptypy version, keyed by the
+    hash of the docstring section. The file is read in one go on the first
+    lookup and rewritten at exit by the master process if sections were
+    added, such that later imports skip the parsing.
+
+    The cache is only used if the environment variable ``PTYPY_CACHE_DIR``
+    names a directory, the cache file is then
+    ``$PTYPY_CACHE_DIR/descriptors-<version>.json``. Saving it removes the
+    files of other versions, such that the directory holds one file only.
+    """
+
+    def __init__(self, filename=None):
+        self.filename = filename
+        self._entries = None
+        self._new = {}
+
+    @staticmethod
+    def default_filename():
+        """
+        Cache file name from the environment, None if disabled.
+        """
+        from ..version import version
+        cache_dir = os.environ.get('PTYPY_CACHE_DIR')
+        if not cache_dir:
+            return None
+        return os.path.join(cache_dir, 'descriptors-%s.json' % version)
+
+    @staticmethod
+    def key(s):
+        return hashlib.sha1(s.encode('utf-8')).hexdigest()
+
+    def load(self):
+        """
+        Read all cached sections from the cache file.
+        """
+        self._entries = {}
+        if not self.filename:
+            return
+        try:
+            with open(self.filename) as f:
+                self._entries = json.load(f)
+        except (OSError, ValueError):
+            pass
+
+    def get(self, s):
+        """
+        Cached sections of parameter string `s`, None if not cached.
+        """
+        if self._entries is None:
+            self.load()
+        return self._entries.get(self.key(s))
+
+    def put(self, s, sections):
+        """
+        Add the parsed `sections` of parameter string `s`.
+        """
+        if self._entries is None:
+            self.load()
+        k = self.key(s)
+        self._entries[k] = sections
+        self._new[k] = sections
+
+    def save(self):
+        """
+        Write the cache file if sections were added and remove the cache
+        files of other versions. Only the master process writes, the file
+        is replaced atomically.
+        """
+        if not self._new or not self.filename:
+            return
+        from . import parallel
+        if not parallel.master:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.filename), exist_ok=True)
+            # Keep entries written by other processes in the meantime
+            entries = {}
+            try:
+                with open(self.filename) as f:
+                    entries = json.load(f)
+            except (OSError, ValueError):
+                pass
+            entries.update(self._new)
+            tmp = '%s.%d.tmp' % (self.filename, os.getpid())
+            with open(tmp, 'w') as f:
+                json.dump(entries, f)
+            os.replace(tmp, self.filename)
+            self.prune()
+        except OSError:
+            # A read-only home directory should not break anything
+            return
+        self._new = {}
+
+    def prune(self):
+        """
+        Remove the cache files of other versions next to ``filename``.
+        """
+        cache_dir, name = os.path.split(self.filename)
+        for other in os.listdir(cache_dir or '.'):
+            if other != name and other.startswith('descriptors-') and other.endswith('.json'):
+                try:
+                    os.remove(os.path.join(cache_dir, other))
+                except OSError:
+                    pass
+
+
+# Create one instance - typically only this one should be used
+descriptor_cache = DescriptorCache(DescriptorCache.default_filename())
+atexit.register(descriptor_cache.save)
+
+
 class ArgParseDescriptor(Descriptor):
     OPTIONS_DEF = OrderedDict([
         ('default', 'Default value for parameter.'),
@@ -1125,8 +1267,12 @@ class EvalDescriptor(ArgParseDescriptor):
             typ = desc_base().path if desc_base is not None else None
             desc.default = typ
 
-        # Parse parameter section and store in desc
-        desc.from_string(parameter_string)
+        # Parse parameter section, or take it from the cache, and store in desc
+        sections = descriptor_cache.get(parameter_string)
+        if sections is None:
+            sections = parse_sections(parameter_string)
+            descriptor_cache.put(parameter_string, sections)
+        desc.from_sections(sections)
 
         # Attach the Parameter group to cls
         from weakref import ref
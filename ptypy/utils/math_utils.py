@@ -8,12 +8,11 @@ This file is part of the PTYPY package.
     :license: see LICENSE for details.
 """
 import numpy as np
-from scipy.special import erf
-from scipy.linalg import eig
-from scipy import ndimage as ndi
 
 from .misc import *
 
+ndi = lazy_import('scipy.ndimage')
+
 __all__ = ['smooth_step', 'abs2', 'norm2', 'norm', 'delxb', 'delxc', 'delxf',
            'ortho', 'gauss_fwhm', 'gaussian', 'gf', 'cabs2', 'gf_2d', 'c_gf',
            'gaussian2D', 'rl_deconvolution']
@@ -50,6 +49,7 @@ def smooth_step(x, mfs):
     Smoothed step function with fwhm `mfs`
     Evaluates the error function `scipy.special.erf`.
     """
+    from scipy.special import erf
     return 0.5 * erf(x * 2.35 / mfs) + 0.5
 
 def gaussian(x, std=1.0, off=0.0):
@@ -253,6 +253,7 @@ def ortho(modes):
     nplist : list
         List of modes, sorted in descending order
     """
+    from scipy.linalg import eig
     N = len(modes)
     A = np.array([[np.vdot(p2,p1) for p1 in modes] for p2 in modes])
     e, v = eig(A)
@@ -263,9 +264,18 @@ def ortho(modes):
     return amp, nplist
 
 
-c_gf= complex_overload(ndi.gaussian_filter)
-# ndi.gaussian_filter is a little special in the docstring
-c_gf.__doc__='    *complex input*\n\n    '+c_gf.__doc__
+def c_gf(c, *arg, **kwargs):
+    """
+    *complex input*
+
+    scipy.ndimage.gaussian_filter applied to the real and imaginary
+    parts of `c` separately.
+
+    See also
+    --------
+    gf
+    """
+    return complex_overload(ndi.gaussian_filter)(c, *arg, **kwargs)
 
 def gf(c, *arg, **kwargs):
     """
@@ -8,6 +8,7 @@ This file is part of the PTYPY package.
     :license: see LICENSE for details.
 """
 import os
+import importlib
 import numpy as np
 from functools import wraps
 from collections import OrderedDict
@@ -16,7 +17,7 @@ from collections import namedtuple
 __all__ = ['str2int', 'str2range', 'complex_overload', 'expect2',
            'expect3', 'keV2m', 'keV2nm', 'nm2keV', 'm2keV', 'clean_path',
            'unique_path', 'Table', 'all_subclasses', 'expectN', 'isstr',
-           'electron_wavelength']
+           'electron_wavelength', 'lazy_import']
 
 
 def all_subclasses(cls, names=False):
@@ -361,3 +362,33 @@ def electron_wavelength(electron_energy):
     moc2 = 511 # keV
     wavelength = hc / np.sqrt(electron_energy * (2 * moc2 + electron_energy)) * 1e-10
     return wavelength
+
+
+class _LazyModule(object):
+    """
+    Placeholder for a module that is imported on first attribute access.
+    """
+    def __init__(self, name):
+        self.__dict__['_name'] = name
+        self.__dict__['_module'] = None
+
+    def __getattr__(self, attr):
+        module = self.__dict__['_module']
+        if module is None:
+            module = importlib.import_module(self.__dict__['_name'])
+            self.__dict__['_module'] = module
+        return getattr(module, attr)
+
+    def __repr__(self):
+        return "<lazy module '%s'>" % self.__dict__['_name']
+
+
+def lazy_import(name):
+    """
+    Return a stand-in for module `name` that imports it only when
+    one of its attributes is first accessed.
+
+    Use this for heavy optional dependencies that are only needed by
+    a few functions, e.g. ``zmq = lazy_import('zmq')``.
+    """
+    return _LazyModule(name)
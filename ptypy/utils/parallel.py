@@ -9,6 +9,7 @@ This file is part of the PTYPY package.
 """
 import numpy as np
 
+from .profiling import profiler
 from .. import __has_mpi4py__ as hmpi
 
 size = 1
@@ -25,9 +26,15 @@ del hmpi
 MPIenabled = not (size == 1)
 master = (rank == 0)
 
+# MPI counts and displacements are C ints
+MAX_COUNT = 2**31 - 1
+# Bytes packed by the source per round in scatter_dict
+SCATTER_BYTES = 2**28
+
 __all__ = ['MPIenabled', 'comm', 'MPI', 'master','barrier',
-           'LoadManager', 'loadmanager','allreduce','send','receive','bcast',
-           'bcast_dict', 'gather_dict', 'gather_list', 
+           'LoadManager', 'loadmanager','allreduce','allreduce_sum_max','allreduce_region','alltoallv',
+           'sync_regions','scatter_regions','gather_regions','send','receive','bcast',
+           'bcast_dict', 'scatter_dict', 'gather_dict', 'gather_list', 
            'MPIrand_normal', 'MPIrand_uniform','MPInoise2d']
 
 
@@ -187,6 +194,7 @@ def allreduce(a, op=None):
     isscalar = np.isscalar(a)
     if isscalar:
         a = np.array(a)
+    profiler.count('allreduce_bytes', a.nbytes)
     if op is None:
         # print a.shape
         comm.Allreduce(MPI.IN_PLACE, a)
@@ -197,6 +205,32 @@ def allreduce(a, op=None):
     else:
         return a
 
+_sum_max_ops = {}
+
+def allreduce_sum_max(a, nmax):
+    """
+    In-place allreduce of the 1D float64 array `a` with a single
+    ``Allreduce``. All elements are summed, except for the last `nmax`
+    ones, for which the maximum is taken.
+
+    Minima can be reduced along by storing them with inverted sign.
+    """
+    if not MPIenabled:
+        return a
+    op = _sum_max_ops.get(nmax)
+    if op is None:
+        def _sum_max(inbuf, outbuf, datatype):
+            x = np.frombuffer(inbuf, dtype=np.float64)
+            y = np.frombuffer(outbuf, dtype=np.float64)
+            n = len(y) - nmax
+            y[:n] += x[:n]
+            np.maximum(y[n:], x[n:], out=y[n:])
+        op = MPI.Op.Create(_sum_max, commute=True)
+        _sum_max_ops[nmax] = op
+    profiler.count('allreduce_bytes', a.nbytes)
+    comm.Allreduce(MPI.IN_PLACE, a, op=op)
+    return a
+
 def allreduceC(c):
     """
     Performs MPI parallel ``allreduce`` with a sum as reduction
@@ -211,6 +245,228 @@ def allreduceC(c):
     for s in c.S.values():
         allreduce(s.data)
 
+def allreduce_region(a, region, origin=(0, 0)):
+    """
+    Sum-reduce the 2D `region` of `a` across processes, exchanging only
+    the parts where the regions of different processes overlap.
+
+    Parameters
+    ----------
+    a : numpy-ndarray
+        The array to operate on. Its contribution is assumed to be zero
+        outside of `region`.
+
+    region : tuple
+        ``(y0, y1, x0, x1)``, bounds of this process' region in the last
+        two axes of the array shared by all processes. Can be empty.
+
+    origin : tuple
+        Position of ``a[..., 0, 0]`` in that array, for processes that
+        only hold a part of it.
+
+    Note
+    ----
+    After the call, ``a[..., y0:y1, x0:x1]`` holds the sum over all
+    processes. Outside of `region` `a` is left untouched. The partial
+    sums are added in rank order, so overlapping regions end up
+    identical on all processes.
+    """
+    if not MPIenabled:
+        return a
+    regions = comm.allgather(tuple(int(r) for r in region))
+    y0, y1, x0, x1 = regions[rank]
+    oy, ox = origin
+    local = a[..., y0 - oy:y1 - oy, x0 - ox:x1 - ox]
+    if local.size == 0:
+        return a
+
+    own = local.copy()
+    local.fill(0)
+    requests = []
+    parts = []
+    for r, (ry0, ry1, rx0, rx1) in enumerate(regions):
+        oy0, oy1 = max(y0, ry0), min(y1, ry1)
+        ox0, ox1 = max(x0, rx0), min(x1, rx1)
+        if oy0 >= oy1 or ox0 >= ox1:
+            continue
+        sl = (Ellipsis, slice(oy0 - y0, oy1 - y0), slice(ox0 - x0, ox1 - x0))
+        if r == rank:
+            parts.append((sl, own))
+            continue
+        sendbuf = np.ascontiguousarray(own[sl])
+        recvbuf = np.empty_like(sendbuf)
+        profiler.count('allreduce_bytes', sendbuf.nbytes)
+        requests.append(comm.Isend(sendbuf, dest=r, tag=rank))
+        requests.append(comm.Irecv(recvbuf, source=r, tag=r))
+        parts.append((sl, (sendbuf, recvbuf)))
+    MPI.Request.Waitall(requests)
+
+    # Add up in rank order
+    for sl, part in parts:
+        if part is own:
+            local[sl] += own[sl]
+        else:
+            local[sl] += part[1]
+    return a
+
+def sync_regions(a, region):
+    """
+    Make `a` identical on all processes after :py:func:`allreduce_region`.
+
+    Every pixel in the last two axes is taken from the lowest rank whose
+    `region` contains it. Pixels outside of all regions are left as they
+    are. This costs one full :py:func:`allreduce` of `a`.
+    """
+    if not MPIenabled:
+        return a
+    regions = comm.allgather(tuple(int(r) for r in region))
+    owner = np.full(a.shape[-2:], -1, dtype=np.int32)
+    for r, (y0, y1, x0, x1) in reversed(list(enumerate(regions))):
+        owner[y0:y1, x0:x1] = r
+    b = np.where(owner == rank, a, 0).astype(a.dtype)
+    allreduce(b)
+    a[...] = np.where(owner >= 0, b, a)
+    return a
+
+def scatter_regions(a, region):
+    """
+    Copy of the 2D `region` of the array `a` of the master node,
+    sent to every process.
+
+    Parameters
+    ----------
+    a : numpy-ndarray
+        The array of the master node. Other processes only pass an array
+        of the same dtype and leading dimensions.
+
+    region : tuple
+        ``(y0, y1, x0, x1)``, bounds of the requested region in the last
+        two axes of the master's `a`. Can be empty.
+
+    Returns
+    -------
+    out : numpy-ndarray
+        ``a[..., y0:y1, x0:x1]`` of the master node.
+    """
+    y0, y1, x0, x1 = (int(r) for r in region)
+    if not MPIenabled:
+        return a[..., y0:y1, x0:x1].copy()
+    regions = comm.allgather((y0, y1, x0, x1))
+    if master:
+        requests = []
+        for r, (ry0, ry1, rx0, rx1) in enumerate(regions):
+            if r == rank or ry1 <= ry0 or rx1 <= rx0:
+                continue
+            sendbuf = np.ascontiguousarray(a[..., ry0:ry1, rx0:rx1])
+            requests.append((comm.Isend(sendbuf, dest=r, tag=r), sendbuf))
+        MPI.Request.Waitall([req for req, buf in requests])
+        return a[..., y0:y1, x0:x1].copy()
+    out = np.empty(a.shape[:-2] + (max(y1 - y0, 0), max(x1 - x0, 0)), dtype=a.dtype)
+    if out.size:
+        comm.Recv(out, source=0, tag=rank)
+    return out
+
+def gather_regions(a, region, origin=(0, 0)):
+    """
+    Collect the 2D regions of all processes in the array `a` of the master
+    node, the reverse of :py:func:`scatter_regions`.
+
+    Every pixel in the last two axes is taken from the lowest rank whose
+    `region` contains it. The master's `a` must hold all regions, its
+    pixels outside of all regions are left as they are.
+
+    Parameters
+    ----------
+    a : numpy-ndarray
+        The array to operate on, holding at least `region`.
+
+    region : tuple
+        ``(y0, y1, x0, x1)``, bounds of this process' region in the last
+        two axes of the master's `a`. Can be empty.
+
+    origin : tuple
+        Position of ``a[..., 0, 0]`` in the master's `a`, for processes
+        that only hold a part of it.
+    """
+    if not MPIenabled:
+        return a
+    regions = comm.allgather(tuple(int(r) for r in region))
+    if not master:
+        y0, y1, x0, x1 = regions[rank]
+        oy, ox = origin
+        if y1 > y0 and x1 > x0:
+            comm.Send(np.ascontiguousarray(a[..., y0 - oy:y1 - oy, x0 - ox:x1 - ox]), dest=0, tag=rank)
+        return a
+    # Later writes win, so receive in reverse rank order and keep the own region
+    y0, y1, x0, x1 = regions[rank]
+    own = a[..., y0:y1, x0:x1].copy()
+    for r in range(size - 1, 0, -1):
+        ry0, ry1, rx0, rx1 = regions[r]
+        if ry1 <= ry0 or rx1 <= rx0:
+            continue
+        buf = np.empty(a.shape[:-2] + (ry1 - ry0, rx1 - rx0), dtype=a.dtype)
+        comm.Recv(buf, source=r, tag=r)
+        a[..., ry0:ry1, rx0:rx1] = buf
+    a[..., y0:y1, x0:x1] = own
+    return a
+
+def alltoallv(sendbuf, sendcounts, recvbuf, recvcounts):
+    """
+    Wrapper for comm.Alltoallv on contiguous 1D arrays.
+
+    If a count or displacement would exceed :py:data:`MAX_COUNT`, the
+    data is exchanged in rounds of at most ``MAX_COUNT // size`` elements
+    per process, packed into temporary buffers.
+
+    Parameters
+    ----------
+    sendbuf : numpy-ndarray
+        Data for all processes, packed in rank order.
+
+    sendcounts : sequence of int
+        Number of elements of `sendbuf` for each process.
+
+    recvbuf : numpy-ndarray
+        Output array of the same dtype as `sendbuf`, filled with the data
+        from all processes in rank order.
+
+    recvcounts : sequence of int
+        Number of elements received from each process.
+
+    Returns
+    -------
+    nbytes : int
+        Number of bytes sent to other processes.
+    """
+    sendcounts = [int(n) for n in sendcounts]
+    recvcounts = [int(n) for n in recvcounts]
+    sdispls = [int(n) for n in np.cumsum([0] + sendcounts[:-1])]
+    rdispls = [int(n) for n in np.cumsum([0] + recvcounts[:-1])]
+    if not MPIenabled:
+        recvbuf[:recvcounts[0]] = sendbuf[:sendcounts[0]]
+        return 0
+    # All processes have to agree on the number of rounds
+    nmax = np.array([sum(sendcounts), sum(recvcounts), max(sendcounts), max(recvcounts)])
+    comm.Allreduce(MPI.IN_PLACE, nmax, op=MPI.MAX)
+    if nmax[:2].max() <= MAX_COUNT:
+        comm.Alltoallv([sendbuf, (sendcounts, sdispls)], [recvbuf, (recvcounts, rdispls)])
+    else:
+        chunk = max(MAX_COUNT // size, 1)
+        for start in range(0, int(nmax[2:].max()), chunk):
+            scounts = [min(max(n - start, 0), chunk) for n in sendcounts]
+            rcounts = [min(max(n - start, 0), chunk) for n in recvcounts]
+            sbuf = np.concatenate([sendbuf[d + start:d + start + n] for d, n in zip(sdispls, scounts)])
+            rbuf = np.empty(sum(rcounts), dtype=recvbuf.dtype)
+            comm.Alltoallv([sbuf, (scounts, [int(n) for n in np.cumsum([0] + scounts[:-1])])],
+                           [rbuf, (rcounts, [int(n) for n in np.cumsum([0] + rcounts[:-1])])])
+            offset = 0
+            for d, n in zip(rdispls, rcounts):
+                recvbuf[d + start:d + start + n] = rbuf[offset:offset + n]
+                offset += n
+    nbytes = (sum(sendcounts) - sendcounts[rank]) * sendbuf.itemsize
+    profiler.count('alltoallv_bytes', nbytes)
+    return nbytes
+
 def _MPIop(a, op, axis=None):
     """
     Apply operation op on accross a list of arrays distributed between
@@ -479,7 +735,8 @@ def bcast_dict(dct, keys='all', source=0):
     There is no guarantee that each *key,value* pair is accepted at other
     nodes, except for ``keys='all'``. Also in this implementation
     the input `dct` from source is *completely* transmitted to every node,
-    potentially creating a large overhead for may nodes and huge dictionarys
+    potentially creating a large overhead for may nodes and huge dictionarys.
+    Use :any:`scatter_dict` to send each node only its own items.
 
     Deleting reference in input dictionary may result in data loss at
     ``rank==source``
@@ -518,6 +775,85 @@ def bcast_dict(dct, keys='all', source=0):
                 out[k] = v
         return out
 
+def scatter_dict(dct, keys, source=0):
+    """
+    Scatters the items of dict `dct` from ``rank==source``, such that
+    each process receives only the items it asks for.
+
+    If all values are numpy arrays of the same shape and dtype, they are
+    sent with ``Scatterv`` in rounds, each packing at most
+    :py:data:`SCATTER_BYTES` on the source and keeping counts below
+    :py:data:`MAX_COUNT`. Other values are pickled and sent with ``scatter``.
+
+    Parameters
+    ----------
+    dct : dict
+        Dictionary to scatter, only used at ``rank==source``.
+
+    keys : list
+        Keys whose values are wanted by this process. Keys that are not
+        in `dct` are ignored.
+
+    source : int
+        Rank of node / process which scatters.
+
+    Returns
+    -------
+    dct : dict
+        The items of the source dictionary with keys in `keys`.
+
+    See also
+    --------
+    bcast_dict
+    """
+    keys = [k.item() if isinstance(k, np.generic) else k for k in keys]
+    if not MPIenabled:
+        return dict((k, dct[k]) for k in keys if k in dct)
+
+    wanted = comm.gather(keys, root=source)
+    if rank == source:
+        parts = [[k for k in w if k in dct] for w in wanted]
+        values = [dct[k] for p in parts for k in p]
+        stack = (len(values) > 0 and all(type(v) is np.ndarray for v in values)
+                 and len(set((v.shape, v.dtype.str) for v in values)) == 1)
+        if stack:
+            shape, dtypestr = values[0].shape, values[0].dtype.str
+            nmax = max(len(p) for p in parts)
+            comm.scatter([(p, shape, dtypestr, nmax) for p in parts], root=source)
+        else:
+            items = comm.scatter([dict((k, dct[k]) for k in p) for p in parts], root=source)
+            return items
+    else:
+        header = comm.scatter(None, root=source)
+        if type(header) is dict:
+            return header
+
+    # Stacked arrays, sent in rounds of at most `nround` frames per process
+    if rank == source:
+        mykeys = parts[rank]
+    else:
+        mykeys, shape, dtypestr, nmax = header
+    newdtype = '|u1' if dtypestr == '|b1' else dtypestr
+    npix = max(int(np.prod(shape)), 1)
+    nbytes = npix * np.dtype(newdtype).itemsize
+    nround = max(min(MAX_COUNT // npix, SCATTER_BYTES // nbytes) // size, 1)
+    recvbuf = np.empty((len(mykeys),) + tuple(shape), dtype=newdtype)
+    for start in range(0, nmax, nround):
+        if rank == source:
+            chunks = [p[start:start + nround] for p in parts]
+            counts = [len(c) * npix for c in chunks]
+            displs = [int(n) for n in np.cumsum([0] + counts[:-1])]
+            sendbuf = np.empty((sum(len(c) for c in chunks),) + tuple(shape), dtype=newdtype)
+            for i, k in enumerate(k for c in chunks for k in c):
+                sendbuf[i] = dct[k]
+            sendspec = [sendbuf, (counts, displs)]
+        else:
+            sendspec = None
+        comm.Scatterv(sendspec, recvbuf[start:start + nround], root=source)
+    if dtypestr == '|b1':
+        recvbuf = recvbuf.astype('bool')
+    return dict(zip(mykeys, recvbuf))
+
 def allgather_dict(dct):
     """
     Allgather dict in place.
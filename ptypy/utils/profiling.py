@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+"""\
+Per-iteration profiling of reconstructions.
+
+The process-wide :py:data:`profiler` accumulates wall time per phase and
+counters (FFTs, bytes moved by MPI allreduce, ...) between two calls of
+:py:meth:`Profiler.record`, which appends one JSON line per process to a
+profile file. Use ``ptypy.profile`` to summarize such a file.
+
+This file is part of the PTYPY package.
+
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import json
+import os
+import sys
+import time
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+__all__ = ['Profiler', 'profiler', 'peak_memory', 'read_profile', 'summarize']
+
+
+def peak_memory():
+    """
+    Peak resident memory of this process in bytes, or None if unknown.
+    """
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return int(rss) if sys.platform == 'darwin' else int(rss) * 1024
+
+
+class Profiler(object):
+    """
+    Accumulates phase timings and counters and streams them to a
+    newline-delimited JSON file.
+
+    All methods are cheap no-ops unless the profiler has been started.
+    """
+
+    def __init__(self):
+        self.active = False
+        self.filename = None
+        self._file = None
+        self.phases = {}
+        self.counters = {}
+
+    def start(self, filename):
+        """
+        Start profiling and append records to `filename`.
+        """
+        from . import parallel
+        if parallel.master:
+            if self._file is None or self.filename != filename:
+                self.close()
+                dirname = os.path.dirname(filename)
+                if dirname:
+                    os.makedirs(dirname, exist_ok=True)
+                self._file = open(filename, 'a')
+        self.filename = filename
+        self.active = True
+        self.reset()
+
+    def stop(self):
+        """
+        Stop profiling and close the profile file.
+        """
+        self.active = False
+        self.close()
+        self.reset()
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def reset(self):
+        """
+        Discard the timings and counters accumulated since the last record.
+        """
+        self.phases = {}
+        self.counters = {}
+
+    def add_time(self, name, duration):
+        """
+        Add `duration` seconds to the phase `name`.
+        """
+        if self.active:
+            self.phases[name] = self.phases.get(name, 0.) + duration
+
+    def count(self, name, n=1):
+        """
+        Increase the counter `name` by `n`.
+        """
+        if self.active:
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    @contextmanager
+    def phase(self, name):
+        """
+        Context manager timing the enclosed block as phase `name`.
+        """
+        if not self.active:
+            yield
+            return
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - t)
+
+    def record(self, **info):
+        """
+        Write one record per process with the phases and counters
+        accumulated since the previous record, then reset them.
+
+        Keyword arguments are stored with the record. This is a collective
+        call if MPI is used, records of all processes are written by the
+        master process.
+        """
+        if not self.active:
+            return
+        from . import parallel
+        rec = dict(info)
+        rec.update(rank=parallel.rank,
+                   time=time.time(),
+                   phases=self.phases,
+                   counters=self.counters,
+                   peak_memory=peak_memory())
+        self.reset()
+        recs = parallel.comm.gather(rec, root=0) if parallel.MPIenabled else [rec]
+        if parallel.master and self._file is not None:
+            for r in recs:
+                self._file.write(json.dumps(r, default=_to_json) + '\n')
+            self._file.flush()
+
+
+def _to_json(obj):
+    """
+    Fallback for numpy scalars and arrays in records.
+    """
+    if hasattr(obj, 'tolist'):
+        return obj.tolist()
+    raise TypeError("%r is not JSON serializable" % obj)
+
+
+def read_profile(filename):
+    """
+    Read all records of the profile file `filename` as a list of dicts.
+    """
+    with open(filename) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _engine_runs(records):
+    """
+    Split records into runs of one engine, each ended by a finalize record.
+    """
+    runs = []
+    current = []
+    for rec, nxt in zip(records, records[1:] + [None]):
+        current.append(rec)
+        # The finalize records of all processes follow each other
+        if rec.get('event') == 'finalize' and (nxt is None or nxt.get('event') != 'finalize'):
+            runs.append(current)
+            current = []
+    if current:
+        runs.append(current)
+    return runs
+
+
+def _size(nbytes):
+    for unit in ['B', 'kB', 'MB', 'GB']:
+        if abs(nbytes) < 1024. or unit == 'GB':
+            return '%.1f %s' % (nbytes, unit) if unit != 'B' else '%d B' % nbytes
+        nbytes /= 1024.
+
+
+def summarize(records, per_iteration=False):
+    """
+    Summary of profile `records` as text, one block per engine run.
+
+    For every phase, the total time over all iterations, the mean and
+    maximum per iteration and the imbalance between processes (ratio of
+    the largest to the smallest total) are listed. With `per_iteration`,
+    one line per record of the first process is added.
+    """
+    lines = []
+    for run in _engine_runs(records):
+        its = [r for r in run if r.get('event') == 'iteration']
+        ranks = sorted(set(r.get('rank', 0) for r in run))
+        engine = run[0].get('engine', '?')
+        niter = sum(r.get('iterations', 1) for r in its if r.get('rank', 0) == ranks[0])
+        first = its[0]['iteration'] - its[0].get('iterations', 1) + 1 if its else 0
+        last = its[-1]['iteration'] if its else 0
+        lines.append('Engine %s: %d iterations (%d-%d), %d process(es)'
+                     % (engine, niter, first, last, len(ranks)))
+
+        # Phase timings per process
+        totals = {}
+        per_iter = {}
+        for r in run:
+            rank = r.get('rank', 0)
+            for name, t in r.get('phases', {}).items():
+                totals.setdefault(name, {}).setdefault(rank, 0.)
+                totals[name][rank] += t
+                if r.get('event') == 'iteration':
+                    per_iter.setdefault(name, []).append(t / max(r.get('iterations', 1), 1))
+        if totals:
+            lines.append('  %-22s %12s %12s %12s %10s' % ('phase', 'total [s]', 'mean [ms]', 'max [ms]', 'imbalance'))
+            for name in sorted(totals, key=lambda n: -max(totals[n].values())):
+                tot = totals[name]
+                pi = per_iter.get(name, [0.])
+                imbalance = max(tot.values()) / min(tot.values()) if min(tot.values()) > 0 else float('inf')
+                lines.append('  %-22s %12.3f %12.3f %12.3f %10.2f'
+                             % (name, max(tot.values()), 1e3 * sum(pi) / len(pi), 1e3 * max(pi), imbalance))
+
+        # Counters, summed over processes
+        counters = {}
+        for r in run:
+            for name, n in r.get('counters', {}).items():
+                counters[name] = counters.get(name, 0) + n
+        for name in sorted(counters):
+            n = counters[name]
+            per = n / float(max(niter, 1))
+            if name.endswith('bytes'):
+                lines.append('  %-22s %12s %12s per iteration' % (name, _size(n), _size(per)))
+            else:
+                lines.append('  %-22s %12d %12.1f per iteration' % (name, n, per))
+
+        mem = [r['peak_memory'] for r in run if r.get('peak_memory') is not None]
+        if mem:
+            lines.append('  %-22s %12s' % ('peak_memory', _size(max(mem))))
+        errors = [r['error'] for r in its if r.get('rank', 0) == ranks[0] and r.get('error') is not None]
+        if errors:
+            lines.append('  %-22s %12s -> %s' % ('error', _fmt(errors[0]), _fmt(errors[-1])))
+
+        if per_iteration:
+            lines.append('  %10s %12s %10s %14s  %s' % ('iteration', 'time [ms]', 'ffts', 'allreduce', 'error'))
+            for r in its:
+                if r.get('rank', 0) != ranks[0]:
+                    continue
+                c = r.get('counters', {})
+                lines.append('  %10d %12.3f %10d %14s  %s'
+                             % (r['iteration'], 1e3 * r.get('phases', {}).get('iterate', 0.),
+                                c.get('ffts', 0), _size(c.get('allreduce_bytes', 0)), _fmt(r.get('error'))))
+        lines.append('')
+    return '\n'.join(lines)
+
+
+def _fmt(error):
+    if error is None:
+        return '-'
+    return '[' + ', '.join('%.4g' % e for e in error) + ']'
+
+
+# Create one instance - typically only this one should be used
+profiler = Profiler()
@@ -9,16 +9,17 @@ This file is part of the PTYPY package.
 import numpy as np
 from . import parallel
 import urllib.request, urllib.error, urllib.parse
-from scipy import ndimage as ndi
 
 from . import array_utils as au
-from .misc import expect2
+from .misc import expect2, lazy_import
 # from .. import io # FIXME: SC: when moved here, io fails
 
 __all__ = ['hdr_image', 'diversify', 'cxro_iref', 'xradia_star', 'png2mpg',
            'mass_center', 'phase_from_dpc', 'radial_distribution',
            'stxm_analysis', 'stxm_init', 'load_from_ptyr', 'remove_hot_pixels']
 
+ndi = lazy_import('scipy.ndimage')
+
 
 def diversify(A, noise=None, shift=None, power=1.0):
     """
@@ -0,0 +1,107 @@
+"""
+Tests for the compact storage of diffraction data in the serial engines.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+from unittest import mock
+
+from test import utils as tu
+from ptypy import utils as u
+import ptypy
+ptypy.load_gpu_engines("serial")
+from ptypy.accelerate.base.compact import CompactMagnitudes, PackedMask
+import tempfile
+import shutil
+import numpy as np
+
+
+class CompactFramesTest(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.data = rng.poisson(rng.uniform(0, 1e4, size=(6, 16, 21))).astype(np.float32)
+        self.data[2] = 0.
+        self.mask = rng.uniform(size=self.data.shape) > 0.1
+
+    def test_magnitudes(self):
+        mag = np.sqrt(self.data)
+        for mode, tol in [('float16', 1e-3 * mag), ('uint16', mag.max() / 65535.)]:
+            cmag = CompactMagnitudes(self.data, mode)
+            self.assertEqual(cmag.shape, mag.shape)
+            self.assertEqual(len(cmag), len(mag))
+            self.assertLess(cmag.nbytes, mag.nbytes // 2 + 100)
+            out = cmag[:]
+            self.assertEqual(out.dtype, np.float32)
+            self.assertTrue(np.all(np.abs(out - mag) <= tol))
+            idx = np.array([4, 0, 2])
+            for item in [slice(1, 4), idx, (3, None), (slice(2, 5), None), 5]:
+                np.testing.assert_array_equal(cmag[item], out[item])
+            np.testing.assert_array_equal(np.asarray(cmag), out)
+
+    def test_mask(self):
+        pmask = PackedMask(self.mask)
+        self.assertEqual(pmask.shape, self.mask.shape)
+        self.assertLess(pmask.nbytes, self.mask.nbytes // 4)
+        ma = self.mask.astype(np.float32)
+        for item in [slice(None), slice(1, 4), np.array([5, 1]), (0, None)]:
+            np.testing.assert_array_equal(pmask[item], ma[item])
+
+
+class CompactDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="compact_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def run_engine(self, name, rtol=1e-3, **kwargs):
+        out = []
+        for compact_data in [None, 'uint16']:
+            engine_params = u.Param()
+            engine_params.name = name
+            engine_params.numiter = 20
+            engine_params.compact_data = compact_data
+            engine_params.update(kwargs)
+            np.random.seed(1)
+            out.append(tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                           scanmodel="BlockFull", autosave=False, verbose_level="critical"))
+        err, err_compact = [np.array([info["error"][0] for info in P.runtime["iter_info"]]) for P in out]
+        np.testing.assert_allclose(err_compact, err, rtol=rtol)
+        return out[1]
+
+    def test_DM_serial_compact(self):
+        self.run_engine("DM_serial")
+
+    def test_DM_serial_compact_batches(self):
+        # Without a batch_size, compact frames are expanded in bounded batches
+        with mock.patch("ptypy.accelerate.base.engines.projectional_serial.COMPACT_BATCH_SIZE", 7):
+            P = self.run_engine("DM_serial")
+        for kern in P.engines["engine00"].kernels.values():
+            self.assertEqual(kern.batch_size, 7)
+
+    def test_EPIE_serial_compact(self):
+        # The order of the views is random
+        self.run_engine("EPIE_serial", rtol=0.1, compute_fourier_error=True)
+
+    def test_release_data(self):
+        P = self.run_engine("DM_serial", release_data=True)
+        for d in P.diff.S.values():
+            self.assertEqual(d.data.shape[0], 0)
+            self.assertEqual(P.mask.S[d.ID].data.shape[0], 0)
+
+        # A following serial engine reuses the compact frames
+        engine_params = u.Param()
+        engine_params.name = "EPIE_serial"
+        engine_params.numiter = 5
+        engine_params.compute_fourier_error = True
+        P.run(epars=engine_params)
+        err = np.array([info["error"][0] for info in P.runtime["iter_info"][-5:]])
+        self.assertTrue(np.all(np.isfinite(err)))
+
+
+if __name__ == "__main__":
+    unittest.main()
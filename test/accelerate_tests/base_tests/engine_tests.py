@@ -6,6 +6,7 @@ This file is part of the PTYPY package.
     :license: see LICENSE for details.
 """
 import unittest
+from unittest import mock
 
 from test import utils as tu
 from ptypy import utils as u
@@ -167,5 +168,212 @@ class MLSerialTest(unittest.TestCase):
                                            scanmodel="BlockFull", autosave=False, verbose_level="critical"))
         self.check_engine_output(out, plotting=False, debug=False)
 
+    def test_ML_serial_lbfgs(self):
+        LL = {}
+        for optimizer in ["cg", "lbfgs", "lbfgs_smooth"]:
+            engine_params = u.Param()
+            engine_params.name = "ML_serial"
+            engine_params.numiter = 50
+            engine_params.floating_intensities = False
+            engine_params.reg_del2 = True
+            engine_params.reg_del2_amplitude = 1.
+            engine_params.scale_precond = True
+            engine_params.scale_probe_object = 1e-6
+            engine_params.optimizer = optimizer.split("_")[0]
+            engine_params.lbfgs_memory = 4
+            if optimizer == "lbfgs_smooth":
+                engine_params.smooth_gradient = 20
+                engine_params.smooth_gradient_decay = 1/10.
+            np.random.seed(1)
+            P = tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                    scanmodel="BlockFull", autosave=False, verbose_level="critical")
+            LL[optimizer] = np.array([info["error"][1] for info in P.runtime["iter_info"]])
+        self.assertTrue(np.isfinite(LL["lbfgs"]).all())
+        self.assertLess(LL["lbfgs"][-1], LL["lbfgs"][0])
+        self.assertLess(LL["lbfgs"][-1], 2 * LL["cg"][-1])
+        self.assertTrue(np.isfinite(LL["lbfgs_smooth"]).all())
+        self.assertLess(LL["lbfgs_smooth"][-1], LL["lbfgs_smooth"][0])
+
+    def test_ML_serial_minibatch(self):
+        LL = {}
+        for fraction in [1., 0.3]:
+            engine_params = u.Param()
+            engine_params.name = "ML_serial"
+            engine_params.numiter = 40
+            engine_params.floating_intensities = False
+            engine_params.reg_del2 = True
+            engine_params.reg_del2_amplitude = 1.
+            engine_params.scale_precond = True
+            engine_params.scale_probe_object = 1e-6
+            engine_params.batch_size = 5
+            engine_params.minibatch_fraction = fraction
+            engine_params.minibatch_schedule = "linear"
+            engine_params.minibatch_ramp = 30
+            engine_params.minibatch_sampling = "reshuffle"
+            np.random.seed(1)
+            P = tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                    scanmodel="BlockFull", autosave=False, verbose_level="critical")
+            LL[fraction] = np.array([info["error"][1] for info in P.runtime["iter_info"]])
+        # the last iterations use all frames again
+        self.assertTrue(np.isfinite(LL[0.3]).all())
+        self.assertLess(LL[0.3][-1], LL[0.3][0])
+        self.assertLess(LL[0.3][-1], 2 * LL[1.][-1])
+
+    def test_ML_serial_minibatch_requires_batch_size(self):
+        engine_params = u.Param()
+        engine_params.name = "ML_serial"
+        engine_params.numiter = 5
+        engine_params.minibatch_fraction = 0.3
+        with self.assertRaises(RuntimeError):
+            tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                scanmodel="BlockFull", autosave=False, verbose_level="critical")
+
+    def test_ML_serial_batch_size(self):
+        out = []
+        for batch_size in [None, 7]:
+            engine_params = u.Param()
+            engine_params.name = "ML_serial"
+            engine_params.numiter = 100
+            engine_params.floating_intensities = True
+            engine_params.reg_del2 = False
+            engine_params.reg_del2_amplitude = 1.
+            engine_params.scale_precond = False
+            engine_params.batch_size = batch_size
+            np.random.seed(1)
+            out.append(tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                           scanmodel="BlockFull", autosave=False, verbose_level="critical"))
+        self.check_engine_output(out, plotting=False, debug=False)
+
+    def test_ML_serial_exit_cache(self):
+        out = []
+        for exit_cache_frames in [0, 50]:
+            engine_params = u.Param()
+            engine_params.name = "ML_serial"
+            engine_params.numiter = 100
+            engine_params.floating_intensities = True
+            engine_params.reg_del2 = False
+            engine_params.reg_del2_amplitude = 1.
+            engine_params.scale_precond = False
+            engine_params.batch_size = 7
+            engine_params.exit_cache_frames = exit_cache_frames
+            np.random.seed(1)
+            out.append(tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                           scanmodel="BlockFull", autosave=False, verbose_level="critical"))
+        self.check_engine_output(out, plotting=False, debug=False)
+
+    def test_ML_serial_num_threads(self):
+        out = []
+        for num_threads in [1, 3]:
+            engine_params = u.Param()
+            engine_params.name = "ML_serial"
+            engine_params.numiter = 100
+            engine_params.floating_intensities = True
+            engine_params.reg_del2 = False
+            engine_params.reg_del2_amplitude = 1.
+            engine_params.scale_precond = False
+            engine_params.batch_size = 7
+            engine_params.num_threads = num_threads
+            np.random.seed(1)
+            out.append(tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                           scanmodel="BlockFull", autosave=False, verbose_level="critical"))
+        self.check_engine_output(out, plotting=False, debug=False)
+
+
+class ProjectionalSerialTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="projectional_serial_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def run_engines(self, name, variants, numiter=20, **kwargs):
+        """
+        Run engine `name` once for each dict of parameters in `variants`.
+        """
+        out = []
+        for variant in variants:
+            engine_params = u.Param()
+            engine_params.name = name
+            engine_params.numiter = numiter
+            engine_params.update(kwargs)
+            engine_params.update(variant)
+            np.random.seed(1)
+            out.append(tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                           scanmodel="BlockFull", autosave=False, verbose_level="critical"))
+        return out
+
+    def check_equivalent(self, out, rtol=1e-5):
+        P0 = out[0]
+        err0 = np.array([info["error"] for info in P0.runtime["iter_info"]])
+        for P in out[1:]:
+            err = np.array([info["error"] for info in P.runtime["iter_info"]])
+            np.testing.assert_allclose(err, err0, rtol=rtol)
+            # The object edges are hardly constrained by the data
+            crop = 42
+            for ID, S in P0.obj.S.items():
+                ob0, ob = S.data[..., crop:-crop, crop:-crop], P.obj.S[ID].data[..., crop:-crop, crop:-crop]
+                np.testing.assert_allclose(ob, ob0, rtol=rtol, atol=rtol * np.abs(ob0).max())
+            for ID, S in P0.probe.S.items():
+                np.testing.assert_allclose(P.probe.S[ID].data, S.data, rtol=rtol, atol=rtol * np.abs(S.data).max())
+
+    def check_num_threads(self, name):
+        # Only the order of the floating point sums differs
+        benchmarks = []
+        engine_class = ptypy.accelerate.base.engines.projectional_serial._ProjectionEngine_serial
+        finalize = engine_class.engine_finalize
+
+        def record(engine, *args, **kwargs):
+            benchmarks.append(dict(engine.benchmark))
+            return finalize(engine, *args, **kwargs)
+
+        with mock.patch.object(engine_class, 'engine_finalize', record):
+            out = self.run_engines(name, [dict(num_threads=1), dict(num_threads=3)], batch_size=7)
+        self.check_equivalent(out, rtol=1e-3)
+        # The timings of all threads are added up
+        single, threaded = benchmarks
+        self.assertEqual(threaded['calls_fourier'], single['calls_fourier'])
+        for field in ['A_Build_aux', 'B_Prop', 'C_Fourier_update', 'D_iProp', 'E_Build_exit']:
+            self.assertGreater(threaded[field], 0.)
+
+    def test_DM_serial_num_threads(self):
+        self.check_num_threads("DM_serial")
+
+    def test_RAAR_serial_num_threads(self):
+        self.check_num_threads("RAAR_serial")
+
+    def check_batch_size(self, name, **kwargs):
+        out = self.run_engines(name, [dict(batch_size=None), dict(batch_size=7)], **kwargs)
+        self.check_equivalent(out)
+        return out
+
+    def test_DM_serial_batch_size(self):
+        self.check_batch_size("DM_serial")
+
+    def test_RAAR_serial_batch_size(self):
+        self.check_batch_size("RAAR_serial")
+
+    def test_DM_serial_stream_batch_size(self):
+        self.check_batch_size("DM_serial_stream")
+
+    def test_DM_serial_position_refinement_batch_size(self):
+        position_refinement = u.Param(start=2, stop=12, nshifts=4, amplitude=1e-6, max_shift=2e-6)
+        engine_class = ptypy.accelerate.base.engines.projectional_serial._ProjectionEngine_serial
+        position_error = engine_class._position_error
+        nframes = {None: [], 7: []}
+
+        def record(engine, kern, aux, addr, *args):
+            nframes[engine.p.batch_size].append(addr.shape[0])
+            return position_error(engine, kern, aux, addr, *args)
+
+        with mock.patch.object(engine_class, '_position_error', record):
+            out = self.check_batch_size("DM_serial", position_refinement=position_refinement)
+        # The error of the candidate positions is evaluated in batches
+        self.assertGreater(max(nframes[None]), 7)
+        self.assertEqual(max(nframes[7]), 7)
+        coords = [np.array([v.coord for v in P.obj.S["SMFG00"].views]) for P in out]
+        np.testing.assert_array_equal(coords[1], coords[0])
+
+
 if __name__ == "__main__":
     unittest.main()
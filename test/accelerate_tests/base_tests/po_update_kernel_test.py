@@ -508,5 +508,110 @@ class PoUpdateKernelTest(unittest.TestCase):
         np.testing.assert_array_equal(object_norm, expected_object_norm,
                                       err_msg="The object norm has not been updated as expected")
 
+    def prepare_random_arrays(self, npr=2, nob=2, frame=8, scan_pts=4, step=3):
+        rng = np.random.default_rng(1234)
+        npos = scan_pts ** 2
+        nmodes = npr * nob
+        osize = frame + (scan_pts - 1) * step + 1
+
+        probe = (rng.random((npr, frame, frame)) + 1j * rng.random((npr, frame, frame))).astype(COMPLEX_TYPE)
+        object_array = (rng.random((nob, osize, osize)) + 1j * rng.random((nob, osize, osize))).astype(COMPLEX_TYPE)
+        exit_wave = (rng.random((npos * nmodes, frame, frame)) + 1j * rng.random((npos * nmodes, frame, frame))).astype(COMPLEX_TYPE)
+        auxiliary_wave = (rng.random((npos * nmodes, frame, frame)) + 1j * rng.random((npos * nmodes, frame, frame))).astype(COMPLEX_TYPE)
+
+        addr = np.zeros((npos, nmodes, 5, 3), dtype=INT_TYPE)
+        exit_idx = 0
+        for pos in range(npos):
+            ypos, xpos = (pos // scan_pts) * step + rng.integers(0, 2), (pos % scan_pts) * step + rng.integers(0, 2)
+            mode_idx = 0
+            for pr_mode in range(npr):
+                for ob_mode in range(nob):
+                    addr[pos, mode_idx] = np.array([[pr_mode, 0, 0],
+                                                    [ob_mode, ypos, xpos],
+                                                    [exit_idx, 0, 0],
+                                                    [pos, 0, 0],
+                                                    [pos, 0, 0]], dtype=INT_TYPE)
+                    mode_idx += 1
+                    exit_idx += 1
+
+        return addr, object_array, probe, exit_wave, auxiliary_wave
+
+    def run_both_modes(self, method, *args, **kwargs):
+        results = []
+        for mode in ['loop', 'batched']:
+            POUK = PoUpdateKernel(mode=mode)
+            # force several blocks in batched mode
+            POUK.block_bytes = 3 * 8 * args[0].shape[-1] ** 2
+            POUK.allocate()
+            out = [a.copy() if isinstance(a, np.ndarray) and a.ndim == 3 else a for a in args[1:]]
+            getattr(POUK, method)(args[0], *out, **kwargs)
+            results.append(out)
+        return results
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            PoUpdateKernel(mode='magic')
+
+    def test_ob_update_batched_matches_loop(self):
+        addr, ob, pr, ex, aux = self.prepare_random_arrays()
+        obn = np.zeros(ob.shape, dtype=FLOAT_TYPE)
+        loop, batched = self.run_both_modes('ob_update', addr, ob, obn, pr, ex)
+        for a, b in zip(loop, batched):
+            np.testing.assert_array_equal(a, b, err_msg="Batched ob_update differs from loop")
+
+    def test_pr_update_batched_matches_loop(self):
+        addr, ob, pr, ex, aux = self.prepare_random_arrays()
+        prn = np.zeros(pr.shape, dtype=FLOAT_TYPE)
+        loop, batched = self.run_both_modes('pr_update', addr, pr, prn, ob, ex)
+        for a, b in zip(loop, batched):
+            np.testing.assert_array_equal(a, b, err_msg="Batched pr_update differs from loop")
+
+    def test_ML_updates_batched_match_loop(self):
+        addr, ob, pr, ex, aux = self.prepare_random_arrays()
+        loop, batched = self.run_both_modes('ob_update_ML', addr, ob, pr, ex, fac=2.0)
+        np.testing.assert_array_equal(loop[0], batched[0], err_msg="Batched ob_update_ML differs from loop")
+        loop, batched = self.run_both_modes('pr_update_ML', addr, pr, ob, ex, fac=2.0)
+        np.testing.assert_array_equal(loop[0], batched[0], err_msg="Batched pr_update_ML differs from loop")
+
+    def test_local_updates_batched_match_loop(self):
+        addr, ob, pr, ex, aux = self.prepare_random_arrays(npr=1, nob=1)
+        nframes = addr.shape[0]
+        obn = np.zeros((nframes,) + ex.shape[-2:], dtype=FLOAT_TYPE)
+        prn = np.zeros((nframes,) + ex.shape[-2:], dtype=FLOAT_TYPE)
+
+        loop, batched = self.run_both_modes('ob_norm_local', addr, ob, obn)
+        np.testing.assert_array_equal(loop[1], batched[1], err_msg="Batched ob_norm_local differs from loop")
+        obn = loop[1]
+        loop, batched = self.run_both_modes('pr_norm_local', addr, pr, prn)
+        np.testing.assert_array_equal(loop[1], batched[1], err_msg="Batched pr_norm_local differs from loop")
+        prn = loop[1]
+
+        loop, batched = self.run_both_modes('ob_update_local', addr, ob, pr, ex, aux, prn, a=0.1, b=0.9)
+        np.testing.assert_array_equal(loop[0], batched[0], err_msg="Batched ob_update_local differs from loop")
+        loop, batched = self.run_both_modes('pr_update_local', addr, pr, ob, ex, aux, obn, obn.max(), a=0.1, b=0.9)
+        np.testing.assert_array_equal(loop[0], batched[0], err_msg="Batched pr_update_local differs from loop")
+
+    def test_wasp_updates_batched_match_loop(self):
+        addr, ob, pr, ex, aux = self.prepare_random_arrays()
+        nmr, dnm = np.zeros_like(ob), np.zeros(ob.shape, dtype=FLOAT_TYPE)
+        loop, batched = self.run_both_modes('ob_update_wasp', addr, ob, pr, ex, aux, nmr, dnm, alpha=0.5)
+        for a, b in zip(loop[:1] + loop[3:], batched[:1] + batched[3:]):
+            np.testing.assert_allclose(a, b, rtol=1e-6, err_msg="Batched ob_update_wasp differs from loop")
+        nmr, dnm = np.zeros_like(pr), np.zeros(pr.shape, dtype=FLOAT_TYPE)
+        loop, batched = self.run_both_modes('pr_update_wasp', addr, pr, ob, ex, aux, nmr, dnm, beta=0.5)
+        for a, b in zip(loop[:1] + loop[3:], batched[:1] + batched[3:]):
+            np.testing.assert_allclose(a, b, rtol=1e-6, err_msg="Batched pr_update_wasp differs from loop")
+
+    def test_batched_only_for_small_frames(self):
+        addr, ob, pr, ex, aux = self.prepare_random_arrays()
+        POUK = PoUpdateKernel(mode='batched')
+        self.assertTrue(POUK._batched(addr, ex.shape))
+        # a single view
+        self.assertFalse(POUK._batched(addr[:1, :1], ex.shape))
+        # frames at the crossover
+        POUK.batch_max_pixels = ex.shape[-2] * ex.shape[-1]
+        self.assertFalse(POUK._batched(addr, ex.shape))
+        self.assertFalse(PoUpdateKernel(mode='loop')._batched(addr, ex.shape))
+
 if __name__ == '__main__':
     unittest.main()
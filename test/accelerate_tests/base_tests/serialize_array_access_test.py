@@ -0,0 +1,70 @@
+'''
+Tests for the address serialization of the serial engines
+'''
+
+import unittest
+import numpy as np
+from ptypy.core import Ptycho
+from ptypy import utils as u
+from ptypy.accelerate.base.engines.projectional_serial import serialize_array_access
+
+
+def reference_addresses(diff_storage):
+    views = sorted(diff_storage.views, key=lambda v: v.dlayer)
+    addr = []
+    for view in views:
+        addr.append([[(v.dlayer, v.dlow[0], v.dlow[1]) for v in
+                      (pod.pr_view, pod.ob_view, pod.ex_view, pod.di_view, pod.ma_view)]
+                     for pod in view.pods.values()])
+    return [v.ID for v in views], np.array(addr).astype(np.int32)
+
+
+class SerializeArrayAccessTest(unittest.TestCase):
+
+    def test_incremental_table(self):
+        p = u.Param()
+        p.verbose_level = "error"
+        p.frames_per_block = 20
+        p.io = u.Param()
+        p.io.rfile = None
+        p.io.autosave = u.Param(active=False)
+        p.io.autoplot = u.Param(active=False)
+        p.io.interaction = u.Param(active=False)
+        p.scans = u.Param()
+        p.scans.MF = u.Param()
+        p.scans.MF.name = 'Full'
+        p.scans.MF.coherence = u.Param(num_probe_modes=2)
+        p.scans.MF.illumination = u.Param(diversity=None)
+        p.scans.MF.data = u.Param()
+        p.scans.MF.data.name = 'MoonFlowerScan'
+        p.scans.MF.data.shape = 32
+        p.scans.MF.data.num_frames = 60
+        p.scans.MF.data.save = None
+        p.scans.MF.data.block_wait_count = 1
+        P = Ptycho(p, level=1)
+
+        table = u.Param()
+        nviews = []
+        while P.model.data_available:
+            P.new_data = P.model.new_data()
+            d = list(P.diff.storages.values())[0]
+            view_IDs, poe_IDs, addr = serialize_array_access(d, table=table)
+            ref_IDs, ref_addr = reference_addresses(d)
+            self.assertEqual(addr.shape[1], 2)
+            nviews.append(addr.shape[0])
+            self.assertListEqual(view_IDs, ref_IDs)
+            np.testing.assert_array_equal(addr, ref_addr)
+            pod = d.views[0].pod
+            self.assertEqual(poe_IDs, (pod.pr_view.storage.ID,
+                                       pod.ob_view.storage.ID,
+                                       pod.ex_view.storage.ID))
+
+            # A full build gives the same result
+            np.testing.assert_array_equal(serialize_array_access(d)[2], addr)
+
+        self.assertGreater(len(nviews), 1)
+        self.assertEqual(nviews[-1], 60)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+"""
+Tests for the region-restricted object reduction of DM_serial.
+
+The MPI class is run by the driver test on several processes, it may
+also be run directly with ``mpirun -np 4 pytest sparse_allreduce_test.py``.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+
+from test import utils as tu
+from ptypy import utils as u
+from ptypy.utils import parallel
+import ptypy
+ptypy.load_gpu_engines("serial")
+import tempfile
+import shutil
+import numpy as np
+
+
+class DMSerialSparseMPITest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="sparse_allreduce_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def test_DM_serial_sparse(self):
+        out = []
+        for sparse in [False, True]:
+            engine_params = u.Param()
+            engine_params.name = "DM_serial"
+            engine_params.numiter = 10
+            engine_params.alpha = 1.
+            engine_params.probe_update_start = 0
+            engine_params.overlap_converge_factor = 0.001
+            engine_params.overlap_max_iterations = 5
+            engine_params.object_inertia = 1e-3
+            engine_params.sparse_allreduce = sparse
+            np.random.seed(1)
+            out.append(tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                           scanmodel="BlockFull", autosave=False, verbose_level="critical"))
+        P_dense, P_sparse = out
+        if parallel.size > 1:
+            self.assertTrue(P_sparse.engines["engine00"]._sparse_allreduce())
+        # Only the summation order differs, which DM amplifies slowly over the iterations
+        rtol = 1e-3
+        err_dense, err_sparse = [np.array([info["error"] for info in P.runtime["iter_info"]]) for P in out]
+        self.assertEqual(len(err_sparse), 10)
+        np.testing.assert_allclose(err_sparse, err_dense, rtol=rtol,
+                                   err_msg="The sparse and dense errors are not matching as expected")
+        # The object edges are hardly constrained by the data
+        crop = 42
+        for sID in P_dense.obj.S.keys():
+            ob_dense = P_dense.obj.S[sID].data[..., crop:-crop, crop:-crop]
+            ob_sparse = P_sparse.obj.S[sID].data[..., crop:-crop, crop:-crop]
+            np.testing.assert_allclose(ob_sparse, ob_dense, rtol=rtol, atol=rtol * np.abs(ob_dense).max(),
+                                       err_msg="The sparse and dense objects are not matching as expected")
+        for sID in P_dense.probe.S.keys():
+            pr_dense = P_dense.probe.S[sID].data
+            np.testing.assert_allclose(P_sparse.probe.S[sID].data, pr_dense, rtol=rtol, atol=rtol * np.abs(pr_dense).max(),
+                                       err_msg="The sparse and dense probes are not matching as expected")
+
+
+class DMSerialSparseTest(unittest.TestCase):
+
+    def test_DM_serial_sparse_mpi(self):
+        out = tu.MPITestRunner(__file__ + '::DMSerialSparseMPITest', nprocs=4)
+        if out is None:
+            self.skipTest("mpirun not available or already running under MPI")
+        self.assertEqual(out.returncode, 0, msg=out.stdout.decode(errors='replace'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,114 @@
+"""
+Tests for the mini-batch mode of the serial stochastic engines.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+from unittest import mock
+
+from test import utils as tu
+from ptypy import utils as u
+import ptypy
+ptypy.load_gpu_engines("serial")
+from ptypy.accelerate.base.engines import stochastic
+from ptypy.accelerate.base.engines.stochastic import schedule_batches
+import tempfile
+import shutil
+import numpy as np
+
+
+class ScheduleBatchesTest(unittest.TestCase):
+
+    def test_conflict_free(self):
+        rng = np.random.default_rng(0)
+        pos = rng.integers(0, 200, size=(300, 2))
+        order = rng.permutation(300)
+        shape = (32, 24)
+        batches = schedule_batches(order, pos, shape, 8)
+
+        # Every view is scheduled once, in order within each batch
+        np.testing.assert_array_equal(np.sort(np.concatenate(batches)), np.arange(300))
+        rank = np.argsort(order)
+        for b in batches:
+            self.assertLessEqual(len(b), 8)
+            self.assertTrue(np.all(np.diff(rank[b]) > 0))
+            d = np.abs(pos[b][:, None] - pos[b][None, :])
+            overlap = (d[..., 0] < shape[0]) & (d[..., 1] < shape[1])
+            np.testing.assert_array_equal(overlap, np.eye(len(b), dtype=bool))
+
+    def test_overlap(self):
+        order = np.arange(10)[::-1]
+        batches = schedule_batches(order, np.zeros((10, 2)), (8, 8), 4, overlap=True)
+        self.assertListEqual([b.tolist() for b in batches], [[9, 8, 7, 6], [5, 4, 3, 2], [1, 0]])
+
+
+class StochasticBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="stochastic_batch_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def run_engine(self, name, batch_size, schedule=None, **kwargs):
+        engine_params = u.Param()
+        engine_params.name = name
+        engine_params.numiter = 10
+        engine_params.compute_fourier_error = True
+        engine_params.batch_size = batch_size
+        engine_params.update(kwargs)
+        # Same view order in all runs
+        default_rng = np.random.default_rng
+        with mock.patch.object(np.random, 'default_rng', lambda seed=0: default_rng(seed)), \
+                mock.patch.object(stochastic, 'schedule_batches', schedule or schedule_batches):
+            np.random.seed(1)
+            P = tu.EngineTestRunner(engine_params, output_path=self.outpath, init_correct_probe=True,
+                                    scanmodel="BlockFull", autosave=False, verbose_level="critical")
+        err = np.array([info["error"][0] for info in P.runtime["iter_info"]])
+        self.assertTrue(np.all(np.isfinite(err)))
+        self.assertLess(err[-1], err[0])
+        return P.obj.S["SMFG00"].data, err
+
+    def check_engine(self, name, **kwargs):
+        # Without probe update, the object updates of conflict-free batches are
+        # the same as those of their views one after the other
+        kwargs.update(probe_update_start=100)
+
+        def single(order, *args, **kw):
+            return [order[i:i + 1] for i in range(len(order))]
+
+        def one_by_one(*args, **kw):
+            return single(np.concatenate(schedule_batches(*args, **kw)))
+
+        # Single views in the batched code path
+        ob_view, err_view = self.run_engine(name, 1, **kwargs)
+        ob_single, err_single = self.run_engine(name, 4, single, **kwargs)
+        np.testing.assert_allclose(ob_single, ob_view, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(err_single, err_view, rtol=1e-5)
+
+        # Batches and their views one by one, in the same order
+        ob_batch, err_batch = self.run_engine(name, 4, **kwargs)
+        ob_seq, err_seq = self.run_engine(name, 4, one_by_one, **kwargs)
+        np.testing.assert_allclose(ob_batch, ob_seq, rtol=1e-6, atol=1e-6)
+        np.testing.assert_allclose(err_batch, err_seq, rtol=1e-5)
+
+    def test_EPIE_serial_batch(self):
+        self.check_engine("EPIE_serial")
+
+    def test_SDR_serial_batch(self):
+        self.check_engine("SDR_serial", sigma=0.5, tau=0.1)
+
+    def test_EPIE_serial_batch_overlap(self):
+        # The updates of overlapping views are added up, so the batches only
+        # approximate the views one after the other
+        kwargs = dict(alpha=0.5, probe_update_start=100)
+        ob_view, err_view = self.run_engine("EPIE_serial", 1, **kwargs)
+        ob_batch, err_batch = self.run_engine("EPIE_serial", 4, batch_overlap=True, **kwargs)
+        np.testing.assert_allclose(err_batch[-1], err_view[-1], rtol=1e-2)
+        np.testing.assert_allclose(ob_batch, ob_view, atol=5e-2)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,11 @@
+"""
+Test session setup.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import os
+
+# Test runs, including the mpirun subprocesses, never write a descriptor cache
+os.environ['PTYPY_CACHE_DIR'] = ''
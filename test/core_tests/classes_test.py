@@ -487,6 +487,40 @@ class TestContainer(unittest.TestCase):
             'Returning list of views on :any:`Storage` `s` failed.'
         )
 
+    def test_view_records(self):
+        """Views stay rows of the container view table"""
+        C = c.Container(data_type='real')
+        S = C.new_storage(ID='S0', psize=1., shape=(1, 10, 10))
+        views = [c.View(C, accessrule={'storageID': 'S0', 'shape': (4, 4),
+                                       'psize': 1., 'coord': (i, 2 * i),
+                                       'layer': i})
+                 for i in range(50)]
+        views[3].active = False
+        recs = C.view_records
+        self.assertEqual(len(recs), 50)
+        np.testing.assert_array_equal(recs['layer'], np.arange(50))
+        np.testing.assert_array_equal(
+            C.view_rows(S), np.delete(np.arange(50), 3))
+        self.assertListEqual(C.views_in_storage(S), views[:3] + views[4:])
+
+        # The vectorized update matches the per-view update
+        S.update_views()
+        for v in views[:3] + views[4:]:
+            dlow, dhigh = v.dlow.copy(), v.dhigh.copy()
+            S.update_views(v)
+            np.testing.assert_array_equal(v.dlow, dlow)
+            np.testing.assert_array_equal(v.dhigh, dhigh)
+        dlow = views[10].dlow.copy()
+        recs['coord'][:, :2] += 1.
+        S.update_views()
+        np.testing.assert_array_equal(views[10].dlow, dlow + 1)
+
+        # Copies are added to the table
+        vc = views[10].copy()
+        self.assertEqual(len(C.view_records), 51)
+        np.testing.assert_array_equal(C.view_records[-1]['dlow'][:2],
+                                      vc.dlow)
+
     @unittest.skip('Function fails during storage creation')
     def test_copy(self):
         """Create a new :any:`Container` matching self"""
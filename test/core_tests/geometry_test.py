@@ -104,7 +104,60 @@ class GeometryTest(unittest.TestCase):
         G = self.set_up_farfield()
         P = BasicFarfieldPropagator(G.p,ffttype="scipy")
         self. _basic_propagator_test(P)
-    
+
+    def _inplace_propagator_test(self, prop):
+
+        # Create random stack of 2D arrays
+        S = (4,) + tuple(prop.sh)
+        A = (np.random.random(S) + 1j * np.random.random(S)).astype(prop.dtype)
+
+        # Out-of-place reference
+        B = prop.fw(A)
+        C = prop.bw(A)
+
+        # In-place transforms
+        D = A.copy()
+        E = prop.fw_inplace(D)
+        F = A.copy()
+        prop.bw_inplace(F)
+
+        # asserts
+        assert (E is D), "fw_inplace did not return its input, using {:s}".format(prop.FFTch.ffttype)
+        np.testing.assert_allclose(B, D, rtol=1e-4, atol=1e-4, err_msg="fw_inplace(x) differs from fw(x), using {:s}".format(prop.FFTch.ffttype))
+        np.testing.assert_allclose(C, F, rtol=1e-4, atol=1e-4, err_msg="bw_inplace(x) differs from bw(x), using {:s}".format(prop.FFTch.ffttype))
+        prop.bw_inplace(D)
+        np.testing.assert_allclose(A, D, rtol=1e-4, atol=1e-4, err_msg="bw_inplace(fw_inplace(x)) did not return x, using {:s}".format(prop.FFTch.ffttype))
+
+    def test_inplace_nearfield_propagator(self):
+        G = self.set_up_nearfield()
+        for ffttype in ["fftw", "numpy", "scipy"]:
+            P = BasicNearfieldPropagator(G.p,ffttype=ffttype,dtype=np.complex64)
+            self._inplace_propagator_test(P)
+
+    def test_inplace_farfield_propagator(self):
+        G = self.set_up_farfield()
+        for ffttype in ["fftw", "numpy", "scipy"]:
+            P = BasicFarfieldPropagator(G.p,ffttype=ffttype,dtype=np.complex64,workers=2)
+            self._inplace_propagator_test(P)
+
+    def test_fftw_plans_per_thread(self):
+        import gc
+        import threading
+        G = self.set_up_farfield()
+        P = BasicFarfieldPropagator(G.p,ffttype="fftw",dtype=np.complex64)
+        A = np.ones((2,) + tuple(P.sh), dtype=np.complex64)
+        P.fw_inplace(A.copy())
+        threads = [threading.Thread(target=P.fw_inplace, args=(A.copy(),)) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(len(P.FFTch._plans), 4)
+        # plans of finished threads are released with them
+        del threads, t
+        gc.collect()
+        self.assertEqual(len(P.FFTch._plans), 1)
+
 
 
 if __name__ == '__main__':
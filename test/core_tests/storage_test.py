@@ -52,6 +52,48 @@ class StorageTest(unittest.TestCase):
         S.reformat()
         assert np.allclose(S[V], 1.)
 
+    def test_storage_reformat_incremental(self):
+        """
+        Test that incremental reformatting matches a full reformat
+        """
+        C1 = Container(data_dims=2, data_type='real')
+        C2 = Container(data_dims=2, data_type='real')
+        S1 = C1.new_storage(psize=1., padonly=True)
+        S2 = C2.new_storage(psize=1., padonly=True)
+        for chunk in range(4):
+            for i in range(10):
+                n = 10 * chunk + i
+                for C, S in [(C1, S1), (C2, S2)]:
+                    V = View(container=C, storageID=S.ID, shape=(8, 8),
+                             coord=(3. * n, -2. * n), layer=100 - n)
+                    V.data = n
+            S1.reformat()
+            S2.reformat(incremental=True)
+            assert S1.shape == S2.shape
+            assert S1.layermap == S2.layermap
+            np.testing.assert_array_equal(S1.center, S2.center)
+            np.testing.assert_array_equal(S1.data, S2.data)
+            for V1, V2 in zip(C1.V.values(), C2.V.values()):
+                np.testing.assert_array_equal(S1[V1], S2[V2])
+                assert V2.dlayer == S2.layermap.index(V2.layer)
+
+        # The layer slots follow the layermap
+        for i, l in enumerate(S2.layermap):
+            assert S2.layer_slot(l) == i
+        assert S2.layer_slot(1000) is None
+        S2.data[:] = 7.
+        S2.put_layers([100, 61, 99], np.zeros((3,) + S2.shape[1:]))
+        assert (S2[100] == 0).all() and (S2[61] == 0).all()
+        assert (S2[62] == 7).all()
+        S2.put_layers([62, 63], np.ones((2,) + S2.shape[1:]))
+        assert (S2[62] == 1).all() and (S2[63] == 1).all()
+        assert (S2[64] == 7).all()
+
+        # Deactivating a view falls back to a full reformat
+        list(C2.V.values())[0].active = False
+        S2.reformat(incremental=True)
+        assert 100 not in S2.layermap
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -7,6 +7,7 @@ This file is part of the PTYPY package.
 """
 
 import unittest
+import numpy as np
 from test import utils as tu
 from ptypy import utils as u
 import tempfile
@@ -49,5 +50,47 @@ class DMTest(unittest.TestCase):
         engine_params.obj_smooth_std = 20
         tu.EngineTestRunner(engine_params, output_path=self.outpath)
 
+    def test_DM_stopping(self):
+        engine_params = u.Param()
+        engine_params.name = 'DM'
+        engine_params.numiter = 200
+        engine_params.numiter_contiguous = 2
+        engine_params.stopping = u.Param(active=True, rtol=1e-2, patience=6)
+        P = tu.EngineTestRunner(engine_params, output_path=self.outpath, autosave=False, verbose_level="critical")
+        engine = P.engines['engine00']
+        self.assertIsNotNone(engine.stop_reason)
+        self.assertLess(engine.curiter, 200)
+        err = [info['error'][1] for info in P.runtime.iter_info]
+        self.assertGreater(min(err[-3:]), 0.99 * min(err[:-3]))
+
+    def test_DM_stopping_target(self):
+        engine_params = u.Param()
+        engine_params.name = 'DM'
+        engine_params.numiter = 20
+        engine_params.stopping = u.Param(active=True, metric='fourier', target=1e10)
+        P = tu.EngineTestRunner(engine_params, output_path=self.outpath, autosave=False, verbose_level="critical")
+        self.assertEqual(P.engines['engine00'].curiter, 1)
+        self.assertEqual(len(P.runtime.iter_info), 1)
+
+    def test_DM_error_statistics(self):
+        engine_params = u.Param()
+        engine_params.name = 'DM'
+        engine_params.numiter = 5
+        engine_params.record_local_error = True
+        engine_params.record_local_error_interval = 2
+        P = tu.EngineTestRunner(engine_params, output_path=self.outpath, autosave=False, verbose_level="critical")
+        engine = P.engines['engine00']
+        # The local errors are from the last iteration with a gathered map
+        self.assertEqual(engine._next_local_error, 7)
+        errs = np.array(list(engine.error.values()))
+        info = P.runtime.iter_info[-1]
+        np.testing.assert_allclose(info['error'], errs.mean(0))
+        np.testing.assert_allclose(info['error_min'], errs.min(0))
+        np.testing.assert_allclose(info['error_max'], errs.max(0))
+        hist = P.runtime.error_hist
+        self.assertEqual(hist.shape, (3, len(P.runtime.error_hist_edges) + 1))
+        np.testing.assert_array_equal(hist.sum(1), len(errs))
+
+
 if __name__ == "__main__":
     unittest.main()
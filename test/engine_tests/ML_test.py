@@ -7,8 +7,10 @@ This file is part of the PTYPY package.
 """
 
 import unittest
+import numpy as np
 from test import utils as tu
 from ptypy import utils as u
+from ptypy.engines.ML import LBFGS
 import tempfile
 import shutil
 
@@ -49,6 +51,85 @@ class MLTest(unittest.TestCase):
         tu.EngineTestRunner(engine_params, output_path=self.outpath)
 
 
+    def test_ML_farfield_lbfgs(self):
+        engine_params = u.Param()
+        engine_params.name = 'ML'
+        engine_params.numiter = 5
+        engine_params.floating_intensities = False
+        engine_params.intensity_renormalization = 1.0
+        engine_params.reg_del2 =True
+        engine_params.reg_del2_amplitude = 0.01
+        engine_params.smooth_gradient = 0.0
+        engine_params.scale_precond =False
+        engine_params.probe_update_start = 0
+        engine_params.optimizer = 'lbfgs'
+        engine_params.lbfgs_memory = 3
+        tu.EngineTestRunner(engine_params, output_path=self.outpath)
+
+    def test_ML_farfield_lbfgs_smooth(self):
+        engine_params = u.Param()
+        engine_params.name = 'ML'
+        engine_params.numiter = 5
+        engine_params.floating_intensities = False
+        engine_params.intensity_renormalization = 1.0
+        engine_params.reg_del2 =True
+        engine_params.reg_del2_amplitude = 0.01
+        engine_params.smooth_gradient = 2.0
+        engine_params.smooth_gradient_decay = 0.1
+        engine_params.scale_precond =False
+        engine_params.probe_update_start = 0
+        engine_params.optimizer = 'lbfgs'
+        engine_params.lbfgs_memory = 3
+        P = tu.EngineTestRunner(engine_params, output_path=self.outpath)
+        err = np.array([info["error"][1] for info in P.runtime["iter_info"]])
+        self.assertTrue(np.all(np.isfinite(err)))
+
+        # Without history, the direction is the smoothed and scaled gradient
+        lbfgs = LBFGS(P.obj, P.probe, 2)
+        ob_grad, pr_grad, ob_h, pr_h = [c.copy(c.ID + '_test%d' % i, fill=0.)
+                                        for i, c in enumerate([P.obj, P.probe, P.obj, P.probe])]
+        rng = np.random.default_rng(0)
+        for c in [ob_grad, pr_grad]:
+            for s in c.storages.values():
+                s.data[:] = rng.normal(size=s.shape) + 1j * rng.normal(size=s.shape)
+        lbfgs.direction(ob_grad, pr_grad, ob_h, pr_h, 0.5, smooth=lambda x: 2 * x)
+        for name, s in ob_h.storages.items():
+            np.testing.assert_allclose(s.data, -2 * ob_grad.S[name].data, rtol=1e-6)
+        for name, s in pr_h.storages.items():
+            np.testing.assert_allclose(s.data, -0.5 * pr_grad.S[name].data, rtol=1e-6)
+
+    def test_ML_farfield_minibatch(self):
+        engine_params = u.Param()
+        engine_params.name = 'ML'
+        engine_params.numiter = 5
+        engine_params.floating_intensities = False
+        engine_params.intensity_renormalization = 1.0
+        engine_params.reg_del2 =True
+        engine_params.reg_del2_amplitude = 0.01
+        engine_params.smooth_gradient = 0.0
+        engine_params.scale_precond =True
+        engine_params.probe_update_start = 0
+        engine_params.minibatch_fraction = 0.3
+        engine_params.minibatch_schedule = 'linear'
+        engine_params.minibatch_ramp = 4
+        engine_params.minibatch_sampling = 'reshuffle'
+        P = tu.EngineTestRunner(engine_params, output_path=self.outpath)
+        engine = P.engines['engine00']
+        # The last iteration used all frames
+        self.assertIsNone(engine.batch)
+
+        # Reshuffling uses every frame once per pass
+        engine._batch_queue = None
+        idx = np.concatenate([engine._draw_batch(10, 3) for i in range(3)])
+        self.assertEqual(len(np.unique(idx)), 9)
+        idx = np.concatenate([idx, engine._draw_batch(10, 3)])
+        self.assertEqual(len(np.unique(idx)), 10)
+
+        # Stratified sampling draws one frame per group
+        engine.p.minibatch_sampling = 'stratified'
+        idx = engine._draw_batch(10, 3)
+        np.testing.assert_array_equal(np.digitize(idx, [3, 6]), [0, 1, 2])
+
     def test_ML_nearfield(self):
         engine_params = u.Param()
         engine_params.name = 'ML'
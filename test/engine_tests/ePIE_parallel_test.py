@@ -0,0 +1,113 @@
+"""
+Test for the ePIEparallel engine.
+
+The MPI class is run by the driver test on several processes, it may
+also be run directly with ``mpirun -np 4 pytest ePIE_parallel_test.py``.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+import random
+import tempfile
+import shutil
+from unittest import mock
+import numpy as np
+
+from test import utils as tu
+from ptypy import utils as u
+from ptypy.utils import parallel
+from ptypy.custom import ePIE_parallel
+
+
+def run_engine(outpath, **kwargs):
+    engine_params = u.Param()
+    engine_params.name = 'ePIEparallel'
+    engine_params.numiter = 5
+    engine_params.probe_update_start = 1
+    engine_params.average_probe = True
+    engine_params.update(kwargs)
+    np.random.seed(1)
+    random.seed(parallel.rank)
+    return tu.EngineTestRunner(engine_params, output_path=outpath, init_correct_probe=True,
+                               autosave=False, verbose_level="critical")
+
+
+class EPIEParallelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="ePIE_parallel_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def test_ePIE_parallel(self):
+        P = run_engine(self.outpath)
+        err = np.array([info["error"][0] for info in P.runtime["iter_info"]])
+        self.assertTrue(np.all(np.isfinite(err)))
+
+    def test_subtract(self):
+        subtract = ePIE_parallel.EPIEParallel._subtract
+        region = (2, 10, 3, 12)
+        for other in [(0, 20, 0, 20), (4, 6, 5, 8), (0, 5, 10, 30), (20, 30, 0, 5), (0, 0, 0, 0)]:
+            mask = np.zeros((32, 32), dtype=bool)
+            mask[2:10, 3:12] = True
+            mask[other[0]:other[1], other[2]:other[3]] = False
+            parts = np.zeros_like(mask, dtype=int)
+            for y0, y1, x0, x1 in subtract(region, other):
+                parts[y0:y1, x0:x1] += 1
+            np.testing.assert_array_equal(parts, mask)
+
+
+class EPIEParallelSparseMPITest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="ePIE_parallel_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def test_sparse_allreduce(self):
+        # Record the object storages before the engine restores the full object
+        shapes = {}
+        finalize = ePIE_parallel.EPIEParallel.engine_finalize
+        def record(engine):
+            shapes.update((name, (s.data.shape, engine.ob_regions.get(name))) for name, s in engine.ob.S.items())
+            finalize(engine)
+        P_dense = run_engine(self.outpath, sparse_allreduce=False)
+        with mock.patch.object(ePIE_parallel.EPIEParallel, 'engine_finalize', record):
+            P_sparse = run_engine(self.outpath, sparse_allreduce=True)
+        if parallel.size > 1:
+            self.assertTrue(P_sparse.engines["engine00"]._sparse_allreduce())
+            self.assertTrue(shapes)
+            for name, (shape, (y0, y1, x0, x1)) in shapes.items():
+                full_shape = P_dense.obj.S[name].data.shape
+                if parallel.master:
+                    self.assertEqual(shape, full_shape)
+                else:
+                    # Other nodes only held their tile
+                    self.assertEqual(shape, full_shape[:-2] + (y1 - y0, x1 - x0))
+                    self.assertLess(np.prod(shape), np.prod(full_shape))
+        for sID in P_dense.obj.S.keys():
+            self.assertTrue(np.all(np.isfinite(P_dense.obj.S[sID].data)))
+            np.testing.assert_allclose(P_sparse.obj.S[sID].data, P_dense.obj.S[sID].data, rtol=1e-5, atol=1e-5,
+                                       err_msg="The sparse and dense objects are not matching as expected")
+        for sID in P_dense.probe.S.keys():
+            probe = P_dense.probe.S[sID].data
+            self.assertTrue(np.all(np.isfinite(probe)))
+            np.testing.assert_allclose(P_sparse.probe.S[sID].data, probe, rtol=1e-5, atol=1e-5 * np.abs(probe).max(),
+                                       err_msg="The sparse and dense probes are not matching as expected")
+
+
+class MPITest(unittest.TestCase):
+
+    def test_sparse_allreduce_mpi(self):
+        out = tu.MPITestRunner(__file__ + '::EPIEParallelSparseMPITest', nprocs=4)
+        if out is None:
+            self.skipTest("mpirun not available or already running under MPI")
+        self.assertEqual(out.returncode, 0, msg=out.stdout.decode(errors='replace'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,66 @@
+"""
+Test for the position refinement module.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+
+import unittest
+import numpy as np
+from test import utils as tu
+from ptypy import utils as u
+from ptypy.engines.posref import GridSearchRefine
+import tempfile
+import shutil
+
+
+class PosrefTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="posref_test")
+
+    def tearDown(self):
+        shutil.rmtree(self.outpath)
+
+    def test_batched_candidates(self):
+        engine_params = u.Param()
+        engine_params.name = 'DM'
+        engine_params.numiter = 3
+        P = tu.EngineTestRunner(engine_params, output_path=self.outpath,
+                                autosave=False, verbose_level="error")
+
+        p = u.Param(amplitude=3e-6, max_shift=4e-6, batch_size=7)
+        posref = GridSearchRefine(p, P.obj, metric="photon")
+        posref.max_shift_dist = p.amplitude
+        di_view = list(P.diff.views.values())[10]
+        ob_view = di_view.pod.ob_view
+        coord = ob_view.coord.copy()
+        psize = ob_view.psize[0]
+        coords = coord + psize * np.array([[0, 0], [1, 0], [0, -2], [3, 1], [-1, -1]])
+
+        # Batched evaluation does not move the view
+        patches, valid = posref._candidate_patches(ob_view, coords)
+        np.testing.assert_array_equal(ob_view.coord, coord)
+        np.testing.assert_array_equal(valid, np.arange(len(coords)))
+        errors = posref.fourier_error(di_view, patches)
+
+        # Same errors as moving the view to each candidate
+        for c, e in zip(coords, errors):
+            ob_view.coord = c
+            ob_view.storage.update_views(ob_view)
+            np.testing.assert_allclose(posref.fourier_error(di_view, ob_view.data), e, rtol=1e-5)
+        ob_view.coord = coord
+        ob_view.storage.update_views(ob_view)
+
+        best, error = posref._best_candidate(di_view, coords, np.inf)
+        self.assertEqual(best, np.argmin(errors))
+
+        # Full grid search refinement
+        delta = posref.update_view_position(di_view)
+        np.testing.assert_allclose(ob_view.coord, coord + delta)
+        self.assertLessEqual(np.linalg.norm(delta), p.max_shift)
+
+
+if __name__ == "__main__":
+    unittest.main()
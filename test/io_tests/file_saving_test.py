@@ -5,9 +5,11 @@ Tests whether the framework saves the output files
 import unittest
 import tempfile
 import h5py as h5
+import numpy as np
 
 from test import utils as tu
 import ptypy.utils as u
+from ptypy.io import h5options
 
 class FileSavingTest(unittest.TestCase):
     def test_output_file_saving_rfile_is_None(self):
@@ -180,3 +182,83 @@ class FileSavingTest(unittest.TestCase):
             probe = f['/content/probe/SMFG00/data'][0]
         except KeyError:
             self.fail(msg="Couldn't load the probe data")
+
+    def test_output_file_saving_threaded_save_run(self):
+        engine_params = u.Param()
+        engine_params.name = 'DM'
+        engine_params.numiter = 5
+        engine_params.alpha =1
+        engine_params.probe_update_start = 2
+        engine_params.overlap_converge_factor = 0.05
+        engine_params.overlap_max_iterations = 10
+        engine_params.probe_inertia = 1e-3
+        engine_params.object_inertia = 0.1
+        engine_params.fourier_relax_factor = 0.01
+        engine_params.obj_smooth_std = 20
+        outpath = tempfile.mkdtemp(prefix='something')
+        PtychoOutput = tu.EngineTestRunner(engine_params,propagator='farfield', output_path=outpath, output_file=None)
+        file_path = outpath + 'reconstruction.h5'
+
+        obj = PtychoOutput.obj.S['SMFG00'].data.copy()
+        PtychoOutput.save_run(file_path, kind='minimal', threaded=True)
+        # the saved object is a snapshot taken when save_run was called
+        PtychoOutput.obj.S['SMFG00'].data[:] = 0.
+        PtychoOutput.wait_for_save()
+
+        try:
+            f = h5.File(file_path, 'r')
+        except IOError:
+            self.fail(msg="File does not exist")
+
+        np.testing.assert_array_equal(f['/content/obj/SMFG00/data'][()], obj,
+                                      err_msg="The saved object is not the snapshot")
+        f.close()
+
+    def test_threaded_save_run_error(self):
+        engine_params = u.Param()
+        engine_params.name = 'DM'
+        engine_params.numiter = 2
+        outpath = tempfile.mkdtemp(prefix='something')
+        PtychoOutput = tu.EngineTestRunner(engine_params, propagator='farfield', output_path=outpath,
+                                           output_file=None, autosave=False, verbose_level="critical")
+        # The parent of the destination is a file, the write fails
+        blocker = outpath + '/blocker'
+        open(blocker, 'w').close()
+        h5opt = h5options['UNSUPPORTED']
+        PtychoOutput.save_run(blocker + '/reconstruction.h5', kind='minimal', threaded=True)
+        with self.assertRaises(OSError):
+            PtychoOutput.wait_for_save()
+        self.assertEqual(h5options['UNSUPPORTED'], h5opt)
+        # The error is only raised once
+        PtychoOutput.wait_for_save()
+
+
+
+class SaveErrorTest(unittest.TestCase):
+    """
+    Works on any number of processes and is also run on 4 MPI
+    processes by MPITest.
+    """
+    def test_wait_for_save_error_on_all_nodes(self):
+        from ptypy.core import Ptycho
+        from ptypy.utils import parallel
+        # Only the master saves, so only the master has an error
+        P = u.Param(_save_thread=None, _save_error=OSError('disk full') if parallel.master else None)
+        try:
+            Ptycho.wait_for_save(P)
+        except Exception as e:
+            error = e
+        else:
+            error = None
+        self.assertIsInstance(error, OSError if parallel.master else RuntimeError)
+        self.assertIn('disk full', str(error))
+        self.assertIsNone(P._save_error)
+
+
+class MPITest(unittest.TestCase):
+
+    def test_wait_for_save_error_mpi(self):
+        out = tu.MPITestRunner(__file__ + '::SaveErrorTest', nprocs=4)
+        if out is None:
+            self.skipTest("mpirun not available or already running under MPI")
+        self.assertEqual(out.returncode, 0, msg=out.stdout.decode(errors='replace'))
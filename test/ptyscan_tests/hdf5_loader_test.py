@@ -3,10 +3,11 @@ import tempfile
 import os
 import h5py as h5
 import shutil
+from unittest import mock
 import numpy as np
 import ptypy
 from test.utils import PtyscanTestRunner
-from ptypy.experiment.hdf5_loader import Hdf5Loader
+from ptypy.experiment.hdf5_loader import Hdf5Loader, Hdf5LoaderFast
 from ptypy import utils as u
 
 
@@ -1599,6 +1600,75 @@ class Hdf5LoaderTestNoSWMR(unittest.TestCase):
         output = PtyscanTestRunner(Hdf5Loader, data_params, auto_frames=k, cleanup=False)
 
 
+    def test_fast_loader_in_chunks(self):
+        k = 12
+        frame_size_m = 20
+        frame_size_n = 20
+
+        positions_slow = np.arange(k)
+        positions_fast = np.arange(k)
+        with h5.File(self.positions_file, 'w') as f:
+            f[self.positions_slow_key] = positions_slow
+            f[self.positions_fast_key] = positions_fast
+
+        data = np.arange(k*frame_size_m*frame_size_n).reshape((k, frame_size_m, frame_size_n))
+        with h5.File(self.intensity_file, 'w') as f:
+            f[self.intensity_key] = data
+
+        mask = np.ones(data.shape[-2:], dtype=float)
+        mask[::2] = 0
+        with h5.File(self.mask_file, 'w') as f:
+            f[self.mask_key] = mask
+
+        data_params = u.Param()
+        data_params.auto_center = False
+        data_params.intensities = u.Param()
+        data_params.intensities.file = self.intensity_file
+        data_params.intensities.key = self.intensity_key
+
+        data_params.mask = u.Param()
+        data_params.mask.file = self.mask_file
+        data_params.mask.key = self.mask_key
+
+        data_params.positions = u.Param()
+        data_params.positions.file = self.positions_file
+        data_params.positions.slow_key = self.positions_slow_key
+        data_params.positions.fast_key = self.positions_fast_key
+
+        def load_in_chunks(loader_class, pars, fail_prefetch=False):
+            pars.save = None
+            loader = loader_class(pars)
+            loader.initialize()
+            if fail_prefetch:
+                # A prefetch that fails in a worker, leaving a partly
+                # written buffer behind, is read again
+                start_prefetch = loader._start_prefetch
+                def failing_prefetch():
+                    start_prefetch()
+                    if loader._prefetch is not None:
+                        slices, buffer_id, result = loader._prefetch
+                        result.wait()
+                        loader._buffer_arrays(buffer_id, len(slices))[0][:] = -1
+                        loader._prefetch = (slices, buffer_id, mock.Mock(get=mock.Mock(side_effect=OSError)))
+                loader._start_prefetch = failing_prefetch
+            frames = []
+            for i in range(4):
+                msg = loader.auto(5)
+                if isinstance(msg, dict):
+                    frames += [(f['index'], f['data'], f['mask']) for f in msg['iterable']]
+            return frames
+
+        reference = load_in_chunks(Hdf5Loader, data_params.copy(99))
+        self.assertEqual(len(reference), k)
+        for prefetch, fail_prefetch in [(False, False), (True, False), (True, True)]:
+            data_params.prefetch = prefetch
+            output = load_in_chunks(Hdf5LoaderFast, data_params.copy(99), fail_prefetch)
+            self.assertEqual(len(output), len(reference))
+            for (index, frame, mask), (ref_index, ref_frame, ref_mask) in zip(output, reference):
+                self.assertEqual(index, ref_index)
+                np.testing.assert_array_equal(frame, ref_frame,
+                                              err_msg="Frame %d differs (prefetch=%s)" % (index, prefetch))
+                np.testing.assert_array_equal(mask, ref_mask)
 
 class Hdf5LoaderTestWithSWMR(unittest.TestCase):
     def test_something(self):
@@ -0,0 +1,281 @@
+"""
+Tests for the ZMQ streaming PtyScans, using local stand-ins for the
+publishing services.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+import threading
+import pickle
+import json
+import struct
+import time
+import numpy as np
+
+from ptypy import utils as u
+from ptypy import __has_zmq__
+
+try:
+    import bitshuffle
+    has_bitshuffle = True
+except ImportError:
+    has_bitshuffle = False
+
+if __has_zmq__:
+    import zmq
+    from ptypy.experiment.zmq_receiver import FrameRingBuffer
+    from ptypy.experiment.diamond_streaming import DiamondZMQLoader
+    from ptypy.experiment.nanomax_streaming import NanomaxZmqScan
+
+SHAPE = (16, 16)
+
+
+def frame(i):
+    return np.full(SHAPE, i + 1, dtype=np.float32)
+
+
+def run_auto(scan, frames):
+    """
+    Prepare data until the end of the scan, returns frames and positions by index.
+    """
+    scan.initialize()
+    data, positions = {}, {}
+    t = time.time()
+    while time.time() - t < 20:
+        msg = scan.auto(frames)
+        if msg == scan.EOS:
+            break
+        elif msg == scan.WAIT:
+            time.sleep(0.01)
+            continue
+        for it in msg['iterable']:
+            data[it['index']] = it['data']
+            positions[it['index']] = it['position']
+    return data, positions
+
+
+@unittest.skipIf(not __has_zmq__, "zmq not available")
+class FrameRingBufferTest(unittest.TestCase):
+
+    def test_ring(self):
+        buf = FrameRingBuffer(3)
+        for i in range(3):
+            buf.next_frame(SHAPE, np.float32)[:] = frame(i)
+            buf.commit_frame((i, -i))
+        self.assertTrue(buf.full)
+
+        # The writer waits until a slot is released
+        def write():
+            buf.next_frame()[:] = frame(3)
+            buf.commit_frame((3, -3))
+        writer = threading.Thread(target=write)
+        writer.start()
+        writer.join(0.2)
+        self.assertTrue(writer.is_alive())
+        frames, positions = buf.get([0, 1])
+        buf.release(2)
+        writer.join(5)
+        self.assertEqual(buf.available, 4)
+        np.testing.assert_array_equal(frames[1], frame(1))
+        np.testing.assert_array_equal(positions[0], [0, 0])
+        frames, positions = buf.get([2, 3])
+        np.testing.assert_array_equal(frames[3], frame(3))
+        np.testing.assert_array_equal(positions[3], [3, -3])
+        with self.assertRaises(IndexError):
+            buf.get([1])
+
+        # Positions arriving separately
+        buf.release(4)
+        for i in range(4, 7):
+            self.assertTrue(buf.put_position((i, -i)))
+        self.assertEqual(buf.available, 4)
+        self.assertFalse(buf.full)
+
+        # Closing stops a waiting writer
+        buf.close()
+        self.assertIsNone(buf.next_frame())
+        self.assertFalse(buf.put_position((7, -7)))
+
+    def test_positions_ahead(self):
+        capacity = 4
+        buf = FrameRingBuffer(capacity)
+        buf.put_position((0, 0))
+        buf.next_frame(SHAPE, np.float32)[:] = frame(0)
+        buf.commit_frame()
+        buf.release(1)
+
+        # Positions run ahead of the frames by more than the capacity
+        num_positions = 3 * capacity + 1
+        for i in range(1, num_positions):
+            self.assertTrue(buf.put_position((i, -i)))
+        self.assertEqual(buf.num_positions, num_positions)
+        self.assertFalse(buf.full)
+
+        # Frames catch up and are released while they arrive
+        for i in range(1, num_positions):
+            buf.next_frame()[:] = frame(i)
+            buf.commit_frame()
+            frames, positions = buf.get([i])
+            np.testing.assert_array_equal(frames[i], frame(i))
+            np.testing.assert_array_equal(positions[i], [i, -i])
+            buf.release(i)
+        self.assertEqual(buf.available, num_positions)
+
+
+@unittest.skipIf(not __has_zmq__, "zmq not available")
+class ZmqStreamingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.context = zmq.Context()
+        self.threads = []
+
+    def tearDown(self):
+        for t in self.threads:
+            t.join(5)
+        self.context.destroy(linger=0)
+
+    def bind(self, kind):
+        socket = self.context.socket(kind)
+        socket.bind('tcp://127.0.0.1:*')
+        return socket, socket.getsockopt_string(zmq.LAST_ENDPOINT)
+
+    def start(self, target, *args):
+        t = threading.Thread(target=target, args=args, daemon=True)
+        t.start()
+        self.threads.append(t)
+
+    def test_diamond(self):
+        num_frames = 30
+        meta, meta_address = self.bind(zmq.REP)
+        push, push_address = self.bind(zmq.PUSH)
+
+        def serve_metadata():
+            self.assertEqual(meta.recv(), b"Start")
+            meta.send(pickle.dumps({'dtype': np.float32, 'shape': (num_frames,) + SHAPE}))
+            self.assertEqual(meta.recv(), b"Stop")
+            meta.send(b"")
+
+        def push_frames():
+            for i in range(num_frames):
+                push.send_multipart([frame(i).tobytes(), str(1e-6 * i).encode(), str(-1e-6 * i).encode()])
+
+        self.start(serve_metadata)
+        self.start(push_frames)
+
+        p = u.Param()
+        p.metadata = meta_address
+        p.datastream = push_address
+        p.buffer_size = 8
+        p.psize = 1e-4
+        p.energy = 7.
+        p.distance = 1.
+        p.center = (8, 8)
+        p.logfile = '/dev/null'
+        p.save = None
+        scan = DiamondZMQLoader(p)
+        data, positions = run_auto(scan, 5)
+
+        self.assertEqual(sorted(data), list(range(num_frames)))
+        for i in range(num_frames):
+            np.testing.assert_array_equal(data[i], frame(i))
+            np.testing.assert_allclose(positions[i], [-1e-6 * i, 1e-6 * i])
+        self.assertFalse(scan.receiver.is_alive())
+
+    def test_nanomax(self):
+        num_frames = 25
+        pub, pub_address = self.bind(zmq.PUB)
+
+        def publish():
+            # Give the subscriber time to connect
+            time.sleep(0.5)
+            pub.send_pyobj({'path': 'scan', 'scannr': 1})
+            for i in range(num_frames):
+                pub.send_pyobj({'x': i, 'y': 2 * i, 'diff': frame(i).astype(np.uint32)})
+            pub.send_pyobj({'path': 'finished'})
+
+        self.start(publish)
+
+        p = u.Param()
+        p.host, p.port = pub_address[len('tcp://'):].rsplit(':', 1)
+        p.port = int(p.port)
+        p.detector_host = None
+        p.xMotor = 'x'
+        p.yMotor = 'y'
+        p.buffer_size = 10
+        p.min_frames = 2
+        p.shape = 16
+        p.center = (8, 8)
+        p.psize = 1e-4
+        p.energy = 7.
+        p.distance = 1.
+        p.save = None
+        scan = NanomaxZmqScan(p)
+        data, positions = run_auto(scan, 4)
+
+        self.assertEqual(sorted(data), list(range(num_frames)))
+        for i in range(num_frames):
+            np.testing.assert_array_equal(data[i], frame(i))
+            np.testing.assert_allclose(positions[i], [-2e-6 * i, -1e-6 * i])
+        scan.receiver.stop(5)
+
+    @unittest.skipIf(not has_bitshuffle, "bitshuffle not available")
+    def test_nanomax_detector_stream(self):
+        num_frames = 25
+        buffer_size = 5
+        block_size = 64
+        pub, pub_address = self.bind(zmq.PUB)
+        push, push_address = self.bind(zmq.PUSH)
+        positions_sent = threading.Event()
+
+        def publish():
+            # Give the subscriber time to connect
+            time.sleep(0.5)
+            pub.send_pyobj({'path': 'scan', 'scannr': 1})
+            for i in range(num_frames):
+                pub.send_pyobj({'x': i, 'y': 2 * i})
+            pub.send_pyobj({'path': 'finished'})
+            positions_sent.set()
+
+        def push_frames():
+            # The positions run more than buffer_size ahead of the frames
+            positions_sent.wait(5)
+            for i in range(num_frames):
+                img = frame(i).astype(np.uint32)
+                info = {'shape': img.shape, 'type': img.dtype.str}
+                # bslz4 header: uncompressed size and block size in bytes
+                header = struct.pack('>QI', img.nbytes, block_size * img.itemsize)
+                push.send_multipart([json.dumps(info).encode(),
+                                     header + bitshuffle.compress_lz4(img, block_size=block_size).tobytes()])
+
+        self.start(publish)
+        self.start(push_frames)
+
+        p = u.Param()
+        p.host, p.port = pub_address[len('tcp://'):].rsplit(':', 1)
+        p.port = int(p.port)
+        p.detector_host, p.detector_port = push_address[len('tcp://'):].rsplit(':', 1)
+        p.detector_port = int(p.detector_port)
+        p.xMotor = 'x'
+        p.yMotor = 'y'
+        p.buffer_size = buffer_size
+        p.min_frames = 2
+        p.shape = 16
+        p.center = (8, 8)
+        p.psize = 1e-4
+        p.energy = 7.
+        p.distance = 1.
+        p.save = None
+        scan = NanomaxZmqScan(p)
+        data, positions = run_auto(scan, 4)
+
+        self.assertEqual(sorted(data), list(range(num_frames)))
+        for i in range(num_frames):
+            np.testing.assert_array_equal(data[i], frame(i))
+            np.testing.assert_allclose(positions[i], [-2e-6 * i, -1e-6 * i])
+        scan.receiver.stop(5)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -2,9 +2,14 @@
 Test descriptor submodule
 """
 import unittest
+import tempfile
+import shutil
+import os
+from unittest import mock
 
 from ptypy import defaults_tree
-from ptypy.utils.descriptor import EvalDescriptor, CODES
+from ptypy.utils import descriptor
+from ptypy.utils.descriptor import EvalDescriptor, DescriptorCache, CODES
 from ptypy.utils import Param
 
 
@@ -591,5 +596,87 @@ class EvalDescriptorTest(unittest.TestCase):
     def test_load_json(self):
         pass
 
+
+class DescriptorCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="descriptor_cache_test")
+        self.cache = descriptor.descriptor_cache
+
+    def tearDown(self):
+        descriptor.descriptor_cache = self.cache
+        shutil.rmtree(self.outpath)
+
+    def parse(self):
+        root = EvalDescriptor('')
+
+        @root.parse_doc('engine.test')
+        class Test(object):
+            """
+            Defaults:
+
+            [numiter]
+            default = 5
+            type = int
+            help = Number of iterations
+            lowlim = 0
+
+            [sub]
+            default =
+            type = Param
+            help = A sub-tree
+
+            [sub.value]
+            default = 0.5
+            type = float
+            help = A value
+            """
+        return root, Test
+
+    def test_cache(self):
+        fname = os.path.join(self.outpath, 'cache', 'descriptors.json')
+        descriptor.descriptor_cache = DescriptorCache(fname)
+        root, Test = self.parse()
+        descriptor.descriptor_cache.save()
+        self.assertTrue(os.path.exists(fname))
+
+        # A new cache reads the parsed sections from the file
+        cache = DescriptorCache(fname)
+        descriptor.descriptor_cache = cache
+        root_cached, Test_cached = self.parse()
+        self.assertEqual(len(cache._entries), 1)
+        self.assertEqual(cache._new, {})
+        self.assertEqual([(k, d.options) for k, d in root_cached.descendants],
+                         [(k, d.options) for k, d in root.descendants])
+        self.assertEqual(Test_cached.DEFAULT, Test.DEFAULT)
+        self.assertEqual(Test_cached.DEFAULT.sub.value, 0.5)
+
+    def test_prune(self):
+        cache_dir = os.path.join(self.outpath, 'cache')
+        os.makedirs(cache_dir)
+        for name in ['descriptors-0.1.json', 'other.json']:
+            open(os.path.join(cache_dir, name), 'w').close()
+        descriptor.descriptor_cache = DescriptorCache(os.path.join(cache_dir, 'descriptors-0.2.json'))
+        root, Test = self.parse()
+        descriptor.descriptor_cache.save()
+        self.assertEqual(sorted(os.listdir(cache_dir)), ['descriptors-0.2.json', 'other.json'])
+
+    def test_default_filename(self):
+        with mock.patch.dict(os.environ):
+            os.environ.pop('PTYPY_CACHE_DIR', None)
+            self.assertIsNone(DescriptorCache.default_filename())
+            os.environ['PTYPY_CACHE_DIR'] = ''
+            self.assertIsNone(DescriptorCache.default_filename())
+            os.environ['PTYPY_CACHE_DIR'] = self.outpath
+            self.assertEqual(os.path.dirname(DescriptorCache.default_filename()), self.outpath)
+
+    def test_disabled(self):
+        descriptor.descriptor_cache = DescriptorCache(None)
+        root, Test = self.parse()
+        descriptor.descriptor_cache.save()
+        self.assertEqual(Test.DEFAULT.numiter, 5)
+        self.assertEqual(os.listdir(self.outpath), [])
+
+
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,40 @@
+"""
+Tests for the lazily imported optional modules.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+import subprocess
+import sys
+
+from ptypy import utils as u
+from ptypy import __has_matplotlib__
+
+
+class LazyImportTest(unittest.TestCase):
+
+    def test_lazy_import(self):
+        mod = u.lazy_import('json')
+        self.assertIn('json', repr(mod))
+        self.assertEqual(mod.loads('[1]'), [1])
+
+    def test_import_ptypy(self):
+        code = ("import sys, ptypy; "
+                "print(sorted(m for m in ['zmq', 'matplotlib', 'scipy.ndimage'] if m in sys.modules))")
+        out = subprocess.run([sys.executable, '-c', code], check=True, stdout=subprocess.PIPE,
+                             stderr=subprocess.DEVNULL)
+        self.assertEqual(out.stdout.split()[-1], b'[]')
+
+    @unittest.skipIf(not __has_matplotlib__, "matplotlib not available")
+    def test_plot_names(self):
+        from ptypy.utils import plot_utils
+        self.assertListEqual(u._lazy_names['plot_utils'], plot_utils.__all__)
+        for name in u._lazy_attrs:
+            self.assertTrue(callable(getattr(u, name)))
+        self.assertIn('imsave', dir(u))
+
+
+if __name__ == "__main__":
+    unittest.main()
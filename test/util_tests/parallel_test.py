@@ -0,0 +1,179 @@
+"""
+Tests for the MPI utilities. AlltoallvTest, RegionAllreduceTest and
+ScatterDictTest work on any number of processes and are also run on
+4 MPI processes by MPITest.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+import numpy as np
+
+from test import utils as tu
+from ptypy.utils import parallel
+
+
+class ParallelTest(unittest.TestCase):
+
+    def test_scatter_dict(self):
+        dct = dict((k, np.full((4, 3), k, dtype=np.float32)) for k in range(10))
+        out = parallel.scatter_dict(dct, np.array([7, 2, 3, 12]))
+        self.assertListEqual(list(out.keys()), [7, 2, 3])
+        for k, v in out.items():
+            self.assertIs(type(k), int)
+            np.testing.assert_array_equal(v, dct[k])
+
+
+class AlltoallvTest(unittest.TestCase):
+
+    def exchange(self, max_count):
+        """
+        Process r sends (r + 1) * (p + 2) elements to process p.
+        """
+        sendcounts = [(parallel.rank + 1) * (p + 2) for p in range(parallel.size)]
+        recvcounts = [(p + 1) * (parallel.rank + 2) for p in range(parallel.size)]
+        send = np.concatenate([1000 * parallel.rank + 100 * p + np.arange(n, dtype=np.float32)
+                               for p, n in enumerate(sendcounts)] + [np.zeros(2, dtype=np.float32)])
+        recv = np.zeros(sum(recvcounts), dtype=np.float32)
+        default = parallel.MAX_COUNT
+        parallel.MAX_COUNT = max_count
+        try:
+            nbytes = parallel.alltoallv(send, sendcounts, recv, recvcounts)
+        finally:
+            parallel.MAX_COUNT = default
+        expected = np.concatenate([1000 * p + 100 * parallel.rank + np.arange(n, dtype=np.float32)
+                                   for p, n in enumerate(recvcounts)])
+        return recv, expected, nbytes, (sum(sendcounts) - sendcounts[parallel.rank]) * 4
+
+    def test_alltoallv(self):
+        recv, expected, nbytes, expected_nbytes = self.exchange(parallel.MAX_COUNT)
+        np.testing.assert_array_equal(recv, expected)
+        self.assertEqual(nbytes, expected_nbytes)
+
+    def test_alltoallv_rounds(self):
+        # Counts above the limit are exchanged in several rounds,
+        # assert after all exchanges so that no process is left waiting
+        out = [self.exchange(max_count) for max_count in [1, 5, 4 * parallel.size]]
+        for recv, expected, nbytes, expected_nbytes in out:
+            np.testing.assert_array_equal(recv, expected)
+            self.assertEqual(nbytes, expected_nbytes)
+
+
+class RegionAllreduceTest(unittest.TestCase):
+
+    shape = (2, 23, 31)
+
+    def check_regions(self, regions):
+        """
+        Regions of all processes, ``regions[rank]`` is this process' region.
+        """
+        rng = np.random.default_rng(parallel.rank)
+        y0, y1, x0, x1 = region = regions[parallel.rank]
+        a = np.zeros(self.shape, dtype=np.complex128)
+        a[..., y0:y1, x0:x1] = rng.normal(size=a[..., y0:y1, x0:x1].shape)
+        tile = a[..., y0:y1, x0:x1].copy()
+        full = a.copy()
+        parallel.allreduce(full)
+
+        parallel.allreduce_region(a, region)
+        # The region holds the sum over all processes
+        in_region = np.allclose(a[..., y0:y1, x0:x1], full[..., y0:y1, x0:x1], rtol=1e-12, atol=1e-12)
+
+        parallel.sync_regions(a, region)
+        a0 = parallel.bcast(a if parallel.master else None) if parallel.MPIenabled else a
+
+        # The same with only the region held by each process, which
+        # the master collects and sends out again
+        parallel.allreduce_region(tile, region, origin=(y0, x0))
+        in_tile = np.allclose(tile, full[..., y0:y1, x0:x1], rtol=1e-12, atol=1e-12)
+        if parallel.master:
+            gathered = np.zeros_like(a)
+            gathered[..., y0:y1, x0:x1] = tile
+            parallel.gather_regions(gathered, region)
+        else:
+            gathered = None
+            parallel.gather_regions(tile, region, origin=(y0, x0))
+        scattered = parallel.scatter_regions(gathered if parallel.master else tile, region)
+
+        # Assert only after all collective calls, a failure must not block the other processes
+        self.assertTrue(in_region, 'Region is not reduced')
+        self.assertTrue(in_tile, 'Region held alone is not reduced')
+        if parallel.master:
+            np.testing.assert_allclose(gathered, full, rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(scattered, full[..., y0:y1, x0:x1], rtol=1e-12, atol=1e-12)
+        np.testing.assert_allclose(a, full, rtol=1e-12, atol=1e-12)
+        # and identical on all processes
+        np.testing.assert_array_equal(a, a0)
+
+    def test_overlapping(self):
+        self.check_regions([(2 * r, 2 * r + 12, 3 * r, 3 * r + 15) for r in range(parallel.size)])
+
+    def test_disjoint(self):
+        step = self.shape[-1] // parallel.size
+        self.check_regions([(0, self.shape[-2], r * step, (r + 1) * step) for r in range(parallel.size)])
+
+    def test_empty(self):
+        regions = [(r, r + 10, 2 * r, 2 * r + 20) for r in range(parallel.size)]
+        # One process without views, and one covering everything
+        regions[-1] = (0, 0, 0, 0)
+        if parallel.size > 2:
+            regions[1] = (0, self.shape[-2], 0, self.shape[-1])
+        self.check_regions(regions)
+
+
+class ScatterDictTest(unittest.TestCase):
+
+    def scatter(self, dct, scatter_bytes):
+        """
+        Process r asks for the keys ``k % size == r`` and a missing key.
+        """
+        keys = [k for k in range(20) if k % parallel.size == parallel.rank] + [99]
+        default = parallel.SCATTER_BYTES
+        parallel.SCATTER_BYTES = scatter_bytes
+        try:
+            return keys[:-1], parallel.scatter_dict(dct if parallel.master else {}, keys)
+        finally:
+            parallel.SCATTER_BYTES = default
+
+    def test_scatter_dict_rounds(self):
+        frames = dict((k, np.full((4, 3), k, dtype=np.complex64) + 1j * k) for k in range(20))
+        masks = dict((k, np.arange(12).reshape(4, 3) % (k + 2) == 0) for k in range(20))
+        # A single round, one frame per process and round, and a few frames per round
+        out = [self.scatter(frames, scatter_bytes) for scatter_bytes in [parallel.SCATTER_BYTES, 1, 3 * 96 * parallel.size]]
+        out.append(self.scatter(masks, 2 * 12 * parallel.size))
+        out.append(self.scatter(dict((k, str(k)) for k in range(20)), 1))
+        # Assert only after all collective calls, a failure must not block the other processes
+        for (keys, result), expected in zip(out, [frames] * 3 + [masks, None]):
+            self.assertListEqual(list(result.keys()), keys)
+            for k in keys:
+                if expected is None:
+                    self.assertEqual(result[k], str(k))
+                else:
+                    self.assertEqual(result[k].dtype, expected[k].dtype)
+                    np.testing.assert_array_equal(result[k], expected[k])
+
+
+class MPITest(unittest.TestCase):
+
+    def test_region_allreduce_mpi(self):
+        out = tu.MPITestRunner(__file__ + '::RegionAllreduceTest', nprocs=4)
+        if out is None:
+            self.skipTest("mpirun not available or already running under MPI")
+        self.assertEqual(out.returncode, 0, msg=out.stdout.decode(errors='replace'))
+
+    def test_alltoallv_mpi(self):
+        out = tu.MPITestRunner(__file__ + '::AlltoallvTest', nprocs=4)
+        if out is None:
+            self.skipTest("mpirun not available or already running under MPI")
+        self.assertEqual(out.returncode, 0, msg=out.stdout.decode(errors='replace'))
+
+    def test_scatter_dict_mpi(self):
+        out = tu.MPITestRunner(__file__ + '::ScatterDictTest', nprocs=4)
+        if out is None:
+            self.skipTest("mpirun not available or already running under MPI")
+        self.assertEqual(out.returncode, 0, msg=out.stdout.decode(errors='replace'))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,106 @@
+"""
+Tests for the per-iteration profiling of reconstructions.
+
+This file is part of the PTYPY package.
+    :copyright: Copyright 2014 by the PTYPY team, see AUTHORS.
+    :license: see LICENSE for details.
+"""
+import unittest
+import tempfile
+import shutil
+import os
+import numpy as np
+
+from ptypy import utils as u
+from ptypy.core import Ptycho
+from ptypy.core.geometry import FFTchooser
+from ptypy.utils import profiling
+from ptypy.utils.profiling import profiler
+
+
+class ProfilingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.outpath = tempfile.mkdtemp(suffix="profiling_test")
+
+    def tearDown(self):
+        profiler.stop()
+        shutil.rmtree(self.outpath)
+
+    def test_profiler(self):
+        fname = os.path.join(self.outpath, 'sub', 'test.jsonl')
+        fft = FFTchooser('numpy')
+        fft.assign_fft()
+
+        # Nothing is accumulated while inactive
+        profiler.count('ffts')
+        with profiler.phase('a'):
+            pass
+        self.assertEqual(profiler.counters, {})
+        self.assertEqual(profiler.phases, {})
+
+        profiler.start(fname)
+        with profiler.phase('a'):
+            fft.fft(np.zeros((3, 8, 8), dtype=np.complex64))
+        fft.ifft_inplace(np.zeros((8, 8), dtype=np.complex64))
+        profiler.add_time('b', 0.5)
+        profiler.add_time('b', 0.25)
+        profiler.record(event='iteration', engine='test', iteration=1, iterations=1, error=np.ones(3))
+        profiler.count('ffts', 2)
+        profiler.record(event='finalize', engine='test', iteration=1)
+        profiler.stop()
+
+        recs = profiling.read_profile(fname)
+        self.assertEqual(len(recs), 2)
+        self.assertEqual(recs[0]['counters']['ffts'], 4)
+        self.assertEqual(recs[0]['phases']['b'], 0.75)
+        self.assertGreater(recs[0]['phases']['a'], 0.)
+        self.assertEqual(recs[0]['error'], [1., 1., 1.])
+        self.assertEqual(recs[1]['counters'], {'ffts': 2})
+        summary = profiling.summarize(recs, per_iteration=True)
+        self.assertIn('Engine test: 1 iterations', summary)
+        self.assertIn('ffts', summary)
+
+    def test_ptycho_profile(self):
+        p = u.Param()
+        p.verbose_level = "critical"
+        p.io = u.Param()
+        p.io.home = self.outpath
+        p.io.rfile = None
+        p.io.autosave = u.Param(active=False)
+        p.io.autoplot = u.Param(active=False)
+        p.io.interaction = u.Param(active=False)
+        p.io.profile = u.Param(active=True, file='profile.jsonl')
+        p.scans = u.Param()
+        p.scans.MF = u.Param()
+        p.scans.MF.name = 'Full'
+        p.scans.MF.data = u.Param()
+        p.scans.MF.data.name = 'MoonFlowerScan'
+        p.scans.MF.data.shape = 32
+        p.scans.MF.data.num_frames = 50
+        p.scans.MF.data.save = None
+        p.engines = u.Param()
+        p.engines.DM = u.Param(name='DM', numiter=4, numiter_contiguous=2)
+        p.engines.ML = u.Param(name='ML', numiter=3)
+        P = Ptycho(p, level=5)
+        self.assertFalse(profiler.active)
+
+        recs = profiling.read_profile(os.path.join(self.outpath, 'profile.jsonl'))
+        events = [(r['event'], r['engine'], r['iteration']) for r in recs]
+        self.assertListEqual(events, [('iteration', 'DM', 2), ('iteration', 'DM', 4), ('finalize', 'DM', 4),
+                                      ('iteration', 'ML', 1), ('iteration', 'ML', 2), ('iteration', 'ML', 3),
+                                      ('finalize', 'ML', 3)])
+        for r in recs:
+            if r['event'] == 'iteration':
+                self.assertGreater(r['counters']['ffts'], 0)
+                self.assertGreater(r['phases']['iterate'], 0.)
+                self.assertGreater(r['peak_memory'], 0)
+        self.assertIn('fourier_update', recs[0]['phases'])
+        self.assertIn('gradient', recs[3]['phases'])
+        summary = profiling.summarize(recs)
+        self.assertIn('Engine DM: 4 iterations (1-4)', summary)
+        self.assertIn('Engine ML: 3 iterations (1-3)', summary)
+
+
+if __name__ == "__main__":
+    unittest.main()
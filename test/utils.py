@@ -12,6 +12,8 @@ This file is part of the PTYPY package.
 import inspect
 import shutil
 import os
+import sys
+import subprocess
 import tempfile
 import numpy as np
 from ptypy import utils as u
@@ -25,6 +27,32 @@ def get_test_data_path(name):
                     ['test_data/', name,'/'])
 
 
+def MPITestRunner(test, nprocs=4, timeout=900):
+    """
+    Run the pytest node `test`, e.g. ``__file__ + '::SomeTest'``, on
+    `nprocs` MPI processes.
+
+    Returns the completed process, or None if this is already an MPI run
+    or mpirun / mpi4py are not available.
+    """
+    mpirun = shutil.which('mpirun') or shutil.which('mpiexec')
+    if parallel.size > 1 or mpirun is None or parallel.MPI is None:
+        return None
+    cmd = [mpirun, '-n', str(nprocs)]
+    version = subprocess.run([mpirun, '--version'], stdout=subprocess.PIPE,
+                             stderr=subprocess.STDOUT).stdout
+    if b'Open MPI' in version or b'OpenRTE' in version:
+        cmd += ['--oversubscribe']
+        if hasattr(os, 'geteuid') and os.geteuid() == 0:
+            cmd += ['--allow-run-as-root']
+    cmd += [sys.executable, '-m', 'pytest', '-q', '-p', 'no:cacheprovider', test]
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    env = dict(os.environ)
+    env['PYTHONPATH'] = os.pathsep.join([root] + [p for p in [env.get('PYTHONPATH')] if p])
+    return subprocess.run(cmd, cwd=root, env=env, timeout=timeout,
+                          stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+
 def PtyscanTestRunner(ptyscan_instance, data_params, save_type='append', auto_frames=20, ncalls=1, cleanup=True):
         u.verbose.set_level(3)
         out_dict = {}